@@ -1,17 +1,33 @@
 import re
+import os
+import types
+import hashlib
+import pickle
 import numpy as np
-import copy
 from caracal.utils.requires import extras
 
 
+# Bump when read_caltable changes what it returns, to invalidate existing caches
+CACHE_VERSION = 1
+
+# Where the caches go if the directory of the database is not writable
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "caracal")
+
+
 class catalog_parser:
-    def __init__(self, filename):
+    def __init__(self, filename, cache=True):
         """
             The all-knowning catalog class
             Give me a filename and I shall pass on divine knowledge
+            If cache is True, the parsed database is read from (or saved
+            to) a binary cache, see load_caltable()
         """
         cls = self.__class__
-        self._cat = cls.read_caltable(filename)
+        self._cat = cls.load_caltable(filename) if cache else cls.read_caltable(filename)
+        # read-only views of the database, shared by all users
+        self._db = types.MappingProxyType({name: types.MappingProxyType(src)
+                                           for name, src in self._cat.items()})
+        self._tree = None
 
     # Comment by Josh: @property is a means to protect private
     # Variables
@@ -21,8 +37,40 @@ class catalog_parser:
     # a.db = XXX is then impossible.
     @property
     def db(self):
-        """ Returns a copy of divine sky knowledge """
-        return copy.deepcopy(self._cat)
+        """ Returns a read-only view of divine sky knowledge """
+        return self._db
+
+    @staticmethod
+    def unit_vectors(ra, decl):
+        """ Unit vectors (N, 3) of positions given by RA and Dec in rad """
+        ra, decl = np.asarray(ra, dtype=float), np.asarray(decl, dtype=float)
+        return np.stack([np.cos(decl) * np.cos(ra),
+                         np.cos(decl) * np.sin(ra),
+                         np.sin(decl)], axis=-1).reshape(-1, 3)
+
+    @extras("scipy.spatial")
+    def _spatial_index(self):
+        """ KD-tree over the unit vectors of the sources, built on first use """
+        if self._tree is None:
+            from scipy.spatial import cKDTree
+            self._names = list(self._cat.keys())
+            self._tree = cKDTree(self.unit_vectors([src["ra"] for src in self._cat.values()],
+                                                   [src["decl"] for src in self._cat.values()]))
+        return self._tree
+
+    def crossmatch(self, ra, decl, tol=2.9E-3):
+        """
+        Finds the sources within an angular distance tol (rad) of each of the
+        positions given by ra and decl (rad, scalars or arrays), in a single
+        query of the spatial index.
+        Returns a list with, per position, the name of the first matching
+        source in database order, or None.
+        """
+        tree = self._spatial_index()
+        # angular distance to chord length on the unit sphere
+        chord = 2 * np.sin(min(tol, np.pi) / 2)
+        matches = tree.query_ball_point(self.unit_vectors(ra, decl), chord)
+        return [self._names[min(match)] if match else None for match in matches]
 
     def __str__(self):
         """ Return multiline string describing the calibrator database """
@@ -45,6 +93,49 @@ class catalog_parser:
                       for name, db in self._cat.items()])
         return '\n'.join(lines)
 
+    @classmethod
+    def cache_files(cls, filename):
+        """
+        Candidate cache files of a database: next to it, else in CACHE_DIR
+        """
+        cachename = os.path.basename(filename) + ".cache"
+        return [os.path.join(os.path.dirname(os.path.abspath(filename)), cachename),
+                os.path.join(CACHE_DIR, cachename)]
+
+    @classmethod
+    def load_caltable(cls, filename):
+        """
+        Returns the database as read_caltable() does, but from a pickled
+        cache when there is one for the current contents of filename (and
+        the current CACHE_VERSION). Otherwise parses the file and caches
+        the result in the first writable cache location.
+        :side-effects: writes the cache file
+        """
+        with open(filename, "rb") as f:
+            key = "{0:d}:{1:s}".format(CACHE_VERSION, hashlib.sha256(f.read()).hexdigest())
+        cachefiles = cls.cache_files(filename)
+        for cachefile in cachefiles:
+            try:
+                with open(cachefile, "rb") as f:
+                    cachekey, calibrator_db = pickle.load(f)
+            except (OSError, EOFError, ValueError, TypeError, pickle.UnpicklingError):
+                continue
+            if cachekey == key:
+                return calibrator_db
+
+        calibrator_db = cls.read_caltable(filename)
+        for cachefile in cachefiles:
+            try:
+                os.makedirs(os.path.dirname(cachefile), exist_ok=True)
+                tmpfile = "{0:s}.{1:d}.tmp".format(cachefile, os.getpid())
+                with open(tmpfile, "wb") as f:
+                    pickle.dump((key, calibrator_db), f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(tmpfile, cachefile)
+                break
+            except OSError:
+                continue
+        return calibrator_db
+
     @classmethod
     def read_caltable(cls, filename):
         """
@@ -73,6 +73,11 @@ then edit the file to suit your needs.
     add('-ew', '--end-worker', metavar="WORKER",
         help='stop pipeline after this worker')
 
+    add('-r', '--resume',
+        help='resume a failed or interrupted run of this configuration: skip the workers and steps it completed '
+             '(as journalled in the output directory), restoring the pipeline state they left',
+        action='store_true')
+
     add('-ct', '--container-tech', choices=["default", "docker", "udocker", "singularity", "podman"],
         default="default",
         help='Containerization backend to use. Default falls back on "general: backend" config setting, or docker if not set.')
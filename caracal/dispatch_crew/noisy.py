@@ -4,6 +4,12 @@
 
 import numpy as np
 import pyrap.tables as tables
+import concurrent.futures
+import functools
+import hashlib
+import json
+import glob
+import re
 import sys
 import os
 import caracal
@@ -39,16 +45,63 @@ def InterpolateTsyseff(tsyseff, chans):
     caracal.log.info('Interpolating Tsys/eff table to observed frequencies ...')
     return np.interp(np.ravel(chans), tsyseff[:, 0], tsyseff[:, 1])
 
-# Get single-MS flags, intervals, channel widths, channel frequencies and calculate natural rms (ignoring flags)
+# Get the modification state of the columns and subtables of an MS read by SummariseMS
+# The storage manager files of a column are modified whenever the column (e.g., FLAG) is written
 
 
-def ProcessSingleMS(ms, kB, tsyseff, tsyseffFile, Aant, selectFieldName, verbose=0):
-    if verbose > 1:
-        caracal.log.info('    Processing MS file {0:s}'.format(ms))
+def MSState(ms):
+    t = tables.table(ms, ack=False)
+    seqnrs = sorted(set(t.getdminfo(col)['SEQNR'] for col in ['FLAG', 'INTERVAL', 'FIELD_ID', 'ANTENNA1', 'ANTENNA2']))
+    t.close()
+    files = [os.path.join(ms, 'table.dat')] + [os.path.join(ms, sub, 'table.dat') for sub in ['FIELD', 'SPECTRAL_WINDOW', 'POLARIZATION']]
+    for seqnr in seqnrs:
+        # All files of the storage manager, as e.g. StandardStMan only updates its index file (table.fNi) on write
+        files += [ff for ff in glob.glob(os.path.join(ms, 'table.f{0:d}*'.format(seqnr))) if re.match(r'table\.f{0:d}(\D|$)'.format(seqnr), os.path.basename(ff))]
+    state = []
+    for ff in sorted(files):
+        if os.path.exists(ff):
+            stat = os.stat(ff)
+            state.append([os.path.relpath(ff, ms), stat.st_mtime_ns, stat.st_size])
+    return state
+
+# Load the single-MS summary from its cache file next to the MS if the MS has not changed since, or return None
+# The cache is keyed on the MS path, the modification state of the MS and the field selection
+
+
+def SummaryCache(ms, selectFieldName):
+    cacheFile = '{0:s}-noise-{1:s}.npz'.format(os.path.splitext(os.path.realpath(ms))[0], hashlib.sha1(str(selectFieldName).encode()).hexdigest()[:8])
+    key = hashlib.sha1(json.dumps([os.path.realpath(ms), selectFieldName, MSState(ms)]).encode()).hexdigest()
+    return cacheFile, key
+
+
+def LoadSummary(ms, selectFieldName):
+    cacheFile, key = SummaryCache(ms, selectFieldName)
+    if not os.path.exists(cacheFile):
+        return None
+    try:
+        with np.load(cacheFile) as cache:
+            if str(cache['key']) != key:
+                return None
+            return {item: cache[item] for item in cache.files if item != 'key'}
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def SaveSummary(ms, selectFieldName, summary):
+    cacheFile, key = SummaryCache(ms, selectFieldName)
+    try:
+        with open(cacheFile + '.tmp', 'wb') as cache:
+            np.savez(cache, key=key, **summary)
+        os.replace(cacheFile + '.tmp', cacheFile)
+    except OSError as exc:
+        caracal.log.info('      Cannot write noise summary cache {0:s} ({1:})'.format(cacheFile, exc))
+
+# Get single-MS unflagged integration per channel, channel widths, channel frequencies and integration
+# The MS is read in chunks of rows, such that memory use scales with the number of channels rather than the size of the MS
+
+
+def SummariseMS(ms, selectFieldName, verbose=0, chunkSize=2**27):
     t = tables.table(ms, ack=False)
-    fieldIDs = t.getcol('FIELD_ID')
-    ant1 = t.getcol('ANTENNA1')
-    ant2 = t.getcol('ANTENNA2')
     fieldNames = tables.table(ms + '/FIELD', ack=False).getcol('NAME')
     spw = tables.table(ms + '/SPECTRAL_WINDOW', ack=False)
     channelWidths = spw.getcol('CHAN_WIDTH')
@@ -67,20 +120,56 @@ def ProcessSingleMS(ms, kB, tsyseff, tsyseffFile, Aant, selectFieldName, verbose
             sys.exit()
         if verbose > 1:
             caracal.log.info('      Successfully selected Field with name {0:s} (Field ID = {1:d})'.format(selectFieldName, selectFieldID))
-        selection = fieldIDs == selectFieldID
     else:
         if verbose > 1:
             caracal.log.info('      Will process all available fields: {0:}'.format(fieldNames))
-        selection = fieldIDs >= fieldIDs.min()
+        selectFieldID = None
 
-    autoCorr = ant1 == ant2
+    # select Stokes I-related corrs
+    keepCorrs = []
+    for cc, corr in enumerate(corrs):
+        if corr not in 'I,RR,LL,XX,YY,'.split(','):
+            if verbose > 1:
+                caracal.log.info('      Discarding correlation {0:s} for predicting the Stokes I noise'.format(corr))
+        else:
+            keepCorrs.append(cc)
+    corrs = [corrs[cc] for cc in keepCorrs]
     if verbose > 1:
-        if autoCorr.sum():
+        caracal.log.info('      Retained correlations {0:}'.format(corrs))
+        caracal.log.info('      Loading flags and intervals ...')
+
+    # Accumulate the unflagged integration per channel (sec) over chunks of rows
+    nRows = t.nrows()
+    nChan = channelFreqs.shape[1]
+    chunkRows = max(1, int(chunkSize // max(1, nChan * len(corrs))))
+    unflaggedIntegration = np.zeros(nChan)
+    totalInterval, nrIntegration, nrAutoCorr = 0., 0, 0
+    antennas, intervals = np.array([], dtype=int), np.array([])
+    for startRow in range(0, nRows, chunkRows):
+        nRow = min(chunkRows, nRows - startRow)
+        ant1 = t.getcol('ANTENNA1', startRow, nRow)
+        ant2 = t.getcol('ANTENNA2', startRow, nRow)
+        antennas = np.union1d(antennas, np.union1d(ant1, ant2))
+        nrAutoCorr += np.count_nonzero(ant1 == ant2)
+        selection = ant1 != ant2
+        if selectFieldID is not None:
+            selection &= t.getcol('FIELD_ID', startRow, nRow) == selectFieldID
+        if not selection.any():
+            continue
+        interval = t.getcol('INTERVAL', startRow, nRow)[selection]
+        flag = t.getcol('FLAG', startRow, nRow)[selection][:, :, keepCorrs]   # flagged data have flag = True
+        unflaggedIntegration += interval.dot(len(corrs) - flag.sum(axis=2))
+        totalInterval += interval.sum()
+        nrIntegration += interval.shape[0]
+        intervals = np.union1d(intervals, interval)
+    t.close()
+
+    if verbose > 1:
+        if nrAutoCorr:
             caracal.log.info('      Successfully selected crosscorrelations only')
         else:
             caracal.log.info('      Found crosscorrelations only')
-    selection *= ant1 != ant2
-    nrAnt = np.unique(np.concatenate((ant1, ant2))).shape[0]
+    nrAnt = antennas.shape[0]
     nrBaseline = nrAnt * (nrAnt - 1) // 2
     if verbose > 1:
         caracal.log.info('      Number of antennas  = {0:d}'.format(nrAnt))
@@ -90,52 +179,53 @@ def ProcessSingleMS(ms, kB, tsyseff, tsyseffFile, Aant, selectFieldName, verbose
             caracal.log.info('      Channel width = {0:.5e} Hz'.format(np.unique(channelWidths)[0]))
         else:
             caracal.log.info('      The channel width takes the following unique values: {0:} Hz'.format(np.unique(channelWidths)))
-
-    if verbose > 1:
-        caracal.log.info('      Loading flags and intervals ...')
-    flag = t.getcol('FLAG')[selection]          # flagged data have flag = True
-    # select Stokes I-related corrs
-    cc = 0
-    while cc < len(corrs):
-        if corrs[cc] not in 'I,RR,LL,XX,YY,'.split(','):
-            if verbose > 1:
-                caracal.log.info('      Discarding correlation {0:s} for predicting the Stokes I noise'.format(corrs[cc]))
-            flag = np.delete(flag, cc, axis=2)
-            del (corrs[cc])
-        else:
-            cc += 1
-    if verbose > 1:
-        caracal.log.info('      Retained correlations {0:}'.format(corrs))
-    interval = t.getcol('INTERVAL')[selection]
-    if verbose > 1:
-        if np.unique(interval).shape[0] == 1:
-            caracal.log.info('      Interval = {0:.5e} sec'.format(np.unique(interval)[0]))
+        if intervals.shape[0] == 1:
+            caracal.log.info('      Interval = {0:.5e} sec'.format(intervals[0]))
         else:
-            caracal.log.info('      The interval takes the following unique values: {0:} sec'.format(np.unique(interval)))
-    t.close()
+            caracal.log.info('      The interval takes the following unique values: {0:} sec'.format(intervals))
 
     if verbose > 1:
-        caracal.log.info('      The *flag* array has shape (Nr_integrations, Nr_channels, Nr_polarisations) = {0:}'.format(flag.shape))
-        caracal.log.info('      The *interval* array has shape (Nr_integrations) = {0:}'.format(interval.shape))
+        caracal.log.info('      Read flags of (Nr_integrations, Nr_channels, Nr_polarisations) = {0:} in chunks of {1:d} rows'.format((nrIntegration, nChan, len(corrs)), chunkRows))
         caracal.log.info('      The *channel* width array has shape (-, Nr_channels) = {0:}'.format(channelWidths.shape))
 
+    return {'unflaggedIntegration': unflaggedIntegration, 'nrIntegration': nrIntegration, 'totalInterval': totalInterval,
+            'nrPol': len(corrs), 'nrBaseline': nrBaseline, 'channelWidths': channelWidths, 'channelFreqs': channelFreqs}
+
+# Get single-MS summary (from cache if possible) and calculate natural rms (ignoring flags)
+
+
+def ProcessSingleMS(ms, kB, tsyseff, tsyseffFile, Aant, selectFieldName, verbose=0, chunkSize=2**27, cache=True):
     if verbose > 1:
-        caracal.log.info('      Total Integration on selected field(s) = {0:.2f} h ({1:d} polarisations)'.format(interval.sum() / nrBaseline / 3600, flag.shape[2]))
+        caracal.log.info('    Processing MS file {0:s}'.format(ms))
+    summary = LoadSummary(ms, selectFieldName) if cache else None
+    if summary is None:
+        summary = SummariseMS(ms, selectFieldName, verbose=verbose, chunkSize=chunkSize)
+        if cache:
+            SaveSummary(ms, selectFieldName, summary)
+    elif verbose > 1:
+        caracal.log.info('      MS and flags unchanged, using the cached summary of field(s) {0:}'.format(selectFieldName or 'all'))
+    unflaggedIntegration, nrIntegration, totalInterval = summary['unflaggedIntegration'], int(summary['nrIntegration']), float(summary['totalInterval'])
+    nrPol, nrBaseline = int(summary['nrPol']), int(summary['nrBaseline'])
+    channelWidths, channelFreqs = summary['channelWidths'], summary['channelFreqs']
+
+    if verbose > 1:
+        caracal.log.info('      Total Integration on selected field(s) = {0:.2f} h ({1:d} polarisations)'.format(totalInterval / nrBaseline / 3600, nrPol))
     if tsyseffFile is not None:
-        rms = np.sqrt(2) * kB * InterpolateTsyseff(tsyseff, channelFreqs) / Aant / np.sqrt(channelWidths * interval.sum() * flag.shape[2])
+        rms = np.sqrt(2) * kB * InterpolateTsyseff(tsyseff, channelFreqs) / Aant / np.sqrt(channelWidths * totalInterval * nrPol)
     else:
-        rms = np.sqrt(2) * kB * tsyseff / Aant / np.sqrt(channelWidths * interval.sum() * flag.shape[2])
+        rms = np.sqrt(2) * kB * tsyseff / Aant / np.sqrt(channelWidths * totalInterval * nrPol)
     if len(rms.shape) == 2 and rms.shape[0] == 1:
         rms = rms[0]
 
     if verbose > 1:
         caracal.log.info('      SINGLE MS median natural noise ignoring flags = {0:.3e} Jy/beam'.format(np.nanmedian(rms)))
 
-    return flag, interval, channelWidths, channelFreqs, rms
+    return unflaggedIntegration, nrIntegration, channelWidths, channelFreqs, rms
 
 
 # Predict natural rms for an arbitrary number of MS files (both ignoring and applying flags)
-def PredictNoise(MS, tsyseff, diam, selectFieldName, verbose=0):
+# Up to ncpu MS files are read in parallel processes, and their summaries are cached unless cache=False
+def PredictNoise(MS, tsyseff, diam, selectFieldName, verbose=0, ncpu=1, cache=True):
 
     # Get Tsys/eff either from table (col1 = frequency, col2 = Tsys/eff) or as a float values (frequency independent Tsys/eff value)
     tsyseffFile, tsyseff = GetTsyseff(tsyseff)
@@ -148,15 +238,22 @@ def PredictNoise(MS, tsyseff, diam, selectFieldName, verbose=0):
     else:
         SEFD = 2 * kB * np.median(tsyseff[:, 1]) / Aant  # median system equivalent flux density (Jy)
 
-    # Read MS files to get the flags and calculate single-MS natural rms values (ignoring flags)
+    # Read MS files to get the unflagged integration and calculate single-MS natural rms values (ignoring flags)
+    args = (kB, tsyseff, tsyseffFile, Aant, selectFieldName)
+    ncpu = max(1, min(ncpu, len(MS)))
+    if ncpu > 1:
+        with concurrent.futures.ProcessPoolExecutor(ncpu) as executor:
+            results = list(executor.map(functools.partial(ProcessSingleMS, verbose=verbose, cache=cache), MS, *[[arg] * len(MS) for arg in args]))
+    else:
+        results = [ProcessSingleMS(ms, *args, verbose=verbose, cache=cache) for ms in MS]
 
     # Start with first file ...
-    flag0, interval0, channelWidths0, channelFreqs0, rms0 = ProcessSingleMS(MS[0], kB, tsyseff, tsyseffFile, Aant, selectFieldName, verbose=verbose)
+    unflaggedIntegration, nrIntegration, channelWidths0, channelFreqs0, rms0 = results[0]
     rmsAll = [rms0]
 
-    # ... and do the same for all other MS's appending to the flag array, checking that the channelisation is the same
+    # ... and add the unflagged integration of all other MS's, checking that the channelisation is the same
     for ii in range(1, len(MS)):
-        flagi, intervali, channelWidthsi, channelFreqsi, rmsi = ProcessSingleMS(MS[ii], kB, tsyseff, tsyseffFile, Aant, selectFieldName, verbose=verbose)
+        unflaggedIntegrationi, nrIntegrationi, channelWidthsi, channelFreqsi, rmsi = results[ii]
 
         if channelWidths0.shape != channelWidthsi.shape or (channelWidths0 != channelWidthsi).sum() or (channelFreqs0 != channelFreqsi).sum():
             caracal.log.info('')
@@ -166,23 +263,19 @@ def PredictNoise(MS, tsyseff, diam, selectFieldName, verbose=0):
             caracal.log.info(' Aborting ...')
             sys.exit()
         else:
-            flag0 = np.concatenate((flag0, flagi), axis=0)
-            interval0 = np.concatenate((interval0, intervali), axis=0)
+            unflaggedIntegration = unflaggedIntegration + unflaggedIntegrationi
+            nrIntegration += nrIntegrationi
             rmsAll.append(rmsi)
 
-    # Message concatenated files
+    # Message combined files
     if verbose > 1 and len(MS) > 1:
-        caracal.log.info('    Concatenating all {0:d} MS files ...'.format(len(MS)))
-        caracal.log.info('      The concatenated *flag* array has shape (Nr_integrations, Nr_channels, Nr_polarisations) = {0:}'.format(flag0.shape))
-        caracal.log.info('      The concatenated *interval* array has shape (Nr_integrations) = {0:}'.format(interval0.shape))
-        caracal.log.info('      The concatenated *channel* width array has shape (-, Nr_channels) = {0:}'.format(channelWidths0.shape))
+        caracal.log.info('    Combining all {0:d} MS files ...'.format(len(MS)))
+        caracal.log.info('      Total Nr_integrations = {0:d}'.format(nrIntegration))
+        caracal.log.info('      The *channel* width array has shape (-, Nr_channels) = {0:}'.format(channelWidths0.shape))
 
     # Reshape arrays
-    if verbose > 1 and len(MS) > 1:
-        caracal.log.info('      Reshaping arrays ...')
-    interval0.resize((interval0.shape[0], 1, 1))
-    channelWidths0.resize((channelWidths0.shape[1]))
-    channelFreqs0.resize((channelFreqs0.shape[1]))
+    channelWidths0 = channelWidths0[0]
+    channelFreqs0 = channelFreqs0[0]
 
     # Interpolate Tsys
     if tsyseffFile is not None:
@@ -191,8 +284,7 @@ def PredictNoise(MS, tsyseff, diam, selectFieldName, verbose=0):
     # Calculate theoretical natural rms
     rmsAll = np.array(rmsAll)
     rmsAll = 1. / np.sqrt((1. / rmsAll**2).sum(axis=0))
-    unflaggedIntegration = (interval0 * (1 - flag0.astype(int))).sum(axis=(0, 2))  # total integration per channel adding up all UNFLAGGED integrations and polarisations (sec)
-    unflaggedIntegration[unflaggedIntegration == 0] = np.nan
+    unflaggedIntegration[unflaggedIntegration == 0] = np.nan   # total integration per channel adding up all UNFLAGGED integrations and polarisations (sec)
     rmsUnflagged = np.sqrt(2) * kB * tsyseff / Aant / np.sqrt(channelWidths0 * unflaggedIntegration)
 
     if verbose >= 1:
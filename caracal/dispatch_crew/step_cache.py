@@ -0,0 +1,157 @@
+import os
+import json
+import hashlib
+import threading
+
+# Stimela parameter suffixes giving the directory of a file
+IO_SUFFIXES = {"msfile": "msdir", "input": "indir", "output": "outdir"}
+
+
+def fingerprint(path):
+    """
+    Fingerprint of a file or directory (e.g. an MS): size and modification time of the
+    file, or of the files in the directory and in its immediate subdirectories (tables),
+    except for the casacore lock files, which change on read access.
+    Returns None if the path does not exist
+    """
+    if os.path.isfile(path):
+        stat = os.stat(path)
+        return [stat.st_size, stat.st_mtime_ns]
+    if not os.path.isdir(path):
+        return None
+    entries = []
+    for top in [path] + sorted(entry.path for entry in os.scandir(path) if entry.is_dir()):
+        for entry in sorted(os.scandir(top), key=lambda entry: entry.name):
+            if entry.is_file() and not entry.name.endswith(".lock"):
+                stat = entry.stat()
+                entries.append([os.path.relpath(entry.path, path), stat.st_size, stat.st_mtime_ns])
+    return entries
+
+
+class StepCache(object):
+    """
+    Cache of the recipe steps completed in earlier runs of the pipeline, to skip them on rerun.
+
+    Steps change their MSs and tables in place, so a step cannot be recognised from the
+    current state of its files alone. Instead, every file a step refers to gets a chain key,
+    the hash of all the steps applied to the file so far (cab, cab version and tag, and all
+    parameters). A step is identified by its own description and the chain keys of its
+    files. It is skipped if the same step completed before, the last completed step on each
+    of its files is that step or one of the steps that followed it in the chain (i.e. no
+    different step has been applied since), the files are still as that last step left them
+    (i.e. nothing else has changed them since), and no earlier step in this run touching
+    them has been run.
+
+    If reuse is False, completed steps are only recorded, and all steps are run.
+    """
+
+    def __init__(self, filename, reuse=True):
+        self.filename = filename
+        self.reuse = reuse
+        # chain keys of the files before each completed step, by step key
+        self.completed = {}
+        # last completed step key and fingerprint of each file
+        self.fingerprints = {}
+        if os.path.exists(filename):
+            try:
+                with open(filename) as f:
+                    cache = json.load(f)
+                self.completed = dict(cache["completed"])
+                self.fingerprints = dict(cache["fingerprints"])
+            except (ValueError, KeyError, TypeError):
+                # unreadable cache, start afresh
+                self.completed, self.fingerprints = {}, {}
+        # chain keys and files changed in this run, and chain keys before the steps to run
+        self.chains = {}
+        self.changed = set()
+        self.parents = {}
+        self.lock = threading.Lock()
+
+    def describe(self, image, config, version=None, tag=None, dirs=None, is_file=None):
+        """
+        Returns the description of a step, as a dict with its identity (a hash of the cab name,
+        version, tag and parameters) and its files as {file: [candidate paths]}.
+        The files are the parameters with Stimela I/O suffixes (e.g. "name:output"), and
+        other parameters for which is_file(value) is true (looked for in the MS, output and
+        input directories, in this order, as given by dirs).
+        Returns None for Python function steps, which are never cached.
+        """
+        if callable(image):
+            return None
+        dirs = dirs or {}
+        identity = hashlib.sha1(json.dumps([image, version, tag, config], sort_keys=True,
+                                           default=str).encode()).hexdigest()
+        files = {}
+
+        def scan(value):
+            if isinstance(value, str):
+                name, _, suffix = value.partition(':')
+                if suffix in IO_SUFFIXES:
+                    files[os.path.normpath(name)] = [os.path.join(dirs.get(IO_SUFFIXES[suffix]) or ".", name)]
+                elif not suffix and is_file and is_file(value):
+                    files[os.path.normpath(value)] = [os.path.join(dirs[key], value)
+                                                      for key in ("msdir", "outdir", "indir") if dirs.get(key)]
+            elif isinstance(value, (list, tuple)):
+                for item in value:
+                    scan(item)
+            elif isinstance(value, dict):
+                for item in value.values():
+                    scan(item)
+
+        scan(config)
+        return dict(identity=identity, files=files)
+
+    @staticmethod
+    def file_fingerprint(paths):
+        """Fingerprint of the first existing of a file's candidate paths"""
+        for path in paths:
+            if os.path.exists(path):
+                return fingerprint(path)
+        return None
+
+    def plan(self, step):
+        """
+        Given a step description (see describe()), decides whether it can be skipped, and
+        advances the chain keys of its files. Returns the step key if the step has to be run
+        (to be passed to record() when it has), or None if it can be skipped.
+        Steps must be planned in the order they are added to the pipeline. Steps without
+        files are always run.
+        """
+        files = step["files"]
+        with self.lock:
+            parents = {name: self.chains.get(name, name) for name in files}
+            key = hashlib.sha1(json.dumps([step["identity"], sorted(parents.items())]).encode()).hexdigest()
+            skip = self.reuse and files and key in self.completed and not self.changed & set(files) and \
+                all(self.applied(name, key) and self.fingerprints[name][1] == self.file_fingerprint(paths)
+                    for name, paths in files.items())
+            for name in files:
+                self.chains[name] = key
+            if skip:
+                return None
+            self.changed.update(files)
+            self.parents[key] = parents
+            return key
+
+    def applied(self, name, key):
+        """True if the step key is in the chain of completed steps leading to the last recorded state of a file"""
+        last = self.fingerprints.get(name, [None])[0]
+        seen = set()
+        while last in self.completed and last not in seen:
+            if last == key:
+                return True
+            seen.add(last)
+            last = self.completed[last].get(name)
+        return False
+
+    def record(self, step, key):
+        """Records a step (see plan()) as completed"""
+        if not step["files"]:
+            return
+        with self.lock:
+            self.completed[key] = self.parents.pop(key)
+            for name, paths in step["files"].items():
+                self.fingerprints[name] = [key, self.file_fingerprint(paths)]
+            tmpfile = f"{self.filename}.tmp"
+            with open(tmpfile, "w") as f:
+                json.dump(dict(completed=self.completed, fingerprints=self.fingerprints), f)
+            os.replace(tmpfile, self.filename)
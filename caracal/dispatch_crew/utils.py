@@ -4,7 +4,9 @@ import yaml
 import caracal
 import caracal.dispatch_crew.caltables as mkct
 import re
+import os
 import codecs
+import json
 from caracal.utils.requires import extras
 
 
@@ -26,13 +28,116 @@ def angular_dist_pos_angle(ra1, dec1, ra2, dec2):
     return R, PA
 
 
+def load_summary(filename):
+    """
+    Reads an MS summary file into a dict. Lists stay lists, NumPy arrays over
+    the summary are only built by MSInfo, for its own use.
+    """
+    with open(filename, 'r') as f:
+        try:
+            return json.load(f)
+        except ValueError:
+            # not strict JSON, fall back to the YAML parser
+            f.seek(0)
+            return ruamel.yaml.load(f, ruamel.yaml.RoundTripLoader)
+
+
+# Loaded MS summaries by path, with the modification time of the file when loaded
+_msinfo_cache = {}
+
+
+class MSInfo(dict):
+    """
+    MS summary (the <ms>-summary.json file written by the obsconf worker)
+    with indexes over its fields.
+
+    It behaves like the summary dict (with plain lists, as read from the
+    file) and in addition provides the field names and source IDs (lists),
+    dict indexes by field name and source ID, the reference and delay
+    directions of all fields as (nfield, 2) arrays of (RA, Dec) in rad,
+    and the total scan time per source ID.
+    """
+
+    def __init__(self, info):
+        super().__init__(info)
+        fields = self['FIELD']
+        self.names = list(fields['NAME'])
+        self.source_ids = list(fields['SOURCE_ID'])
+        # First occurrence wins, as with list.index()
+        self.name_index = {}
+        for idx, name in enumerate(self.names):
+            self.name_index.setdefault(name, idx)
+        self.source_id_index = {}
+        for idx, source_id in enumerate(self.source_ids):
+            self.source_id_index.setdefault(source_id, idx)
+        self.reference_dirs = self._directions('REFERENCE_DIR')
+        self.delay_dirs = self._directions('DELAY_DIR')
+        self._calibrator_matches = {}
+        self.scan_time = {str(source_id): numpy.sum(list(scans.values()))
+                          for source_id, scans in (self.get('SCAN') or {}).items()}
+
+    def _directions(self, column):
+        dirs = self['FIELD'].get(column)
+        if dirs is None or len(dirs) == 0:
+            return None
+        return numpy.array([direction[0][:2] for direction in dirs], dtype=float)
+
+    @classmethod
+    def load(cls, filename):
+        """Returns the MSInfo of a summary file. Caches and reloads as needed"""
+        msinfo, mtime_cache = _msinfo_cache.get(filename, (None, 0))
+        # reload if file on disk is newer
+        mtime = os.path.getmtime(filename)
+        if msinfo is None or mtime > mtime_cache:
+            msinfo = cls(load_summary(filename))
+            _msinfo_cache[filename] = msinfo, mtime
+        return msinfo
+
+    @classmethod
+    def from_info(cls, info):
+        """Returns info as MSInfo, loading it if it is a summary file name"""
+        if isinstance(info, cls):
+            return info
+        if isinstance(info, str):
+            return cls.load(info)
+        return cls(info)
+
+    def index(self, field):
+        """Index of a field given by name or source ID"""
+        if isinstance(field, str):
+            index = self.name_index
+        elif isinstance(field, (int, numpy.integer)):
+            index = self.source_id_index
+        else:
+            raise ValueError("Field cannot be a {0:s}".format(str(type(field))))
+        if field not in index:
+            raise ValueError("Could not find field '{0:}' in the field list {1:}".format(field, self.names))
+        return index[field]
+
+    def calibrator_matches(self, db, tol=2.9E-3):
+        """
+        Names of the calibrators in db (a catalog_parser) matching the
+        delay directions of all fields, with None for fields without a
+        match. The crossmatch is done once per database and tolerance.
+        """
+        key = db, tol
+        if key not in self._calibrator_matches:
+            if self.delay_dirs is None:
+                matches = [None] * len(self.names)
+            else:
+                matches = db.crossmatch(self.delay_dirs[:, 0], self.delay_dirs[:, 1], tol=tol)
+            self._calibrator_matches[key] = matches
+        return self._calibrator_matches[key]
+
+    def observation_length(self, field):
+        """Total scan time of a field given by name or source ID"""
+        return self.scan_time[str(self.source_ids[self.index(field)])]
+
+
 def categorize_fields(info):
-    if isinstance(info, str):
-        with open(info, 'r') as f:
-            info = ruamel.yaml.load(f, ruamel.yaml.RoundTripLoader)
+    info = MSInfo.from_info(info)
 
-    names = info['FIELD']['NAME']
-    ids = info['FIELD']['SOURCE_ID']
+    names = info.names
     intents = info['FIELD']['INTENTS']
     intent_ids = info['FIELD']['STATE_ID']
 
@@ -62,17 +167,13 @@ def get_field_id(info, field_name):
     if not isinstance(field_name, str) and not isinstance(field_name, list):
         raise ValueError(
             "field_name argument must be comma-separated string or list")
-    if isinstance(info, str):
-        with open(info, 'r') as f:
-            info = ruamel.yaml.load(f, ruamel.yaml.RoundTripLoader)
-    names = info['FIELD']['NAME']
-    ids = info['FIELD']['SOURCE_ID']
+    info = MSInfo.from_info(info)
     results = []
     for fn in field_name.split(",") if isinstance(field_name, str) else field_name:
-        if fn not in names:
-            raise KeyError("Could not find field '{0:s}' in the field list {1:}".format(fn, names))
+        if fn not in info.name_index:
+            raise KeyError("Could not find field '{0:s}' in the field list {1:}".format(fn, info.names))
         else:
-            results.append(names.index(fn))
+            results.append(info.name_index[fn])
     return results
 
 
@@ -80,52 +181,26 @@ def select_gcal(info, targets, calibrators, mode='nearest'):
     """
       Automatically select gain calibrator
     """
-    if isinstance(info, str):
-        with open(info, 'r') as f:
-            info = ruamel.yaml.load(f, ruamel.yaml.RoundTripLoader)
-
-    names = info['FIELD']['NAME']
-    ids = info['FIELD']['SOURCE_ID']
-    dirs = info['FIELD']['REFERENCE_DIR']
-
-    def index(field):
-        if isinstance(field, str):
-            idx = names.index(field)
-        elif isinstance(field, int):
-            idx = ids.index(field)
-        return idx
+    info = MSInfo.from_info(info)
 
+    gcal = None
     if mode == 'most_scans':
         most_scans = 0
-        gcal = None
         for fid in calibrators:
-            idx = index(fid)
-            field = str(ids(idx))
+            idx = info.index(fid)
+            field = str(info.source_ids[idx])
             if most_scans < len(info['SCAN'][field]):
                 most_scans = len(info['SCAN'][field])
-                gcal = names[idx]
-    elif mode == 'nearest':
-        tras = []
-        tdecs = []
-        for target in targets:
-            idx = index(target)
-
-            tras.append(dirs[idx][0][0])
-            tdecs.append(dirs[idx][0][1])
-
-        mean_ra = numpy.mean(tras)
-        mean_dec = numpy.mean(tdecs)
-
-        nearest_dist = numpy.inf
-        gcal = None
-        for field in calibrators:
-            idx = index(field)
-            ra = dirs[idx][0][0]
-            dec = dirs[idx][0][1]
-            distance = angular_dist_pos_angle(mean_ra, mean_dec, ra, dec)[0]
-            if nearest_dist > distance:
-                nearest_dist = distance
-                gcal = names[idx]
+                gcal = info.names[idx]
+    elif mode == 'nearest' and len(calibrators):
+        tdirs = info.reference_dirs[[info.index(target) for target in targets]]
+        mean_ra, mean_dec = tdirs.mean(axis=0)
+
+        # The first of the nearest calibrators
+        idxs = [info.index(field) for field in calibrators]
+        cdirs = info.reference_dirs[idxs]
+        distance = angular_dist_pos_angle(mean_ra, mean_dec, cdirs[:, 0], cdirs[:, 1])[0]
+        gcal = info.names[idxs[numpy.argmin(distance)]]
 
     return gcal
 
@@ -134,53 +209,22 @@ def observed_longest(info, bpcals):
     """
       Automatically select bandpass calibrator
     """
-    if isinstance(info, str):
-        with open(info, 'r') as f:
-            info = ruamel.yaml.load(f, ruamel.yaml.RoundTripLoader)
-
-    names = info['FIELD']['NAME']
-    ids = info['FIELD']['SOURCE_ID']
-    dirs = info['FIELD']['REFERENCE_DIR']
-
-    def index(field):
-        if isinstance(field, str):
-            idx = names.index(field)
-        elif isinstance(field, int):
-            idx = ids.index(field)
-        return idx
+    info = MSInfo.from_info(info)
 
     most_time = 0
     field = None
     for bpcal in bpcals:
-        idx = index(bpcal)
-        bpcal = str(ids[idx])
-        total_time = numpy.sum(list(info['SCAN'][bpcal].values()))
+        idx = info.index(bpcal)
+        total_time = info.observation_length(bpcal)
         if total_time > most_time:
             most_time = total_time
-            field = names[idx]
+            field = info.names[idx]
 
     return field
 
 
 def field_observation_length(info, field):
-    if isinstance(info, str):
-        with open(info, 'r') as f:
-            info = ruamel.yaml.load(f, ruamel.yaml.RoundTripLoader)
-
-    names = info['FIELD']['NAME']
-    ids = info['FIELD']['SOURCE_ID']
-
-    def index(field):
-        if isinstance(field, str):
-            idx = names.index(field)
-        elif isinstance(field, int):
-            idx = ids.index(field)
-        else:
-            raise ValueError("Field cannot be a {0:s}".format(type(field)))
-        return idx
-    field = str(ids[index(field)])
-
-    return numpy.sum(list(info['SCAN'][field].values()))
+    return MSInfo.from_info(info).observation_length(field)
 
 
 def closeby(radec_1, radec_2, tol=2.9E-3):
@@ -209,22 +253,13 @@ def hetfield(info, field, db, tol=2.9E-3):
     db (dict):   calibrator data base as returned by
                  calibrator_database()
 
-    Go through all calibrators in db and return the first that matches
-    the coordinates of field in msinfo. Return empty string if not
-    found.
+    Return the first calibrator in db within an angular distance tol
+    (rad) of the delay direction of field in msinfo. Return False if
+    not found.
     """
 
-    # Get position of field in msinfo
-    ind = info['FIELD']['NAME'].index(field)
-    firade = info['FIELD']['DELAY_DIR'][ind][0]
-    firade[0] = numpy.mod(firade[0], 2 * numpy.pi)
-
-    dbcp = db.db
-    for key in dbcp.keys():
-        carade = [dbcp[key]['ra'], dbcp[key]['decl']]
-        if closeby(carade, firade, tol=tol):
-            return key
-    return False
+    info = MSInfo.from_info(info)
+    return info.calibrator_matches(db, tol)[info.index(field)] or False
 
 
 def find_in_native_calibrators(info, field, mode='both'):
@@ -233,9 +268,7 @@ def find_in_native_calibrators(info, field, mode='both'):
        Return a crystalball model if specified and available.
        Otherwise, return False.
     """
-    if isinstance(info, str):
-        with open(info, 'r') as f:
-            info = ruamel.yaml.load(f, ruamel.yaml.RoundTripLoader)
+    info = MSInfo.from_info(info)
 
     returnsky = False
     returnmod = False
@@ -287,9 +320,7 @@ def find_in_casa_calibrators(info, field):
        Return model if it is. Else, return False.
     """
 
-    if isinstance(info, str):
-        with open(info, 'r') as f:
-            info = ruamel.yaml.load(f, ruamel.yaml.RoundTripLoader)
+    info = MSInfo.from_info(info)
 
     with open(caracal.pckgdir + '/data/casa_calibrators.yml') as stdrb:
         db = yaml.safe_load(stdrb)
@@ -332,8 +363,7 @@ def estimate_solints(msinfo, skymodel, Tsys_eta, dish_diameter, npol, gain_tol=0
         flux += model['Total_flux'].sum()
 
     # Get number of antennas
-    with open(msinfo, 'r') as f:
-        info = ruamel.yaml.load(f, ruamel.yaml.RoundTripLoader)
+    info = MSInfo.from_info(msinfo)
     nant = len(info['ANT']['NAME'])
 
     # Get time and frequency resoltion of data
@@ -362,9 +392,7 @@ def estimate_solints(msinfo, skymodel, Tsys_eta, dish_diameter, npol, gain_tol=0
 
 
 def imaging_params(info, spwid=0):
-    if isinstance(info, str):
-        with open(info, 'r') as f:
-            info = ruamel.yaml.load(f, ruamel.yaml.RoundTripLoader)
+    info = MSInfo.from_info(info)
 
     maxbl = info['MAXBL']
     dish_size = numpy.mean(info['ANTENNA']['DISH_DIAMETER'])
@@ -0,0 +1,121 @@
+import os
+import itertools
+import threading
+from caracal import log
+from stimela import utils as stimela_utils
+from stimela.cargo import cab
+
+# container backends that can run steps in a running container
+BACKENDS = ("docker", "podman", "singularity")
+# podman does not take these container options on all setups (as in stimela.podman)
+PODMAN_SKIP_ARGS = ("--memory", "--cpus", "--user")
+
+
+class WarmContainers(object):
+    """
+    Pool of running containers, to run successive Stimela steps in, instead of starting a
+    new container for every step.
+
+    Stimela mounts the parameter file of a step into its container. The containers of the
+    pool mount the directory of the parameter files instead, and each step is run with
+    its own file (the CONFIG variable of the cab runscript). Steps with the same image,
+    mounts, environment and container options thus share a container, and are run in it
+    by "docker exec" or "podman exec", or in a singularity instance. Steps of other
+    backends (e.g. Python function steps) are run as usual.
+
+    Containers are started on first use, and stopped by close(). A step that times out
+    stops the container it runs in (and any other step running in it).
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.containers = {}
+        self.lock = threading.Lock()
+        self._names = itertools.count()
+
+    def supports(self, job):
+        """Whether a Stimela job can be run in a pool container"""
+        return job.jtype == self.backend and self.backend in BACKENDS and hasattr(job.job, "_cab")
+
+    def _config_mount(self, cont):
+        """Returns the pool container mounts of a job container, and the in-container path of its parameter file"""
+        configs = f"{cab.MOUNT}/configs"
+        volumes = [volume for volume in cont.volumes if volume.split(":")[1] != f"{cab.MOUNT}/configfile"]
+        volumes.append(":".join([os.path.abspath(os.path.dirname(cont.parameter_file_name)), configs, "ro"]))
+        return volumes, f"{configs}/{os.path.basename(cont.parameter_file_name)}"
+
+    def _args(self, job):
+        if self.backend == "podman":
+            return [arg for arg in job.args if not arg.startswith(PODMAN_SKIP_ARGS)]
+        return list(job.args)
+
+    def _start(self, job, volumes, environs):
+        """Starts a pool container for a job, and returns its name"""
+        cont = job.job
+        name = f"caracal-{os.getpid()}-{next(self._names)}"
+        if self.backend == "singularity":
+            from stimela import singularity
+            extras = "--userns" if singularity.BINARY_NAME == "singularity" else "--writable-tmpfs"
+            stimela_utils.xrun(f"{singularity.BINARY} instance start --workdir {cont.execdir} --containall {extras}",
+                               [" --bind " + " --bind ".join(volumes), cont.image, name],
+                               log=cont.logger, env=cont._env)
+        else:
+            stimela_utils.xrun(f"{self.backend} run", self._args(job) +
+                               ["-d", "--rm", " -v " + " -v ".join(volumes)] +
+                               ([" -e " + " -e ".join(environs)] if environs else []) +
+                               ([f"-w {cont.WORKDIR}"] if cont.WORKDIR else []) +
+                               ["--name", name, "--entrypoint", "sleep", cont.image, "infinity"],
+                               log=cont.logger)
+        return name
+
+    def _stop(self, name):
+        if self.backend == "singularity":
+            from stimela import singularity
+            stimela_utils.xrun(f"{singularity.BINARY} instance stop", [name])
+        else:
+            stimela_utils.xrun(f"{self.backend} rm", ["-f", name])
+
+    def run_job(self, job):
+        """Runs a Stimela job (see StimelaJob.run_job) in a pool container"""
+        job.declare_status = None
+        cont = job.job
+        cont._cab.update(cont.config, cont.parameter_file_name, tag=job.tag)
+        volumes, config = self._config_mount(cont)
+        environs = [environ for environ in cont.environs if not environ.startswith("CONFIG=")]
+        key = (cont.image, cont.WORKDIR, getattr(cont, "execdir", None), tuple(self._args(job)),
+               tuple(volumes), tuple(environs))
+        with self.lock:
+            name = self.containers.get(key)
+            if name is None:
+                name = self.containers[key] = self._start(job, volumes, environs)
+                log.info(f"Started container [{name}] for {cont.image}, to run this and later steps in")
+
+        def kill():
+            with self.lock:
+                if self.containers.get(key) == name:
+                    del self.containers[key]
+            self._stop(name)
+
+        job.created = True
+        if self.backend == "singularity":
+            from stimela import singularity
+            env = dict(cont._env, **{f"{singularity.BINARY_NAME.upper()}ENV_CONFIG": config})
+            stimela_utils.xrun(f"{singularity.BINARY} exec", [f"instance://{name}", cont.RUNSCRIPT],
+                               log=cont.logger, logfile=cont.logfile, env=env, timeout=cont.time_out,
+                               output_wrangler=job.apply_output_wranglers, kill_callback=kill)
+        else:
+            stimela_utils.xrun(f"{self.backend} exec", [f"-e CONFIG={config}", name, cont.RUNSCRIPT],
+                               log=cont.logger, logfile=cont.logfile, timeout=cont.time_out,
+                               output_wrangler=job.apply_output_wranglers, kill_callback=kill)
+        return 0
+
+    def close(self):
+        """Stops all pool containers"""
+        with self.lock:
+            names, self.containers = list(self.containers.values()), {}
+        for name in names:
+            try:
+                self._stop(name)
+            except Exception as exc:
+                # not fatal, the container will be left running
+                log.warning(f"Could not stop container {name}: {exc}")
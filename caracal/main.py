@@ -178,7 +178,8 @@ def execute_pipeline(options, config, block):
                                            add_all_first=False, prefix=options.general_prefix,
                                            configFileName=options.config, singularity_image_dir=options.singularity_image_dir,
                                            container_tech=backend, start_worker=options.start_worker,
-                                           end_worker=options.end_worker, generate_reports=not options.no_reports)
+                                           end_worker=options.end_worker, generate_reports=not options.no_reports,
+                                           resume=options.resume)
 
             if options.report:
                 pipeline.regenerate_reports()
@@ -0,0 +1,41 @@
+import json
+
+import numpy as np
+import pytest
+
+
+def make_summary(nfield=80, nchan=100, seed=2):
+    """Summary dict of a synthetic MS, in the format written by the obsconf worker"""
+    rng = np.random.default_rng(seed)
+    ra = rng.uniform(0, 2 * np.pi, nfield)
+    dec = rng.uniform(-np.pi / 2, np.pi / 3, nfield)
+    dirs = [[[float(r), float(d)]] for r, d in zip(ra, dec)]
+    intents = ["CALIBRATE_FLUX,CALIBRATE_BANDPASS", "CALIBRATE_AMPL,CALIBRATE_PHASE", "TARGET"]
+    return {
+        "FIELD": {
+            "NAME": [f"F{i:03d}" for i in range(nfield)],
+            "SOURCE_ID": list(range(nfield)),
+            "REFERENCE_DIR": dirs,
+            "DELAY_DIR": dirs,
+            "INTENTS": intents,
+            "STATE_ID": [min(i, 2) for i in range(nfield)],
+        },
+        "SCAN": {str(i): {"1": 120.0 + i, "2": 60.0} for i in range(nfield)},
+        "SPW": {
+            "NUM_CHAN": [nchan],
+            "CHAN_FREQ": [list(1.4e9 + 2.e5 * np.arange(nchan))],
+            "MEAS_FREQ_REF": 5,
+        },
+        "CORR": {"CORR_TYPE": [9, 12]},
+    }
+
+
+@pytest.fixture
+def summary_file(tmp_path):
+    """Factory writing a synthetic MS summary file, returns its path"""
+    def write(name="obs-summary.json", **kwargs):
+        path = tmp_path / name
+        with open(path, "w") as f:
+            json.dump(make_summary(**kwargs), f)
+        return str(path)
+    return write
@@ -0,0 +1,127 @@
+import json
+import os
+from collections import OrderedDict
+
+import numpy as np
+import pytest
+import stimela.recipe
+
+import caracal
+from caracal.dispatch_crew import config_parser
+from caracal.workers.worker_administrator import WorkerAdministrator
+
+CONFIG = """
+schema_version: 1.1.1
+general:
+  prefix: test
+  msdir: msdir
+  input: input
+  output: output
+getdata:
+  dataid: [obs1]
+obsconf:
+  obsinfo:
+    enable: false
+  refant: '0'
+"""
+
+
+def assert_same(value, expected):
+    """Checks that two pipeline state values are equal and of the same types, all the way down"""
+    assert type(value) is type(expected)
+    if isinstance(expected, np.ndarray):
+        assert value.dtype == expected.dtype
+        np.testing.assert_array_equal(value, expected)
+    elif isinstance(expected, dict):
+        assert list(value) == list(expected)
+        for key in expected:
+            assert_same(value[key], expected[key])
+    elif isinstance(expected, (list, tuple)):
+        assert len(value) == len(expected)
+        for item, expected_item in zip(value, expected):
+            assert_same(item, expected_item)
+    else:
+        assert value == expected
+
+
+@pytest.fixture
+def pipeline(tmp_path, monkeypatch, summary_file):
+    """Factory of pipelines configured for a synthetic MS, that run up to the obsconf worker"""
+    monkeypatch.chdir(tmp_path)
+    # Stimela work directories go to the current directory at import
+    monkeypatch.setattr(stimela.recipe, 'CDIR', str(tmp_path))
+    for subdir in ("msdir/obs1.ms", "input", "output"):
+        os.makedirs(subdir)
+    summary_file("msdir/obs1-summary.json", nfield=3)
+    with open("msdir/obs1-obsinfo.txt", "w") as f:
+        f.write("   Observed from   01-Jan-2020/10:00:00.0   to   01-Jan-2020/12:00:00.0 (UTC)\n")
+    with open("config.yml", "w") as f:
+        f.write(CONFIG)
+
+    def make(resume=False):
+        parser = config_parser.config_parser()
+        config, _ = parser.validate_config("config.yml")
+        parser.populate_parser(config)
+        _, config = parser.update_config_from_args(config, [])
+        return WorkerAdministrator(config, os.path.join(caracal.pckgdir, "workers"), configFileName="config.yml",
+                                   end_worker="obsconf", generate_reports=False, resume=resume)
+    return make
+
+
+@pytest.mark.parametrize("value", [
+    None, True, 3, 1.5, "a",
+    [1, "a", [2.5]],
+    np.arange(6, dtype=np.int32).reshape((2, 3)),
+    np.float32(1.5),
+    np.array(["a", "bc"]),
+    (1, (2, "a")),
+    {1, 2},
+    {1: "a", 2: (3, 4)},
+    {"__tuple__": 1, "a": [np.int64(2)]},
+    OrderedDict([("a", 1), ("b", [2])]),
+])
+def test_encode_decode_round_trip(value):
+    encoded = json.loads(json.dumps(WorkerAdministrator.encode_state(value)))
+    decoded = WorkerAdministrator.decode_state(encoded)
+    # OrderedDicts come back as dicts, in the same order
+    assert_same(decoded, dict(value) if isinstance(value, OrderedDict) else value)
+
+
+def test_encode_unsupported_type():
+    with pytest.raises(TypeError):
+        WorkerAdministrator.encode_state(object())
+
+
+def test_resume_restores_obsconf_state(pipeline):
+    first = pipeline()
+    first.run_workers()
+    state = first.pipeline_state()
+    assert [entry["worker"] for entry in first.load_checkpoint()] == ["getdata", "obsconf"]
+    assert state["fcal"] == [["F000"]] and state["target_id"] == [[2]] and state["nchans"] == [[100]]
+    # run settings are saved only once changed
+    assert "msdir" not in state and "virtconcat" not in state and "flags" not in state
+
+    # resuming runs no workers, and gives the state after obsconf
+    resumed = pipeline(resume=True)
+    resumed.run_workers()
+    assert [entry["worker"] for entry in resumed.checkpoint] == ["getdata", "obsconf"]
+    for key in state:
+        assert_same(getattr(resumed, key), getattr(first, key))
+    assert resumed.pipeline_state() == state
+
+
+def test_changed_settings_and_types_are_restored(pipeline):
+    first = pipeline()
+    first.run_workers()
+    first.virtconcat = True
+    first.flags["obsconf"] = ["obsconf_flags"]
+    first.fcal_ra = [np.array([94.18])]
+    first.chanwidth = [(2.e5, np.float32(1.e5))]
+    first.scans = {1: {2, 3}}
+    state = json.loads(json.dumps(first.pipeline_state()))
+    assert {"virtconcat", "flags", "fcal_ra", "chanwidth", "scans"} <= set(state)
+
+    second = pipeline()
+    second.restore_state(state)
+    for key in state:
+        assert_same(getattr(second, key), getattr(first, key))
@@ -0,0 +1,200 @@
+import numpy as np
+import pytest
+
+from caracal.utils.benchmark import make_flag_table
+from caracal.workers.utils.flag_Uzeros import UzeroFlagger
+
+
+def _reference_rows(uv, U, V, cellSize, dilateU, dilateV):
+    """Rows selected by the old range tests, cell by cell"""
+    rowSel = np.zeros(uv.shape[0], dtype=bool)
+    for u, v in zip(U, V):
+        inU = (uv[:, 0] > u - (1 / 2 + dilateU) * cellSize) & (uv[:, 0] <= u + (1 / 2 + dilateU) * cellSize)
+        inV = (uv[:, 1] > v - (1 / 2 + dilateV) * cellSize) & (uv[:, 1] <= v + (1 / 2 + dilateV) * cellSize)
+        rowSel |= inU & inV
+    return rowSel
+
+
+@pytest.mark.parametrize("dilateU, dilateV", [(0, 0), (1, 1), (2, 0), (0, 3)])
+@pytest.mark.parametrize("offset", [0., 3.7])
+def test_match_cells(dilateU, dilateV, offset):
+    cellSize = 10.
+    table, header = make_flag_table(60, cell=cellSize, uvmax=2e3)
+    U, V = np.asarray(table['u']) + offset, np.asarray(table['v']) - offset
+    rng = np.random.default_rng(3)
+    # rows around the cells, and all over the UV plane
+    near = np.repeat(np.stack([U, V], axis=1), 20, axis=0) + rng.uniform(-4 * cellSize, 4 * cellSize, (20 * len(U), 2))
+    uv = np.concatenate([near, rng.uniform(-2.5e3, 2.5e3, (5000, 2))])
+
+    flagger = UzeroFlagger({'flag_u_zeros': {}})
+    rowSel = flagger.matchCells(uv, U, V, header['CDELT2'], dilateU, dilateV)
+    expected = _reference_rows(uv, U, V, header['CDELT2'], dilateU, dilateV)
+    assert expected.any() and not expected.all()
+    np.testing.assert_array_equal(rowSel, expected)
+
+
+def test_match_no_cells():
+    flagger = UzeroFlagger({'flag_u_zeros': {}})
+    assert not flagger.matchCells(np.ones((5, 2)), [], [], 10., 1, 1).any()
+
+
+def test_scan_ranges():
+    """Rows and time steps of each scan, as selected by splitting the scans off the MS"""
+    rng = np.random.default_rng(5)
+    # 4 scans of 6 time stamps of 10 baselines, not in row order
+    scans = np.repeat([3, 5, 8, 9], 60)
+    timestamps = 5e9 + 8. * np.repeat(np.arange(24), 10)
+    order = rng.permutation(scans.size)
+    scans, timestamps = scans[order], timestamps[order]
+
+    flagger = UzeroFlagger({'flag_u_zeros': {}})
+    scanNums, scanRows, scanIntervals = flagger.scanRanges(scans, timestamps)
+    np.testing.assert_array_equal(scanNums, [3, 5, 8, 9])
+    timeSteps = np.unique(timestamps, return_inverse=True)[1]
+    for scan, rows, (start, end) in zip(scanNums, scanRows, scanIntervals):
+        # the rows of mstransform scan=<scan>, in MS order
+        np.testing.assert_array_equal(rows, np.where(scans == scan)[0])
+        # wsclean -interval start end selects the time steps of the scan only
+        np.testing.assert_array_equal(np.where((timeSteps >= start) & (timeSteps < end))[0], rows)
+
+
+@pytest.fixture
+def vis_ms(tmp_path):
+    """An MS of random visibilities and weights, with the uv points of the first channel on grid cell centres"""
+    tables = pytest.importorskip("casacore.tables")
+    from caracal.utils.benchmark import make_ms
+    ms = make_ms(str(tmp_path / "obs.ms"), nant=12, ntime=48, nchan=4, ncorr=2)
+    rng = np.random.default_rng(7)
+    t = tables.table(ms, readonly=False, ack=False)
+    nrow = t.nrows()
+    t.addcols(tables.makearrcoldesc('DATA', 0j, ndim=2, shape=[4, 2]))
+    t.putcol('DATA', rng.normal(size=(nrow, 4, 2)) + 1j * rng.normal(size=(nrow, 4, 2)))
+    t.putcol('WEIGHT', rng.uniform(0.5, 2., (nrow, 2)))
+    # cells of 1 / (32 * 20 arcsec) wavelengths at 1.3 GHz
+    duv = 1. / (32 * np.deg2rad(20. / 3600.)) * 299792458. / 1.3e9
+    t.putcol('UVW', np.concatenate([duv * rng.integers(-12, 13, (nrow, 2)), np.zeros((nrow, 1))], axis=1))
+    t.close()
+    field = tables.table(ms + '/FIELD', readonly=False, ack=False)
+    field.putcell('PHASE_DIR', 0, np.deg2rad([[-30., -45.]]))
+    field.close()
+    return ms
+
+
+def _reference_image(ms, imsize, cell):
+    """Dirty image with natural weights, as the direct Fourier sum of the Stokes-I visibilities of the first channel"""
+    import casacore.tables as tables
+    t = tables.table(ms, ack=False)
+    uvw = t.getcol('UVW') * 1.3e9 / 299792458.
+    vis = t.getcol('DATA')[:, 0].mean(axis=1)
+    weight = 4. / (1. / t.getcol('WEIGHT')).sum(axis=1) * ~t.getcol('FLAG')[:, 0].any(axis=1)
+    t.close()
+    # RA increases to the left
+    offset = (np.arange(imsize) - imsize // 2) * np.deg2rad(cell / 3600.)
+    phase = np.exp(2j * np.pi * (-uvw[:, 0, None, None] * offset[None, None, :] + uvw[:, 1, None, None] * offset[None, :, None]))
+    return (weight[:, None, None] * vis[:, None, None] * phase).real.sum(axis=0) / weight.sum()
+
+
+@pytest.mark.parametrize("chunkSize", [1, 100 * 2 * 16, 2**27])
+def test_dirty_image(vis_ms, chunkSize):
+    flagger = UzeroFlagger({'flag_u_zeros': {'imsize': 32, 'cell': 20., 'chans': [0, 1], 'robust': 10., 'taper': None}})
+    gridded = flagger.gridVis(vis_ms, chunkSize=chunkSize)
+    dirty, header = flagger.dirtyImage(*gridded)
+    # DATA and WEIGHT are single precision
+    np.testing.assert_allclose(dirty, _reference_image(vis_ms, 32, 20.), rtol=0, atol=1e-7)
+    assert (header['CRVAL1'], header['CRVAL2'], header['CDELT1'], header['CRPIX1']) == (330., -45., -20. / 3600., 17)
+
+
+def test_sweep_thresholds(vis_ms, monkeypatch):
+    """The sweep selects the threshold, and estimates its noise, as flagging and imaging the scan once per threshold"""
+    import casacore.tables as tables
+    thresholds = [3., 100., 2., 5.]
+    flagger = UzeroFlagger({'flag_u_zeros': {'imsize': 32, 'cell': 20., 'chans': [0, 4], 'robust': 0., 'taper': None,
+                                             'make_plots': False}})
+    t = tables.table(vis_ms, ack=False)
+    rows = np.where(t.getcol('SCAN_NUMBER') == 2)[0]
+    t.close()
+    inFFT, inFFTHeader = flagger.imageFFT(*flagger.gridImage(vis_ms, rows))
+    U = (np.arange(1, 33) - inFFTHeader['CRPIX1']) * inFFTHeader['CDELT1'] + inFFTHeader['CRVAL1']
+    V = (np.arange(1, 33) - inFFTHeader['CRPIX2'] - 1) * inFFTHeader['CDELT2'] + inFFTHeader['CRVAL2']
+    args = (inFFT, inFFTHeader, vis_ms, np.flip(U), V, 'gal', 'ms', 'track', 2)
+
+    # the old loop: flag the scan for each threshold, image it, and rewind its flags
+    scanFlags = flagger.getScanFlags(vis_ms, rows)
+    expected, cutoffs = [], []
+    for threshold in thresholds:
+        cutoffs.append(flagger.saveFFTTable(*args, 0, 0, 'madThreshold', threshold, 1, 1, False, rows=rows)[3])
+        expected.append(np.std(flagger.gridImage(vis_ms, rows)[0]))
+        flagger.putScanFlags(vis_ms, rows, scanFlags)
+    assert len(set(expected)) == len(thresholds)
+
+    dirtyImage = flagger.dirtyImage
+    rms = []
+
+    def recording_dirtyImage(*imageArgs):
+        dirty, header = dirtyImage(*imageArgs)
+        rms.append(np.std(dirty))
+        return dirty, header
+    monkeypatch.setattr(flagger, 'dirtyImage', recording_dirtyImage)
+    threshold, cutoff = flagger.sweepThresholds(*args, 'madThreshold', thresholds, 1, 1, False, rows=rows)
+    np.testing.assert_allclose(rms, expected, rtol=1e-6)
+    best = int(np.argmin(expected))
+    assert threshold == thresholds[best] and cutoff == pytest.approx(cutoffs[best])
+    # nothing is flagged in the sweep
+    np.testing.assert_array_equal(flagger.getScanFlags(vis_ms, rows), scanFlags)
+
+
+@pytest.mark.parametrize("prefetch", [False, True])
+@pytest.mark.parametrize("chunkSize", [1, 16 * 2 * 7, 16 * 2 * 60, 2**27])
+@pytest.mark.parametrize("scan", [None, 3])
+def test_chunk_flags(tmp_path, chunkSize, prefetch, scan):
+    """Flags updated in chunks of 1, 7 (not dividing the rows), 60 and all rows are those updated at once"""
+    tables = pytest.importorskip("casacore.tables")
+    from caracal.utils.benchmark import make_ms
+    ms = make_ms(str(tmp_path / "obs.ms"), nant=6, ntime=10, nchan=16, ncorr=2)
+    t = tables.table(ms, readonly=False, ack=False)
+    rows = np.where(t.getcol('SCAN_NUMBER') == scan)[0] if scan else np.arange(t.nrows())
+    before = t.getcol('FLAG')
+    rowSel = np.random.default_rng(1).random(rows.size) < 0.3
+
+    def update(startRow, flags):
+        flags |= rowSel[startRow:startRow + flags.shape[0], None, None]
+        flags[:, 3] = True
+
+    flagger = UzeroFlagger({'flag_u_zeros': {}})
+    tSel = t.selectrows(rows) if scan else t
+    counts = flagger.chunkFlags(tSel, update, chunkSize=chunkSize, prefetch=prefetch)
+    if scan:
+        tSel.close()
+    after = t.getcol('FLAG')
+    t.close()
+
+    expected = before.copy()
+    expected[rows] |= rowSel[:, None, None]
+    expected[rows, 3] = True
+    np.testing.assert_array_equal(after, expected)
+    assert counts == (np.count_nonzero(before[rows]), np.count_nonzero(expected[rows]), before[rows].size)
+    # without update, the flags are counted only
+    t = tables.table(ms, ack=False)
+    assert flagger.chunkFlags(t, chunkSize=chunkSize, prefetch=prefetch) == (np.count_nonzero(expected),) * 2 + (expected.size,)
+    t.close()
+
+
+def test_scan_flags_round_trip(tmp_path):
+    tables = pytest.importorskip("casacore.tables")
+    from caracal.utils.benchmark import make_ms
+    ms = make_ms(str(tmp_path / "obs.ms"), nant=6, ntime=10, nchan=16, ncorr=2)
+    t = tables.table(ms, ack=False)
+    before = t.getcol('FLAG')
+    t.close()
+    rows = np.arange(5, before.shape[0], 7)
+
+    flagger = UzeroFlagger({'flag_u_zeros': {}})
+    np.testing.assert_array_equal(flagger.getScanFlags(ms, rows), before[rows])
+    flagger.putScanFlags(ms, rows, ~before[rows])
+    expected = before.copy()
+    expected[rows] = ~before[rows]
+    t = tables.table(ms, ack=False)
+    np.testing.assert_array_equal(t.getcol('FLAG'), expected)
+    t.close()
+    flagger.putScanFlags(ms, rows, before[rows])
+    np.testing.assert_array_equal(flagger.getScanFlags(ms, np.arange(before.shape[0])), before)
@@ -0,0 +1,231 @@
+import numpy as np
+import pytest
+
+from caracal.utils.benchmark import make_cube, make_line_mask
+from caracal.workers.utils.image_contsub import _polyfit_masked, _running_median, _tiles, imcontsub
+
+
+def _cube(shape=(40, 6, 5), seed=1):
+    rng = np.random.default_rng(seed)
+    return rng.normal(size=shape).astype(np.float32), rng.random(shape) < 0.2
+
+
+def _reference_median(data, mask, length):
+    """Per-voxel nanmedian of the mirrored window, as in the old loop"""
+    nchan = data.shape[0]
+    before = length // 2
+    spectra = np.where(mask, np.nan, data).reshape((nchan, -1)).astype(float)
+    padded = np.pad(spectra, ((before, length - 1 - before), (0, 0)), mode='symmetric')
+    median = np.full(spectra.shape, np.nan)
+    for chan in range(nchan):
+        window = padded[chan:chan + length]
+        valid = ~np.isnan(window).all(axis=0)
+        median[chan, valid] = np.nanmedian(window[:, valid], axis=0)
+    return median.reshape(data.shape)
+
+
+@pytest.mark.parametrize("length", [1, 4, 7, 31])
+@pytest.mark.parametrize("blocksize", [1, 50, 2**24])
+def test_running_median_masked(length, blocksize):
+    data, mask = _cube()
+    mask[:, 0, 0] = True  # a fully masked spectrum gives NaN
+    result = _running_median(data, mask, length, blocksize=blocksize)
+    np.testing.assert_allclose(result, _reference_median(data, mask, length), rtol=1e-6)
+    assert np.isnan(result[:, 0, 0]).all()
+
+
+def test_running_median_matches_median_filter():
+    ndimage = pytest.importorskip("scipy.ndimage")
+    data, _ = _cube()
+    np.testing.assert_allclose(_running_median(data, None, 9, blocksize=100),
+                               ndimage.median_filter(data, (9, 1, 1)), rtol=1e-6)
+
+
+def test_running_median_blocksize_bounds_windows(monkeypatch):
+    """Blocks are split along pixels too, when one channel of windows exceeds blocksize"""
+    data, mask = _cube((20, 10, 10))
+    sizes = []
+    sort = np.sort
+
+    def recording_sort(array, *args, **kwargs):
+        sizes.append(array.size)
+        return sort(array, *args, **kwargs)
+
+    monkeypatch.setattr(np, "sort", recording_sort)
+    result = _running_median(data, mask, 11, blocksize=11 * 30)
+    monkeypatch.undo()
+    assert max(sizes) <= 11 * 30
+    np.testing.assert_allclose(result, _reference_median(data, mask, 11), rtol=1e-6)
+
+
+@pytest.mark.parametrize("polyorder", [0, 1, 3])
+def test_polyfit_masked(polyorder):
+    data, mask = _cube()
+    mask[polyorder:, 1, 1] = True  # too few channels for the fit, gives 0
+    fit = _polyfit_masked(data, mask, polyorder)
+
+    nchan = data.shape[0]
+    x = np.linspace(-1., 1., nchan)
+    spectra, masks = data.reshape((nchan, -1)), mask.reshape((nchan, -1))
+    expected = np.zeros(spectra.shape)
+    for pix in range(spectra.shape[1]):
+        use = ~masks[:, pix]
+        if use.sum() >= polyorder + 1:
+            coefficients = np.polynomial.polynomial.polyfit(x[use], spectra[use, pix], polyorder)
+            expected[:, pix] = np.polynomial.polynomial.polyval(x, coefficients)
+    np.testing.assert_allclose(fit, expected.reshape(data.shape), rtol=1e-6, atol=1e-6)
+    assert not fit[:, 1, 1].any()
+
+
+@pytest.mark.parametrize("shape, tilemem, halo", [
+    ((2000, 4096, 4096), 512, 25),
+    ((2000, 4096, 4096), 256, 25),
+    ((2000, 4096, 4096), 64, 25),
+    ((30, 40, 50), 0.1, 0),
+    ((30, 40, 50), 0.01, 6),
+    ((30, 40, 50), 0, 6),
+])
+def test_tiles_cover_plane(shape, tilemem, halo):
+    tiles = _tiles(shape, tilemem, halo)
+    ny, nx = shape[1:]
+    # tiles are at least as large as their halo, unless cut by the edge of the plane
+    assert len(tiles) <= max(1, -(-ny // max(1, halo))) * max(1, -(-nx // max(1, halo)))
+    if ny * nx < 10**6:
+        covered = np.zeros((ny, nx), dtype=int)
+        for (y0, y1, x0, x1), (oy0, oy1, ox0, ox1) in tiles:
+            covered[y0:y1, x0:x1] += 1
+            assert (oy0, oy1, ox0, ox1) == (max(0, y0 - halo), min(ny, y1 + halo), max(0, x0 - halo), min(nx, x1 + halo))
+        assert (covered == 1).all()
+    for (y0, y1, x0, x1), _ in tiles:
+        assert y1 - y0 >= min(halo, ny - y0) and x1 - x0 >= min(halo, nx - x0)
+
+
+@pytest.fixture
+def cube(tmp_path):
+    """Synthetic cube and line mask, with some blanked voxels"""
+    fits = pytest.importorskip("astropy.io.fits")
+    cubename = make_cube(str(tmp_path / "cube.fits"), 24, 32)
+    maskname = make_line_mask(str(tmp_path / "mask.fits"), cubename)
+    with fits.open(cubename, mode="update") as hdul:
+        hdul[0].data[0, 3:5, 10, 10:14] = np.nan
+    return cubename, maskname
+
+
+def run_imcontsub(cube, name, **kwargs):
+    """Runs imcontsub on the cube, returns the data of its three products"""
+    fits = pytest.importorskip("astropy.io.fits")
+    cubename, maskname = cube
+    outputs = ["{}-{}.fits".format(cubename[:-5], product) for product in [name, name + "-fit", name + "-confit"]]
+    imcontsub(cubename, outputs[0], mask=maskname, fitted=outputs[1], confit=outputs[2], clobber=True, **kwargs)
+    return [fits.getdata(output) for output in outputs]
+
+
+FITS = {"poly": dict(fitmode="poly", polyorder=2),
+        "median": dict(fitmode="median", length=5),
+        "savgol": dict(fitmode="savgol", length=5, polyorder=1, sgiters=2)}
+
+
+@pytest.mark.parametrize("fit", sorted(FITS))
+@pytest.mark.parametrize("kersiz", [0, 3])
+@pytest.mark.parametrize("tilemem", [0.01, 0.5])
+def test_tiled_matches_in_memory(cube, fit, kersiz, tilemem):
+    pytest.importorskip("scipy")
+    expected = run_imcontsub(cube, "ref", kersiz=kersiz, **FITS[fit])
+    for result, reference in zip(run_imcontsub(cube, "tiled", kersiz=kersiz, tilemem=tilemem, **FITS[fit]), expected):
+        np.testing.assert_allclose(result, reference, rtol=1e-5, atol=1e-7)
+
+
+def test_tiles_fit_each_pixel_once(cube, monkeypatch):
+    pytest.importorskip("scipy")
+    from caracal.workers.utils import image_contsub
+
+    fitted = []
+    fit_cube = image_contsub._fit_cube
+
+    def recording_fit_cube(data, *args, **kwargs):
+        fitted.append(data.shape[1] * data.shape[2])
+        return fit_cube(data, *args, **kwargs)
+
+    monkeypatch.setattr(image_contsub, "_fit_cube", recording_fit_cube)
+    run_imcontsub(cube, "tiled", kersiz=3, tilemem=0.5, **FITS["poly"])
+    # the halos are convolved, but not fitted again
+    assert len(fitted) > 1 and sum(fitted) == 32 * 32
+
+
+@pytest.mark.parametrize("fit", sorted(FITS))
+@pytest.mark.parametrize("kersiz", [0, 3])
+@pytest.mark.parametrize("tilemem", [0, 0.5])
+def test_parallel_matches_serial(cube, fit, kersiz, tilemem):
+    pytest.importorskip("scipy")
+    expected = run_imcontsub(cube, "ref", kersiz=kersiz, **FITS[fit])
+    results = run_imcontsub(cube, "parallel", kersiz=kersiz, tilemem=tilemem, ncpu=3, **FITS[fit])
+    for result, reference in zip(results, expected):
+        np.testing.assert_allclose(result, reference, rtol=1e-5, atol=1e-7)
+
+
+def test_cube_writer(tmp_path):
+    fits = pytest.importorskip("astropy.io.fits")
+    from caracal.workers.utils.image_contsub import _CubeWriter
+
+    data, _ = _cube((8, 6, 5))
+    data[2, 1, 1] = np.nan
+    template = fits.HDUList([fits.PrimaryHDU(data[None].astype(np.float64)), fits.ImageHDU(np.ones(3), name="EXTRA")])
+    template[0].header["BSCALE"] = 1.
+    filename = str(tmp_path / "out.fits")
+    writer = _CubeWriter(filename, template)
+    for (y0, y1, x0, x1), _ in _tiles(data.shape, 0.0005):
+        writer.write(data[:, y0:y1, x0:x1], y0, y1, x0, x1)
+    writer.close()
+
+    with fits.open(filename) as hdul:
+        header = hdul[0].header
+        assert header["BITPIX"] == -32 and "BSCALE" not in header
+        np.testing.assert_array_equal(hdul[0].data[0], data)
+        assert header["DATAMIN"] == np.nanmin(data) and header["DATAMAX"] == np.nanmax(data)
+        assert hdul["EXTRA"].data.tolist() == [1., 1., 1.]
+    with pytest.raises(OSError):
+        _CubeWriter(filename, template)
+
+    # all blank, the range is left at 0
+    writer = _CubeWriter(filename, template, clobber=True)
+    writer.write(np.full(data.shape, np.nan, dtype=np.float32), 0, 6, 0, 5)
+    writer.close()
+    with fits.open(filename) as hdul:
+        assert hdul[0].header["DATAMIN"] == 0. and hdul[0].header["DATAMAX"] == 0.
+
+
+def test_output_data_range(cube):
+    fits = pytest.importorskip("astropy.io.fits")
+    pytest.importorskip("scipy")
+    cubename, _ = cube
+    run_imcontsub(cube, "range", tilemem=0.5, **FITS["median"])
+    for product in ["range", "range-fit", "range-confit"]:
+        with fits.open("{}-{}.fits".format(cubename[:-5], product)) as hdul:
+            data = hdul[0].data
+            assert hdul[0].header["DATAMIN"] == np.nanmin(data) and hdul[0].header["DATAMAX"] == np.nanmax(data)
+
+
+@pytest.mark.parametrize("kertyp, kersiz", [("gauss", 3), ("tophat", 2)])
+def test_convolve_cube(kertyp, kersiz):
+    signal = pytest.importorskip("scipy.signal")
+    from caracal.workers.utils.image_contsub import _convolve_cube, _make_kernel
+
+    kernel = _make_kernel(kertyp, kersiz)
+    halo = kernel.size // 2
+    data, _ = _cube((4, 30, 25))
+    data[1, 15, 12] = np.nan
+    kernel2d = np.outer(kernel, kernel)[None]
+
+    # normalised by the weights of the pixels that are not blank and inside the plane
+    weights = (~np.isnan(data)).astype(float)
+    expected = signal.convolve(np.nan_to_num(data), kernel2d, mode="same") / signal.convolve(weights, kernel2d, mode="same")
+    expected[np.isnan(data)] = np.nan
+    convolved = _convolve_cube(data.copy(), kernel)
+    np.testing.assert_allclose(convolved, expected, rtol=1e-5, atol=1e-7)
+
+    # away from the edges and blanks, the same as the old FFT convolution normalised by the kernel sum
+    old = signal.fftconvolve(np.nan_to_num(data), kernel2d, mode="same", axes=(1, 2)) / kernel2d.sum()
+    inside = (slice(None), slice(halo, -halo), slice(halo, -halo))
+    clean = np.ones(data.shape, dtype=bool)
+    clean[1, 15 - halo:15 + halo + 1, 12 - halo:12 + halo + 1] = False
+    np.testing.assert_allclose(convolved[inside][clean[inside]], old[inside][clean[inside]], rtol=1e-4, atol=1e-7)
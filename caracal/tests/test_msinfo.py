@@ -0,0 +1,67 @@
+import json
+import os
+
+import numpy as np
+import pytest
+import ruamel.yaml
+
+import caracal
+from caracal.dispatch_crew import utils
+from caracal.dispatch_crew.catalog_parser import catalog_parser
+
+
+def test_load_summary_keeps_lists(summary_file):
+    filename = summary_file(nfield=80, nchan=100)
+    info = utils.load_summary(filename)
+    with open(filename) as f:
+        assert info == ruamel.yaml.load(f, ruamel.yaml.RoundTripLoader)
+    # large numeric lists stay lists, whatever the number of fields or channels
+    for value in (info["FIELD"]["SOURCE_ID"], info["FIELD"]["REFERENCE_DIR"], info["SPW"]["CHAN_FREQ"][0]):
+        assert type(value) is list
+
+
+def test_msinfo_list_api_and_indexes(summary_file):
+    info = utils.MSInfo.load(summary_file(nfield=80))
+    fields = info["FIELD"]
+    assert type(fields["SOURCE_ID"]) is list
+    assert fields["SOURCE_ID"].index(42) == 42
+    assert fields["NAME"] + ["X"] == info.names + ["X"]
+    assert info.index("F010") == 10 and info.index(np.int64(11)) == 11
+    assert info.reference_dirs.shape == (80, 2)
+    np.testing.assert_array_equal(info.reference_dirs[:, 0], [d[0][0] for d in fields["REFERENCE_DIR"]])
+    assert info.observation_length("F003") == 183.0
+    assert utils.get_field_id(info, "F001,F002") == [1, 2]
+    assert utils.categorize_fields(info)["fcal"][1] == ["F000"]
+
+
+def _reference_matches(info, db, tol):
+    """First calibrator in database order close to each field, as found by the old per-field loop"""
+    matches = []
+    for firade in info.delay_dirs:
+        firade = [np.mod(firade[0], 2 * np.pi), firade[1]]
+        matches.append(next((name for name, src in db.db.items()
+                             if utils.closeby([src['ra'], src['decl']], firade, tol=tol)), None))
+    return matches
+
+
+def test_calibrator_matches(summary_file):
+    pytest.importorskip("scipy.spatial")
+    db = catalog_parser(os.path.join(caracal.pckgdir, "data/southern_calibrators.txt"), cache=False)
+    tol = 2.9E-3
+    rng = np.random.default_rng(4)
+    with open(summary_file(nfield=80)) as f:
+        summary = json.load(f)
+    # fields at calibrators (offset within the tolerance, and with RA wrapped around), and elsewhere
+    calibrators = list(db.db.values())[:20]
+    for i, src in enumerate(calibrators):
+        offset = rng.uniform(-0.3, 0.3, 2) * tol
+        ra = src['ra'] + offset[0] - (2 * np.pi if i % 2 else 0)
+        summary["FIELD"]["DELAY_DIR"][i] = [[ra, src['decl'] + offset[1]]]
+    info = utils.MSInfo(summary)
+
+    matches = info.calibrator_matches(db, tol)
+    expected = _reference_matches(info, db, tol)
+    assert matches == expected
+    assert None not in expected[:20] and expected[20:].count(None) > 50
+    assert info.calibrator_matches(db, tol) is matches
+    assert utils.hetfield(info, "F000", db, tol) == expected[0]
@@ -0,0 +1,81 @@
+import glob
+
+import numpy as np
+import pytest
+
+tables = pytest.importorskip("casacore.tables")
+
+from caracal.dispatch_crew import noisy  # noqa: E402
+from caracal.utils.benchmark import make_ms  # noqa: E402
+
+ARGS = (1380.6, 20., None, np.pi * 6.75**2)
+
+
+@pytest.fixture
+def ms(tmp_path):
+    return make_ms(str(tmp_path / "obs.ms"), nant=6, ntime=10, nchan=16, ncorr=4)
+
+
+def _reference_summary(ms):
+    """Unflagged integration per channel and total interval, reading the whole MS at once"""
+    t = tables.table(ms, ack=False)
+    cross = t.getcol('ANTENNA1') != t.getcol('ANTENNA2')
+    interval = t.getcol('INTERVAL')[cross]
+    flag = t.getcol('FLAG')[cross][:, :, :2]  # XX and YY
+    t.close()
+    return interval.dot(2 - flag.sum(axis=2)), interval.sum()
+
+
+@pytest.mark.parametrize("chunkSize", [1, 16 * 2 * 7, 2**27])
+def test_summary_in_chunks(ms, chunkSize):
+    summary = noisy.SummariseMS(ms, 'TARGET', chunkSize=chunkSize)
+    unflaggedIntegration, totalInterval = _reference_summary(ms)
+    np.testing.assert_allclose(summary['unflaggedIntegration'], unflaggedIntegration)
+    assert summary['totalInterval'] == pytest.approx(totalInterval)
+    assert summary['nrIntegration'] == 15 * 10 and summary['nrBaseline'] == 15 and summary['nrPol'] == 2
+
+
+def test_summary_cache(ms, monkeypatch):
+    result = noisy.ProcessSingleMS(ms, *ARGS, 'TARGET')
+    assert len(glob.glob(ms[:-3] + '-noise-*.npz')) == 1
+
+    # unchanged MS, the summary comes from the cache
+    summarise = noisy.SummariseMS
+    calls = []
+
+    def counting_summarise(*args, **kwargs):
+        calls.append(args)
+        return summarise(*args, **kwargs)
+    monkeypatch.setattr(noisy, 'SummariseMS', counting_summarise)
+    cached = noisy.ProcessSingleMS(ms, *ARGS, 'TARGET')
+    assert calls == []
+    for value, expected in zip(cached, result):
+        np.testing.assert_array_equal(value, expected)
+
+    # changing the flags invalidates the cache
+    t = tables.table(ms, readonly=False, ack=False)
+    t.putcol('FLAG', np.ones_like(t.getcol('FLAG')))
+    t.close()
+    flagged = noisy.ProcessSingleMS(ms, *ARGS, 'TARGET')
+    assert len(calls) == 1
+    assert not flagged[0].any() and result[0].all()
+    noisy.ProcessSingleMS(ms, *ARGS, 'TARGET')
+    assert len(calls) == 1
+
+    # each field selection has its own cache
+    noisy.ProcessSingleMS(ms, *ARGS, '')
+    assert len(calls) == 2
+    assert len(glob.glob(ms[:-3] + '-noise-*.npz')) == 2
+
+
+def test_no_summary_cache(ms):
+    noisy.ProcessSingleMS(ms, *ARGS, 'TARGET', cache=False)
+    assert not glob.glob(ms[:-3] + '-noise-*.npz')
+
+
+def test_corrupt_summary_cache(ms):
+    result = noisy.ProcessSingleMS(ms, *ARGS, 'TARGET')
+    cacheFile, _ = noisy.SummaryCache(ms, 'TARGET')
+    with open(cacheFile, 'wb') as f:
+        f.write(b'not a cache')
+    np.testing.assert_array_equal(noisy.ProcessSingleMS(ms, *ARGS, 'TARGET')[0], result[0])
@@ -0,0 +1,138 @@
+import json
+import threading
+import time
+
+import pytest
+import stimela.recipe
+from stimela.exceptions import PipelineException
+from stimela.utils import StimelaCabRuntimeError
+
+from caracal.workers.worker_administrator import ParallelMSRecipe, WorkerAdministrator
+
+ALL = WorkerAdministrator.ALL_RESOURCES
+
+
+def make_pipeline(max_parallel_ms=0):
+    pipeline = object.__new__(WorkerAdministrator)
+    pipeline.config = {'general': {'max_parallel_ms': max_parallel_ms, 'ms_ncpu': 0, 'ms_memory': 0}}
+    pipeline.msbasenames = ['obs1', 'obs2']
+    pipeline.prefix_msbases = ['pfx-obs1', 'pfx-obs2']
+    pipeline.ms_extension = 'ms'
+    pipeline.step_cache = None
+    pipeline.warm_containers = None
+    return pipeline
+
+
+class Events(object):
+    """Thread-safe record of the start and end of steps"""
+
+    def __init__(self):
+        self.events = []
+        self.lock = threading.Lock()
+
+    def add(self, *event):
+        with self.lock:
+            self.events.append(event)
+
+    def index(self, *event):
+        return self.events.index(event)
+
+
+# the parameters of Python steps go to the resume file, so the record of events is a global
+EVENTS = Events()
+
+
+def step(name, ms, delay=0.1, fail=False):
+    EVENTS.add('start', name)
+    time.sleep(delay)
+    if fail:
+        EVENTS.add('fail', name)
+        raise StimelaCabRuntimeError(f"{name} failed")
+    EVENTS.add('end', name)
+
+
+@pytest.fixture
+def events():
+    EVENTS.events.clear()
+    return EVENTS
+
+
+@pytest.fixture
+def recipe(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    # Stimela work directories go to the current directory at import
+    monkeypatch.setattr(stimela.recipe, 'CDIR', str(tmp_path))
+
+    def make(max_parallel_ms=0):
+        recipe = ParallelMSRecipe('test', ms_dir=str(tmp_path), log_dir=str(tmp_path), logfile=False)
+        recipe.pipeline = make_pipeline(max_parallel_ms)
+        return recipe
+    return make
+
+
+def add_step(recipe, name, ms, **kwargs):
+    recipe.add(step, name, dict(name=name, ms=ms, **kwargs), label=name)
+
+
+@pytest.mark.parametrize("resources, other, conflict", [
+    ((set(), {'obs0'}), (set(), {'obs1'}), False),
+    ((set(), {'obs0'}), (set(), {'obs0'}), True),
+    (({'obs0', 'a.ms'}, set()), ({'obs0', 'a.ms'}, set()), False),
+    (({'obs0', 'a.ms'}, set()), ({'obs0'}, {'a.ms'}), True),
+    ((set(), {ALL}), (set(), set()), True),
+    ((set(), set()), ({'obs1'}, {ALL}), True),
+])
+def test_conflict(resources, other, conflict):
+    assert ParallelMSRecipe._conflict(resources, other) is conflict
+    assert ParallelMSRecipe._conflict(other, resources) is conflict
+
+
+def test_steps_follow_dependencies(recipe, events):
+    recipe = recipe()
+    add_step(recipe, 'a1', 'obs1.ms', delay=0.3)
+    add_step(recipe, 'a2', 'obs1-corr.ms')
+    add_step(recipe, 'b1', 'pfx-obs2_table.gc')
+    add_step(recipe, 'all', 'other.ms')
+    add_step(recipe, 'b2', 'obs2.ms')
+    recipe.run()
+
+    # steps of the same observation run in order, those of different ones at once
+    assert events.index('end', 'a1') < events.index('start', 'a2')
+    assert events.index('start', 'b1') < events.index('end', 'a1')
+    # a step of no particular observation waits for all earlier steps, and all later ones wait for it
+    assert max(events.index('end', name) for name in ('a1', 'a2', 'b1')) < events.index('start', 'all')
+    assert events.index('end', 'all') < events.index('start', 'b2')
+
+    assert [job.name for job in recipe.completed] == ['b1', 'a1', 'a2', 'all', 'b2']
+    with open(recipe.resume_file) as f:
+        resume = json.load(f)
+    assert sorted(entry['number'] for entry in resume['steps']) == [1, 2, 3, 4, 5]
+    assert {entry['status'] for entry in resume['steps']} == {'completed'}
+
+
+def test_serial_with_one_slot(recipe, events):
+    recipe = recipe(max_parallel_ms=1)
+    add_step(recipe, 'a1', 'obs1.ms')
+    add_step(recipe, 'b1', 'obs2.ms')
+    recipe.run()
+    assert events.events == [('start', 'a1'), ('end', 'a1'), ('start', 'b1'), ('end', 'b1')]
+
+
+def test_failure_lets_running_steps_finish(recipe, events):
+    recipe = recipe()
+    add_step(recipe, 'a1', 'obs1.ms', fail=True)
+    add_step(recipe, 'b1', 'obs2.ms', delay=0.3)
+    add_step(recipe, 'a2', 'obs1.ms')
+    add_step(recipe, 'b2', 'obs2.ms')
+    with pytest.raises(PipelineException) as exc:
+        recipe.run()
+
+    # b1 was running when a1 failed and completes, no new steps are started
+    assert ('end', 'b1') in events.events
+    assert ('start', 'a2') not in events.events and ('start', 'b2') not in events.events
+    assert exc.value.failed.name == 'a1'
+    assert [job.name for job in exc.value.completed] == ['b1']
+    assert [job.name for job in exc.value.remaining] == ['a2', 'b2']
+    with open(recipe.resume_file) as f:
+        statuses = {entry['label']: entry['status'] for entry in json.load(f)['steps']}
+    assert statuses == {'a1': 'failed', 'b1': 'completed', 'a2': 'remaining', 'b2': 'remaining'}
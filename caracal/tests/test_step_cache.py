@@ -0,0 +1,101 @@
+import os
+
+import pytest
+
+from caracal.dispatch_crew.step_cache import StepCache
+
+
+@pytest.fixture
+def msdir(tmp_path):
+    """A directory with an MS (data and subtable) and a calibration table"""
+    msdir = tmp_path / "msdir"
+    (msdir / "obs.ms" / "ANTENNA").mkdir(parents=True)
+    (msdir / "obs.ms" / "table.f0").write_text("data")
+    (msdir / "obs.ms" / "ANTENNA" / "table.f0").write_text("antennas")
+    (msdir / "obs.gc").write_text("gains")
+    return msdir
+
+
+def describe(cache, msdir, cab, **config):
+    return cache.describe(f"stimela/{cab}", config, version="1.0", dirs=dict(msdir=str(msdir)))
+
+
+def steps(cache, msdir, gain="G"):
+    """The steps of a worker: flagging and calibrating an MS, then plotting the gain table"""
+    return [describe(cache, msdir, "flagger", ms="obs.ms:msfile"),
+            describe(cache, msdir, "calibrator", ms="obs.ms:msfile", caltable="obs.gc:msfile", gaintype=gain),
+            describe(cache, msdir, "plotter", table="obs.gc:msfile")]
+
+
+def modify(msdir, name):
+    """Changes a file as a step would, in place"""
+    path = msdir / name / "table.f0" if name.endswith(".ms") else msdir / name
+    with open(path, "a") as f:
+        f.write("+")
+
+
+def run(cache, msdir, descriptions):
+    """Runs the steps that are not skipped, returns their indices"""
+    ran = []
+    for i, step in enumerate(descriptions):
+        key = cache.plan(step)
+        if key is not None:
+            for name in step["files"]:
+                modify(msdir, name)
+            cache.record(step, key)
+            ran.append(i)
+    return ran
+
+
+def rerun(msdir, reuse=True, **kwargs):
+    cache = StepCache(str(msdir / "step_cache.json"), reuse=reuse)
+    return run(cache, msdir, steps(cache, msdir, **kwargs))
+
+
+def test_describe(msdir):
+    cache = StepCache(str(msdir / "step_cache.json"))
+    step = cache.describe("stimela/cab", dict(ms="obs.ms:msfile", table="obs.gc", plot="gains.png:output",
+                                              files=["a.txt"]),
+                          dirs=dict(msdir="/ms", outdir="/out"), is_file=lambda value: value.endswith(".gc"))
+    assert step["files"] == {"obs.ms": ["/ms/obs.ms"], "obs.gc": ["/ms/obs.gc", "/out/obs.gc"],
+                             "gains.png": ["/out/gains.png"]}
+    assert step["identity"] != cache.describe("stimela/cab", dict(ms="obs.ms:msfile"))["identity"]
+    assert cache.describe(print, {}) is None
+
+
+def test_completed_steps_are_skipped(msdir):
+    assert rerun(msdir) == [0, 1, 2]
+    assert rerun(msdir) == []
+    # casacore lock files change on read access, and do not count
+    (msdir / "obs.ms" / "table.lock").write_text("lock")
+    assert rerun(msdir) == []
+
+
+def test_changed_file_invalidates_its_steps(msdir):
+    rerun(msdir)
+    modify(msdir, "obs.gc")
+    # the calibration step is rerun, and so is the later step using its table
+    assert rerun(msdir) == [1, 2]
+
+
+def test_rerun_step_invalidates_later_steps(msdir):
+    rerun(msdir)
+    # a different calibration is run, plotting its table is too, but the flagging before is not
+    assert rerun(msdir, gain="K") == [1, 2]
+    assert rerun(msdir, gain="K") == []
+    # going back to the first calibration reruns it, as the MS has been changed since
+    assert rerun(msdir) == [1, 2]
+
+
+def test_corrupt_cache_starts_afresh(msdir):
+    rerun(msdir)
+    (msdir / "step_cache.json").write_text('{"completed": ')
+    assert rerun(msdir) == [0, 1, 2]
+    assert rerun(msdir) == []
+
+
+def test_no_reuse_runs_and_records_all_steps(msdir):
+    rerun(msdir)
+    assert rerun(msdir, reuse=False) == [0, 1, 2]
+    assert os.path.exists(msdir / "step_cache.json")
+    assert rerun(msdir) == []
@@ -0,0 +1,109 @@
+from types import SimpleNamespace
+
+import pytest
+from stimela.cargo import cab
+
+from caracal.dispatch_crew import warm_containers
+from caracal.dispatch_crew.warm_containers import WarmContainers
+
+
+class FakeCab(object):
+    def __init__(self):
+        self.updated = []
+
+    def update(self, config, parameter_file_name, tag=None):
+        self.updated.append(parameter_file_name)
+
+
+def make_job(name, image="quay.io/stimela/owlcat:1.2.5-1", output="/data/output", jtype="docker"):
+    """A Stimela container job, with the volumes and environment set up by stimela.recipe.StimelaJob"""
+    volumes = [f"/work/params/{name}.json:{cab.MOUNT}/configfile:ro",
+               f"/cabs/{image.split('/')[-1]}/src:{cab.MOUNT}/code:ro",
+               f"/data/msdir:{cab.MOUNT}/msdir:rw",
+               f"{output}:{cab.MOUNT}/output:rw"]
+    environs = [f"CONFIG={cab.MOUNT}/configfile", f"STIMELA_MOUNT={cab.MOUNT}", f"OUTPUT={cab.MOUNT}/output"]
+    cont = SimpleNamespace(image=image, volumes=volumes, environs=environs, WORKDIR=f"{cab.MOUNT}/output",
+                           RUNSCRIPT="/docker_run", parameter_file_name=f"/work/params/{name}.json",
+                           config={}, _cab=FakeCab(), logger=None, logfile=f"/work/{name}.log", time_out=-1)
+    return SimpleNamespace(name=name, jtype=jtype, job=cont, tag=None, args=["--user 1:1", "--memory 1g", "--shm-size 1gb"],
+                           apply_output_wranglers=None)
+
+
+@pytest.fixture
+def commands(monkeypatch):
+    """Records the container commands run by the pool, instead of running them"""
+    commands = []
+
+    def xrun(command, options, kill_callback=None, **kwargs):
+        commands.append((command, " ".join(map(str, options)), kill_callback))
+    monkeypatch.setattr(warm_containers.stimela_utils, "xrun", xrun)
+    return commands
+
+
+def started(commands):
+    return [options for command, options, _ in commands if command.endswith(" run")]
+
+
+def execs(commands):
+    return [options for command, options, _ in commands if command.endswith(" exec")]
+
+
+def test_steps_share_a_container(commands):
+    pool = WarmContainers("docker")
+    first, second = make_job("step1"), make_job("step2")
+    assert pool.supports(first)
+    pool.run_job(first)
+    pool.run_job(second)
+
+    # one container for both steps, with the directory of the parameter files mounted instead of the files
+    assert len(started(commands)) == 1
+    run = started(commands)[0]
+    assert f"/work/params:{cab.MOUNT}/configs:ro" in run
+    assert "configfile" not in run and "CONFIG=" not in run
+    assert "--entrypoint sleep" in run and run.endswith("infinity")
+    name = run.split("--name ")[1].split()[0]
+    # each step is run with its own parameter file
+    assert execs(commands) == [f"-e CONFIG={cab.MOUNT}/configs/step1.json {name} /docker_run",
+                               f"-e CONFIG={cab.MOUNT}/configs/step2.json {name} /docker_run"]
+    assert first.job._cab.updated == ["/work/params/step1.json"]
+    assert first.created and first.declare_status is None
+
+    pool.close()
+    assert commands[-1][:2] == ("docker rm", f"-f {name}")
+    assert pool.containers == {}
+
+
+def test_different_mounts_or_images_get_their_own_containers(commands):
+    pool = WarmContainers("docker")
+    for job in (make_job("a"), make_job("b", output="/data/plots"), make_job("c", image="quay.io/stimela/casa:1"),
+                make_job("d", output="/data/plots")):
+        pool.run_job(job)
+    assert len(started(commands)) == 3
+    names = [options.split()[-2] for options in execs(commands)]
+    assert names[1] == names[3] and len(set(names)) == 3
+
+
+def test_podman_skips_resource_options(commands):
+    pool = WarmContainers("podman")
+    pool.run_job(make_job("a", jtype="podman"))
+    run = started(commands)[0]
+    assert "--user" not in run and "--memory" not in run and "--shm-size 1gb" in run
+    assert commands[0][0] == "podman run"
+
+
+def test_killed_container_is_replaced(commands):
+    pool = WarmContainers("docker")
+    pool.run_job(make_job("a"))
+    kill = commands[-1][2]
+    kill()
+    assert commands[-1][:2] == ("docker rm", f"-f {started(commands)[0].split('--name ')[1].split()[0]}")
+    assert pool.containers == {}
+    pool.run_job(make_job("b"))
+    assert len(started(commands)) == 2
+
+
+def test_supports():
+    pool = WarmContainers("docker")
+    assert not pool.supports(make_job("a", jtype="singularity"))
+    assert not pool.supports(SimpleNamespace(jtype="docker", job={"function": print, "parameters": {}}))
+    assert not WarmContainers("udocker").supports(make_job("a", jtype="udocker"))
@@ -0,0 +1,408 @@
+"""
+Benchmarks of the numerical kernels CARACal runs in-process
+
+Synthetic FITS cubes, Measurement Sets and flag tables are generated
+in a scratch directory at a number of preset sizes, and the Python-side
+hot paths of the workers are timed and memory-profiled on them. The
+results are written as JSON, such that regressions can be tracked
+between releases:
+
+    python -m caracal.utils.benchmark --sizes small medium \\
+        --output caracal-benchmarks.json
+
+Memory is reported as the peak of the allocations traced by
+tracemalloc (which includes numpy arrays) while a case runs. Work done
+in child processes is timed but not memory-profiled.
+"""
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import contextlib
+import tracemalloc
+import traceback
+from datetime import datetime
+import numpy as np
+
+# Preset problem sizes. Cubes are nchan x npix x npix, the MS has
+# nant * (nant - 1) / 2 baselines, ntime integrations and nmschan
+# channels, and ncells and nsources are the number of UV cells to flag
+# and of catalogue sources to mask, respectively.
+SIZES = {
+    'small': dict(nchan=64, npix=128, nant=16, ntime=60, nmschan=256,
+                  ncells=20, nsources=50),
+    'medium': dict(nchan=256, npix=256, nant=32, ntime=120, nmschan=512,
+                   ncells=100, nsources=300),
+    'large': dict(nchan=512, npix=512, nant=64, ntime=60, nmschan=1024,
+                  ncells=400, nsources=2000),
+}
+
+HI = 1.4204057517667e+9  # Hz
+DISH_SIZE = 13.5  # m, MeerKAT
+
+
+def make_cube(filename, nchan, npix, naxis=4, seed=0):
+    """Write a noise cube with continuum sources and a line source
+
+    The continuum follows a power law in frequency, the line source is
+    a Gaussian in position and frequency. The cube has nchan channels
+    of npix x npix pixels and a degenerate Stokes axis if naxis is 4.
+    """
+    from astropy.io import fits
+
+    rng = np.random.default_rng(seed)
+    cube = rng.normal(scale=1e-4, size=(nchan, npix, npix)).astype(np.float32)
+
+    yy, xx = np.indices((npix, npix), dtype=np.float32)
+    freq = 1.3e9 + 2e5 * np.arange(nchan)
+    for yc, xc, flux in zip(rng.uniform(0, npix, 10), rng.uniform(0, npix, 10),
+                            rng.uniform(1e-3, 1e-1, 10)):
+        blob = flux * np.exp(-((xx - xc)**2 + (yy - yc)**2) / 8.)
+        cube += blob[None] * ((freq / freq[0])**-0.7)[:, None, None]
+
+    zz = np.arange(nchan)[:, None, None]
+    cube += 5e-3 * np.exp(-(zz - nchan / 2.)**2 / (nchan / 20.)**2) * \
+        np.exp(-((xx - npix / 2.)**2 + (yy - npix / 2.)**2) / (npix / 16.)**2)
+
+    header = fits.Header()
+    for ax, (ctype, crpix, cdelt, crval) in enumerate([
+            ('RA---SIN', npix / 2 + 1, -2. / 3600, 180.),
+            ('DEC--SIN', npix / 2 + 1, 2. / 3600, -30.),
+            ('FREQ', 1, 2e5, freq[0]),
+            ('STOKES', 1, 1, 1)][:naxis]):
+        header['CTYPE{:d}'.format(ax + 1)] = ctype
+        header['CRPIX{:d}'.format(ax + 1)] = crpix
+        header['CDELT{:d}'.format(ax + 1)] = cdelt
+        header['CRVAL{:d}'.format(ax + 1)] = crval
+    header['BUNIT'] = 'JY/BEAM'
+    header['RESTFREQ'] = HI
+
+    if naxis == 4:
+        cube = cube[None]
+    elif naxis == 2:
+        cube = cube[0]
+    fits.writeto(filename, cube, header=header, overwrite=True)
+    return filename
+
+
+def make_line_mask(filename, cubename):
+    """Write a mask cube marking the line source of a synthetic cube"""
+    from astropy.io import fits
+
+    with fits.open(cubename) as hdul:
+        data = hdul[0].data
+        mask = (np.abs(data - np.median(data, axis=-3, keepdims=True)) >
+                1e-3).astype(np.float32)
+        fits.writeto(filename, mask, header=hdul[0].header, overwrite=True)
+    return filename
+
+
+def make_image(filename, npix, seed=0):
+    """Write a synthetic 2D continuum image"""
+    return make_cube(filename, 1, npix, naxis=2, seed=seed)
+
+
+def make_ms(msname, nant, ntime, nchan, ncorr=2, flagfrac=0.1, seed=0):
+    """Write a Measurement Set with the columns used by the kernels
+
+    Only FLAG, UVW, ANTENNA1/2, FIELD_ID, SCAN_NUMBER, INTERVAL and TIME
+    are filled (no visibilities), plus the FIELD, SPECTRAL_WINDOW and
+    POLARIZATION subtables. A fraction flagfrac of the data is flagged
+    at random.
+    """
+    import casacore.tables as tables
+
+    rng = np.random.default_rng(seed)
+    if os.path.exists(msname):
+        shutil.rmtree(msname)
+
+    flagdesc = tables.makearrcoldesc(
+        'FLAG', False, ndim=2, shape=[nchan, ncorr], options=4,
+        comment='The data flags, array of bools with same shape as data')
+    ms = tables.default_ms(msname, tables.maketabdesc(flagdesc))
+
+    ant1, ant2 = np.triu_indices(nant, 1)
+    nbl = ant1.size
+    nrow = nbl * ntime
+    ms.addrows(nrow)
+    ms.putcol('ANTENNA1', np.tile(ant1, ntime))
+    ms.putcol('ANTENNA2', np.tile(ant2, ntime))
+    ms.putcol('FIELD_ID', np.zeros(nrow, dtype=np.int32))
+    ms.putcol('SCAN_NUMBER', np.repeat(
+        1 + np.arange(ntime) * 4 // ntime, nbl).astype(np.int32))
+    ms.putcol('INTERVAL', np.full(nrow, 8.))
+    ms.putcol('TIME', np.repeat(5e9 + 8. * np.arange(ntime), nbl))
+
+    # Antennas in a disk of 4 km radius, tracks rotating over 12 h
+    xy = rng.uniform(-4e3, 4e3, size=(nant, 2))
+    bl = xy[ant2] - xy[ant1]
+    ha = np.linspace(-np.pi / 2, np.pi / 2, ntime)
+    uvw = np.zeros((ntime, nbl, 3))
+    uvw[..., 0] = np.cos(ha)[:, None] * bl[:, 0] - np.sin(ha)[:, None] * bl[:, 1]
+    uvw[..., 1] = np.sin(ha)[:, None] * bl[:, 0] + np.cos(ha)[:, None] * bl[:, 1]
+    ms.putcol('UVW', uvw.reshape(nrow, 3))
+
+    ms.putcol('FLAG', rng.random((nrow, nchan, ncorr)) < flagfrac)
+    ms.close()
+
+    field = tables.table(msname + '/FIELD', readonly=False, ack=False)
+    field.addrows(1)
+    field.putcell('NAME', 0, 'TARGET')
+    field.close()
+
+    spw = tables.table(msname + '/SPECTRAL_WINDOW', readonly=False, ack=False)
+    spw.addrows(1)
+    spw.putcell('CHAN_FREQ', 0, 1.3e9 + 2e5 * np.arange(nchan))
+    spw.putcell('CHAN_WIDTH', 0, np.full(nchan, 2e5))
+    spw.putcell('NUM_CHAN', 0, nchan)
+    spw.close()
+
+    pol = tables.table(msname + '/POLARIZATION', readonly=False, ack=False)
+    pol.addrows(1)
+    pol.putcell('CORR_TYPE', 0, np.array([9, 12, 10, 11][:ncorr], dtype=np.int32))
+    pol.putcell('NUM_CORR', 0, ncorr)
+    pol.close()
+    return msname
+
+
+def make_flag_table(ncells, cell=10., uvmax=2e4, seed=0):
+    """Return a table of UV cells to flag and the matching FFT header
+
+    This is what UzeroFlagger.saveFFTTable passes on to flagQuartile:
+    the u, v (in wavelengths) and amplitude of the cells above the
+    cutoff, clustered around u = 0 like the stripes they are meant to
+    remove.
+    """
+    from astropy.table import Table
+
+    rng = np.random.default_rng(seed)
+    u = cell * np.round(rng.normal(scale=3., size=ncells))
+    v = cell * np.round(rng.uniform(-uvmax, uvmax, size=ncells) / cell)
+    amp = rng.uniform(1., 10., size=ncells)
+    return Table(names=['u', 'v', 'amp'], data=(u, v, amp)), {'CDELT2': cell}
+
+
+def make_nvss_catalog(filename, nsources, imsize, seed=0):
+    """Write a catalogue of sources as read by make_mask_nvss"""
+    from astropy.table import Table
+
+    rng = np.random.default_rng(seed)
+    Table({
+        'RADEG': rng.uniform(179., 181., nsources),
+        'DECDEG': rng.uniform(-31., -29., nsources),
+        'MajAxis': rng.uniform(10., 60., nsources),
+        'MinAxis': rng.uniform(10., 60., nsources),
+        'PixX': rng.uniform(0, imsize - 1, nsources),
+        'PixY': rng.uniform(0, imsize - 1, nsources),
+    }).write(filename, format='ascii.commented_header', overwrite=True)
+    return filename
+
+
+def measure(func, args=(), kwargs=None, repeat=3):
+    """Time func(*args, **kwargs) repeat times and trace its memory
+
+    Returns:
+        dict with the wall-clock times (s) of all runs and the peak of
+        the traced memory (MB) over all runs
+    """
+    kwargs = kwargs or {}
+    times = []
+    peak = 0
+    for rr in range(repeat):
+        tracemalloc.start()
+        try:
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                func(*args, **kwargs)
+            times.append(time.perf_counter() - start)
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+        finally:
+            tracemalloc.stop()
+    return {
+        'times': times,
+        'min': min(times),
+        'median': float(np.median(times)),
+        'peak_mb': peak / 2.**20,
+    }
+
+
+def cases(size, workdir):
+    """Yield (name, parameters, setup) of the benchmark cases of a size
+
+    setup() generates the input data and returns (func, args, kwargs),
+    so that generating data is neither timed nor profiled, and cases
+    whose dependencies are missing fail one by one.
+    """
+    def imcontsub_case(fitmode, **params):
+        def setup():
+            from caracal.workers.utils import image_contsub
+            cube = os.path.join(workdir, 'cube.fits')
+            if not os.path.exists(cube):
+                make_cube(cube, size['nchan'], size['npix'])
+            return image_contsub.imcontsub, (cube,), dict(
+                outcubus=os.path.join(workdir, 'contsub.fits'),
+                fitted=os.path.join(workdir, 'fitted.fits'),
+                fitmode=fitmode, clobber=True, **params)
+        return 'imcontsub.' + fitmode, params, setup
+
+    yield imcontsub_case('poly', polyorder=3)
+    yield imcontsub_case('median', length=31)
+    yield imcontsub_case('savgol', length=31, polyorder=2, sgiters=2)
+    yield imcontsub_case('median', length=31, kertyp='gauss', kersiz=3)
+
+    def make_pb_cube():
+        from caracal.workers import line_worker
+        cube = make_cube(os.path.join(workdir, 'pb_image.fits'),
+                         size['nchan'], size['npix'])
+        return line_worker.make_pb_cube, (cube, True, 'mauch', DISH_SIZE, 0.1), {}
+    yield 'line_worker.make_pb_cube', {'typ': 'mauch', 'apply_corr': True}, \
+        make_pb_cube
+
+    def calc_rms():
+        from caracal.workers import line_worker
+        cube = make_cube(os.path.join(workdir, 'rms_cube.fits'),
+                         size['nchan'], size['npix'])
+        mask = make_line_mask(os.path.join(workdir, 'rms_mask.fits'), cube)
+        return line_worker.calc_rms, (cube, mask), {}
+    yield 'line_worker.calc_rms', {'linemask': True}, calc_rms
+
+    def predict_noise():
+        from caracal.dispatch_crew import noisy
+        ms = make_ms(os.path.join(workdir, 'noise.ms'), size['nant'],
+                     size['ntime'], size['nmschan'])
+        # no summary cache, so that every repeat reads the MS
+        return noisy.PredictNoise, ([ms], '22.', DISH_SIZE, 'TARGET'), \
+            {'cache': False}
+    yield 'noisy.PredictNoise', {'nms': 1}, predict_noise
+
+    def flag_quartile():
+        from caracal.workers.utils.flag_Uzeros import UzeroFlagger
+        ms = make_ms(os.path.join(workdir, 'uzeros.ms'), size['nant'],
+                     size['ntime'], size['nmschan'])
+        table, header = make_flag_table(size['ncells'])
+        flagger = UzeroFlagger({'flag_u_zeros': {}})
+        return flagger.flagQuartile, (ms, table, header, 'madThreshold', 1, 1), {}
+    yield 'UzeroFlagger.flagQuartile', {'dilateU': 1, 'dilateV': 1}, \
+        flag_quartile
+
+    def make_mask_nvss():
+        from caracal.workers import mask_worker
+        imsize = size['npix'] * 4
+        catalog = make_nvss_catalog(os.path.join(workdir, 'nvss.txt'),
+                                    size['nsources'], imsize)
+        return mask_worker.make_mask_nvss, (
+            catalog, ['12:00:00', '-30:00:00'], imsize, 2.,
+            os.path.join(workdir, 'nvss_mask.fits')), {}
+    yield 'mask_worker.make_mask_nvss', {'imsize_factor': 4}, make_mask_nvss
+
+    def make_mauchian_pb():
+        from caracal.workers import mosaic_worker
+        image = make_image(os.path.join(workdir, 'mosaic-image.fits'),
+                           size['npix'] * 4)
+        return mosaic_worker.make_mauchian_pb, (image, 1.4e9), {}
+    yield 'mosaic_worker.make_mauchian_pb', {'imsize_factor': 4}, \
+        make_mauchian_pb
+
+
+def run_benchmarks(sizes=('small',), select=None, repeat=3, workdir=None,
+                   verbose=True):
+    """Run the benchmark cases at the given sizes
+
+    Parameters:
+        sizes (list of str): Keys of SIZES to run
+        select (list of str): Only run cases whose name contains one of
+            these strings (all cases if None)
+        repeat (int): Number of timed runs per case
+        workdir (str): Scratch directory for the synthetic data (a
+            temporary directory that is removed afterwards if None)
+        verbose (bool): Print a line per case
+
+    Returns:
+        dict with the environment and a list of results, ready to be
+        dumped as JSON
+    """
+    import caracal
+
+    report = {
+        'caracal': caracal.__version__,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'date': datetime.utcnow().isoformat(timespec='seconds'),
+        'repeat': repeat,
+        'sizes': {name: SIZES[name] for name in sizes},
+        'results': [],
+    }
+
+    tmpdir = tempfile.mkdtemp(prefix='caracal-bench-', dir=workdir)
+    try:
+        for sizename in sizes:
+            sizedir = os.path.join(tmpdir, sizename)
+            os.mkdir(sizedir)
+            for name, params, setup in cases(SIZES[sizename], sizedir):
+                if select and not any(sel in name for sel in select):
+                    continue
+                result = {'name': name, 'size': sizename, 'params': params}
+                try:
+                    func, args, kwargs = setup()
+                    result.update(measure(func, args, kwargs, repeat))
+                except Exception as exc:
+                    result['error'] = '{}: {}'.format(type(exc).__name__, exc)
+                    if verbose:
+                        traceback.print_exc()
+                if verbose:
+                    if 'error' in result:
+                        print('{:<32s} {:<7s} failed: {}'.format(
+                            name, sizename, result['error']))
+                    else:
+                        print('{:<32s} {:<7s} {:9.3f} s {:9.1f} MB'.format(
+                            name, sizename, result['min'], result['peak_mb']))
+                report['results'].append(result)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    return report
+
+
+def parsing():
+    parser = argparse.ArgumentParser(
+        description='Time and memory-profile the in-process numerical '
+        'kernels of CARACal on synthetic data',
+        prog='python -m caracal.utils.benchmark')
+    parser.add_argument(
+        '--sizes', '-s', nargs='+', choices=list(SIZES), default=['small'],
+        help='Problem sizes to run')
+    parser.add_argument(
+        '--select', '-k', nargs='+', default=None,
+        help='Only run cases whose name contains one of these strings')
+    parser.add_argument(
+        '--repeat', '-r', type=int, default=3,
+        help='Number of timed runs per case')
+    parser.add_argument(
+        '--workdir', '-w', default=None,
+        help='Scratch directory for the synthetic data')
+    parser.add_argument(
+        '--output', '-o', default=None,
+        help='JSON file to write the results to (default: stdout)')
+    return parser.parse_args()
+
+
+def main():
+    args = parsing()
+    report = run_benchmarks(args.sizes, args.select, args.repeat,
+                            args.workdir, verbose=args.output is not None)
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=2)
+        print('')
+    else:
+        with open(args.output, 'w') as fobj:
+            json.dump(report, fobj, indent=2)
+
+
+if __name__ == '__main__':
+    main()
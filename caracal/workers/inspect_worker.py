@@ -317,7 +317,8 @@ def plotms(pipeline, recipe, basic, extras=None):
 
     recipe.add("cab/casa_plotms", step, plotms_keys,
                input=pipeline.input, output=output_dir,
-               label=label, memory_limit=None, cpus=None)
+               label=label, memory_limit=None, cpus=None,
+               inputs=[basic["ms"]])
 
 
 def _process_shadems_plot_list(plot_args, basesubst, plotlist, defaults, description, extras=None):
@@ -427,7 +428,8 @@ def direct_shadems(pipeline, recipe, shade_cfg, extras=None):
                         args=plot_args,
                         ignore_errors=shade_cfg["ignore_errors"]),
                    input=pipeline.input, output=shade_cfg["output_dir"],
-                   label=f"{step}:: Plotting", memory_limit=None, cpus=None)
+                   label=f"{step}:: Plotting", memory_limit=None, cpus=None,
+                   inputs=[shade_cfg["ms"]])
 
 
 def shadems(pipeline, recipe, basic, extras=None):
@@ -494,7 +496,8 @@ def shadems(pipeline, recipe, basic, extras=None):
 
         recipe.add("cab/shadems", step, shadems_keys,
                    input=pipeline.input, output=output_dir,
-                   label=label, memory_limit=None, cpus=None)
+                   label=label, memory_limit=None, cpus=None,
+                   inputs=[basic["ms"]])
 
 
 def ragavi_vis(pipeline, recipe, basic, extras=None):
@@ -532,7 +535,8 @@ def ragavi_vis(pipeline, recipe, basic, extras=None):
 
     recipe.add("cab/ragavi_vis", step, ragavi_keys,
                input=pipeline.input, output=output_dir,
-               label=label, memory_limit=None, cpus=None)
+               label=label, memory_limit=None, cpus=None,
+               inputs=[basic["ms"]])
 
 
 # main function
@@ -779,7 +779,7 @@ def worker(pipeline, recipe, config):
             else:
                 mslist = ms_dict[target]
             caracal.log.info('  Target #{0:d}: {1:}, files {2:}'.format(tt, target, mslist))
-            noisy.PredictNoise(['{0:s}/{1:s}'.format(pipeline.msdir, mm) for mm in mslist], str(tsyseff), diam, target, verbose=2)
+            noisy.PredictNoise(['{0:s}/{1:s}'.format(pipeline.msdir, mm) for mm in mslist], str(tsyseff), diam, target, verbose=2, ncpu=ncpu)
 
     if pipeline.enable_task(config, 'make_cube') and config['make_cube']['image_with'] == 'wsclean':
         nchans_all, specframe_all = [], []
@@ -1679,6 +1679,8 @@ def worker(pipeline, recipe, config):
                         fitted=outfitlist[uu],
                         confit=outconlist[uu],
                         clobber=True,
+                        tilemem=config['imcontsub']['tilemem'],
+                        ncpu=config['imcontsub']['ncpu'] or ncpu,
                     )
                     if runonce:
                         rancsonce = True
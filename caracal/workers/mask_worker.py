@@ -13,6 +13,78 @@ NAME = 'Make Masks'
 LABEL = 'mask'
 
 
+@extras("astropy")
+def make_mask_nvss(catalog_table, centre, imsize, cell, mask):
+    """Make a mask of the NVSS sources in catalog_table on an imsize
+    x imsize SIN grid with cell size cell (arcsec) around centre"""
+    from astropy import units as u
+    import astropy.coordinates as coord
+    from astropy import wcs
+    from astropy.io import fits, ascii
+
+    w = wcs.WCS(naxis=2)
+
+    centre = coord.SkyCoord(centre[0], centre[1], unit=(
+        u.hourangle, u.deg), frame='icrs')
+    cell /= 3600.
+
+    w.wcs.crpix = [imsize / 2, imsize / 2]
+    w.wcs.cdelt = np.array([-cell, cell])
+    w.wcs.crval = [centre.ra.deg, centre.dec.deg]
+    w.wcs.ctype = ["RA---SIN", "DEC--SIN"]
+
+    hdr = w.to_header()
+    hdr['SIMPLE'] = 'T'
+    hdr['BITPIX'] = -32
+    hdr['NAXIS'] = 2
+    hdr['EQUINOX'] = 2000.
+    hdr.set('NAXIS1', imsize, after='NAXIS')
+    hdr.set('NAXIS2', imsize, after='NAXIS1')
+
+    if 'CUNIT1' in hdr:
+        del hdr['CUNIT1']
+    if 'CUNIT2' in hdr:
+        del hdr['CUNIT2']
+
+    data = np.zeros([hdr['NAXIS2'], hdr['NAXIS1']])
+
+    tab = ascii.read(catalog_table)
+
+    major = tab['MajAxis']
+    minor = tab['MinAxis']
+    minor = major
+    ra = tab['RADEG']
+    dec = tab['DECDEG']
+
+    pix_x = tab['PixX']
+    pix_y = tab['PixY']
+
+    angle1 = np.radians(0.0)
+    cosangle1 = np.cos(angle1)
+    sinangle1 = np.sin(angle1)
+
+    xnum = np.linspace(0, hdr['NAXIS1'], hdr['NAXIS1'])
+    ynum = np.linspace(0, hdr['NAXIS2'], hdr['NAXIS2'])
+    x, y = np.meshgrid(xnum, ynum)
+
+    for i in range(0, len(pix_x)):
+
+        xc = pix_x[i]
+        yc = pix_y[i]
+
+        if minor[i] / 3600. >= float(hdr['CDELT2']) and major[i] / 3600. >= float(hdr['CDELT2']):
+            a = major[i] / 3600. / float(hdr['CDELT2']) / 2.
+            b = minor[i] / 3600. / float(hdr['CDELT2']) / 2.
+            ell = np.power(x - xc, 2) / np.power(a, 2) + \
+                np.power(y - yc, 2) / np.power(b, 2)
+            index_ell = np.where(np.less_equal(ell, 1))
+            data[index_ell] = 1
+        else:
+            data[int(yc), int(xc)] = 1
+
+    fits.writeto(mask, data, hdr, overwrite=True)
+
+
 @extras("astropy")
 def worker(pipeline, recipe, config):
 
@@ -308,70 +380,6 @@ def worker(pipeline, recipe, config):
 
         fits.writeto(mask, mosdata, moshead, overwrite=True)
 
-    def make_mask_nvss(catalog_table, centre, imsize, cell, mask):
-
-        w = wcs.WCS(naxis=2)
-
-        centre = coord.SkyCoord(centre[0], centre[1], unit=(
-            u.hourangle, u.deg), frame='icrs')
-        cell /= 3600.
-
-        w.wcs.crpix = [imsize / 2, imsize / 2]
-        w.wcs.cdelt = np.array([-cell, cell])
-        w.wcs.crval = [centre.ra.deg, centre.dec.deg]
-        w.wcs.ctype = ["RA---SIN", "DEC--SIN"]
-
-        hdr = w.to_header()
-        hdr['SIMPLE'] = 'T'
-        hdr['BITPIX'] = -32
-        hdr['NAXIS'] = 2
-        hdr['EQUINOX'] = 2000.
-        hdr.set('NAXIS1', imsize, after='NAXIS')
-        hdr.set('NAXIS2', imsize, after='NAXIS1')
-
-        if 'CUNIT1' in hdr:
-            del hdr['CUNIT1']
-        if 'CUNIT2' in hdr:
-            del hdr['CUNIT2']
-
-        data = np.zeros([hdr['NAXIS2'], hdr['NAXIS1']])
-
-        tab = ascii.read(catalog_table)
-
-        major = tab['MajAxis']
-        minor = tab['MinAxis']
-        minor = major
-        ra = tab['RADEG']
-        dec = tab['DECDEG']
-
-        pix_x = tab['PixX']
-        pix_y = tab['PixY']
-
-        angle1 = np.radians(0.0)
-        cosangle1 = np.cos(angle1)
-        sinangle1 = np.sin(angle1)
-
-        xnum = np.linspace(0, hdr['NAXIS1'], hdr['NAXIS1'])
-        ynum = np.linspace(0, hdr['NAXIS2'], hdr['NAXIS2'])
-        x, y = np.meshgrid(xnum, ynum)
-
-        for i in range(0, len(pix_x)):
-
-            xc = pix_x[i]
-            yc = pix_y[i]
-
-            if minor[i] / 3600. >= float(hdr['CDELT2']) and major[i] / 3600. >= float(hdr['CDELT2']):
-                a = major[i] / 3600. / float(hdr['CDELT2']) / 2.
-                b = minor[i] / 3600. / float(hdr['CDELT2']) / 2.
-                ell = np.power(x - xc, 2) / np.power(a, 2) + \
-                    np.power(y - yc, 2) / np.power(b, 2)
-                index_ell = np.where(np.less_equal(ell, 1))
-                data[index_ell] = 1
-            else:
-                data[int(yc), int(xc)] = 1
-
-        fits.writeto(mask, data, hdr, overwrite=True)
-
     def merge_masks(extended_mask, catalog_mask, end_mask):
 
         catlist = fits.open(catalog_mask)
@@ -11,6 +11,33 @@ NAME = "Mosaic 2D-images or cubes"
 LABEL = 'mosaic'
 
 
+# Copied from line_worker.py and edited. This is to get a Mauchian beam.
+# The original version makes the build_beam function in worker() redundant but I do not want to change too many things at once.
+@extras(packages="astropy")
+def make_mauchian_pb(filename, freq):  # pbtype):
+    from astropy.io import fits
+    with fits.open(filename) as image:
+        headimage = image[0].header
+        ang_offset = np.indices(
+            (headimage['naxis2'], headimage['naxis1']), dtype=np.float32)
+        ang_offset[0] -= (headimage['crpix2'] - 1)
+        ang_offset[1] -= (headimage['crpix1'] - 1)
+        ang_offset = np.sqrt((ang_offset**2).sum(axis=0))  # Using offset in x and y direction to calculate the total offset from the pointing centre
+        ang_offset = ang_offset * np.abs(headimage['cdelt1'])  # Now offset is in units of deg
+        # if pbtype == 'gaussian':
+        #    sigma_pb = 17.52 / (freq / 1e+9) / dish_size / 2.355
+        #    sigma_pb.resize((sigma_pb.shape[0], 1, 1))
+        #    datacube = np.exp(-datacube**2 / 2 / sigma_pb**2)
+        # elif pbtype == 'mauchian':
+        FWHM_pb = (57.5 / 60) * (freq / 1.5e9)**-1  # Eqn 4 of Mauch et al. (2020), but in deg   # freq is just a float for the 2D case
+        pb_image = (np.cos(1.189 * np.pi * (ang_offset / FWHM_pb)) / (
+            1 - 4 * (1.189 * ang_offset / FWHM_pb)**2))**2  # Eqn 3 of Mauch et al. (2020)
+        fits.writeto(filename.replace('image.fits', 'pb.fits'),
+                     pb_image, header=headimage, overwrite=True)
+        caracal.log.info('Created Mauchian primary-beam  FITS {0:s}'.format(
+            filename.replace('image.fits', 'pb.fits')))
+
+
 @extras(packages="astropy")
 def worker(pipeline, recipe, config):
 
@@ -117,30 +144,6 @@ def worker(pipeline, recipe, config):
 
         fits.writeto(out_beam, gaussian, hdr, overwrite=True)
 
-    # Copied from line_worker.py and edited. This is to get a Mauchian beam.
-    # The original version makes the build_beam function above redundant but I do not want to change too many things at once.
-    def make_mauchian_pb(filename, freq):  # pbtype):
-        with fits.open(filename) as image:
-            headimage = image[0].header
-            ang_offset = np.indices(
-                (headimage['naxis2'], headimage['naxis1']), dtype=np.float32)
-            ang_offset[0] -= (headimage['crpix2'] - 1)
-            ang_offset[1] -= (headimage['crpix1'] - 1)
-            ang_offset = np.sqrt((ang_offset**2).sum(axis=0))  # Using offset in x and y direction to calculate the total offset from the pointing centre
-            ang_offset = ang_offset * np.abs(headimage['cdelt1'])  # Now offset is in units of deg
-            # if pbtype == 'gaussian':
-            #    sigma_pb = 17.52 / (freq / 1e+9) / dish_size / 2.355
-            #    sigma_pb.resize((sigma_pb.shape[0], 1, 1))
-            #    datacube = np.exp(-datacube**2 / 2 / sigma_pb**2)
-            # elif pbtype == 'mauchian':
-            FWHM_pb = (57.5 / 60) * (freq / 1.5e9)**-1  # Eqn 4 of Mauch et al. (2020), but in deg   # freq is just a float for the 2D case
-            pb_image = (np.cos(1.189 * np.pi * (ang_offset / FWHM_pb)) / (
-                1 - 4 * (1.189 * ang_offset / FWHM_pb)**2))**2  # Eqn 3 of Mauch et al. (2020)
-            fits.writeto(filename.replace('image.fits', 'pb.fits'),
-                         pb_image, header=headimage, overwrite=True)
-            caracal.log.info('Created Mauchian primary-beam  FITS {0:s}'.format(
-                filename.replace('image.fits', 'pb.fits')))
-
     def consistent_cdelt3(image_filenames, input_directory, nrdecimals):
         cdelt3s = []
         for ff in image_filenames:
@@ -2,7 +2,6 @@
 import os
 import sys
 import caracal
-from caracal.dispatch_crew.utils import closeby
 import caracal.dispatch_crew.caltables as mkct
 import numpy as np
 from caracal.workers.utils import manage_flagsets as manflags
@@ -23,28 +22,28 @@ def getfield_coords(info, field, db, tol=2.9E-3, tol_diff=4.8481E-6):
     field (str): field name
     db (dict):   calibrator data base as returned by
                  calibrator_database()
-    Go through all calibrators in db and return the first that matches
-    the coordinates of field in msinfo. Return empty string if not
-    found.
-    If coordinates difference is larger than tol_diff, return the correct coordinates, else return empty string.
+    Return the first calibrator in db within an angular distance tol
+    (rad) of the delay direction of field in msinfo, with its database
+    coordinates. Return None, None, None if not found.
+    If coordinates difference is larger than tol_diff, return the correct coordinates, else return None, None, None.
     """
 
-    # Get position of field in msinfo
-    ind = info['FIELD']['NAME'].index(field)
-    firade = info['FIELD']['DELAY_DIR'][ind][0]
-    firade[0] = np.mod(firade[0], 2 * np.pi)
-    dbcp = db.db
+    # Crossmatch of all fields of the MS, done once per database
+    info = utils.MSInfo.from_info(info)
+    ind = info.index(field)
+    key = info.calibrator_matches(db, tol)[ind]
     caracal.log.info("Checking for crossmatch")
-    caracal.log.info("Database keys:", dbcp.keys())
-    for key in dbcp.keys():
-        carade = [dbcp[key]['ra'], dbcp[key]['decl']]
-        if closeby(carade, firade, tol=tol):
-            if not closeby(carade, firade, tol=tol_diff):
-                return key, dbcp[key]['ra'], dbcp[key]['decl']
-            else:
-                caracal.log.info("Calibrator coordinates match within the specified tolerance.")
-                return None, None, None
-    return None, None, None
+    if key is None:
+        return None, None, None
+    src = db.db[key]
+    firade = info.delay_dirs[ind]
+    chord = np.linalg.norm(db.unit_vectors(*firade) - db.unit_vectors(src['ra'], src['decl']))
+    offset = 2 * np.arcsin(chord / 2)
+    if not offset < tol_diff:
+        return key, src['ra'], src['decl']
+    else:
+        caracal.log.info("Calibrator coordinates match within the specified tolerance.")
+        return None, None, None
 
 
 def worker(pipeline, recipe, config):
@@ -7,7 +7,13 @@ import caracal
 import shutil
 import argparse
 import time
+import threading
+import json
+import contextlib
+import multiprocessing
 from collections import OrderedDict
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor
 import matplotlib.dates as mdat
 from matplotlib import gridspec
 from matplotlib import rc
@@ -20,6 +26,7 @@ import casacore.tables as tables
 import stimela.recipe
 import sys
 import os
+import psutil
 import numpy as np
 import yaml
 from caracal.utils.requires import extras
@@ -29,13 +36,150 @@ dm = measures.measures()
 
 timeInit = time.time()
 
+# Flagger, pipeline and scan jobs of the running scan pool, inherited by its forked workers
+_scanPool = None
+
+
+def _analyseScan(kk):
+    """Run UzeroFlagger.analyseScan on scan job kk in a scan pool worker"""
+    flagger, pipeline, scanJobs = _scanPool
+    return flagger.analyseScan(pipeline, *scanJobs[kk])
+
+
+# Style of the diagnostic plots
+PLOT_PARAMS = {'figure.autolayout': True,
+               'font.family': 'serif',
+               'figure.facecolor': 'white',
+               'pdf.fonttype': 3,
+               'font.serif': 'times',
+               'font.style': 'normal',
+               'font.weight': 'book',
+               'font.size': 16,
+               'axes.linewidth': 1.5,
+               'lines.linewidth': 1,
+               'xtick.labelsize': 16,
+               'ytick.labelsize': 16,
+               'legend.fontsize': 16,
+               'xtick.direction': 'in',
+               'ytick.direction': 'in',
+               'xtick.major.size': 3,
+               'xtick.major.width': 1.5,
+               'xtick.minor.size': 2.5,
+               'xtick.minor.width': 1.,
+               'ytick.major.size': 3,
+               'ytick.major.width': 1.5,
+               'ytick.minor.size': 2.5,
+               'ytick.minor.width': 1.,
+               'text.usetex': False
+               }
+
+
+@extras(packages="astropy")
+def drawPanel(fig, gs, NS, kk, panel, common_vmax):
+    """Draw row kk of NS rows of a diagnostic figure from the artefact panel"""
+    from astropy import units as u
+    from astropy.coordinates import SkyCoord
+    from astropy.io import fits
+    from astropy.wcs import WCS
+
+    fitsim = panel['image']
+    fitswcs = WCS(fits.Header.fromstring(panel['wcs']))
+    rms1 = np.std(fitsim)
+    scan, percent, ctff, type = panel['scan'], panel['percent'], panel['ctff'], panel['type']
+
+    ax = fig.add_subplot(gs[kk, 0], projection=fitswcs)
+    ax.imshow(fitsim, cmap='Greys', vmin=-rms1, vmax=2 * rms1)
+    if scan != 0:
+        ax.annotate("Scan: " + str(scan) + r" rms = " + str(np.round(rms1 * 1e6, 3)) + r" $\mu$Jyb$^{-1}$", xy=(0.05, 0.95), xycoords='axes fraction', horizontalalignment='left', verticalalignment='top', backgroundcolor='w', fontsize=12)
+    else:
+        ax.annotate("rms = " + str(np.round(rms1 * 1e6, 3)) + r" $\mu$Jyb$^{-1}$", xy=(0.05, 0.95), xycoords='axes fraction', horizontalalignment='left', verticalalignment='top', backgroundcolor='w', fontsize=12)
+    if type == 'postFlag':
+        ax.annotate(r"Flags {percent} $\%$".format(percent=str(np.round(percent, 2))), xy=(0.95, 0.05), xycoords='axes fraction', horizontalalignment='right', verticalalignment='bottom', backgroundcolor='w', fontsize=12)
+
+    lon = ax.coords[0]
+    lat = ax.coords[1]
+    c = SkyCoord('00:02:00.', '00:01:00.0', unit=(u.hourangle, u.deg))
+    lon.set_ticks(spacing=c.ra.degree * u.degree)
+    lat.set_ticks(spacing=c.ra.degree * u.degree)
+
+    lon.set_auto_axislabel(False)
+    lat.set_auto_axislabel(False)
+    lon.set_ticklabel(exclude_overlapping=True)
+    lat.set_ticklabel(exclude_overlapping=True)
+
+    if kk == NS / 2 or kk == NS / 2 + 1 or (kk == 0 and NS == 1):
+        lat.set_axislabel(r'Dec  (J2000)')
+        lat.set_ticklabel_visible(True)
+    else:
+        lat.set_ticklabel_visible(True)
+    if kk == NS - 1:
+        lon.set_axislabel(r'RA  (J2000)')
+        lon.set_ticklabel_visible(True)
+    else:
+        lon.set_ticklabel_visible(False)
+
+    udelt, vdelt, w = panel['udelt'], panel['vdelt'], panel['w']
+    ax.set_autoscale_on(False)
+
+    ax2 = fig.add_subplot(gs[kk, 1])
+    extent = [-w * udelt, w * udelt, -w * vdelt, w * vdelt]
+    ax2.imshow(panel['fft'], vmin=0, vmax=common_vmax, extent=extent, origin='upper')
+    if ctff:
+        ax2.contour(panel['fft'], levels=[ctff,], colors=['r'], linewidths=[1,], extent=extent, origin='upper')
+
+    ax2.yaxis.set_label_position("right")
+    ax2.yaxis.tick_right()
+    ax2.yaxis.set_ticks_position('right')
+
+    if kk == NS - 1:
+        ax2.set_xlabel(r'u [$\lambda$]')
+        ax2.set_xticks([-1500, 0, 1500])
+    else:
+        ax2.set_xticks([])
+    if kk == NS / 2 or kk == NS / 2 + 1 or (kk == 0 and NS == 1):
+        ax2.set_ylabel(r'v [$\lambda$]')
+
+    ax2.set_xlim(-2000, 2000)
+    ax2.set_ylim(-2000, 2000)
+    ax2.set_yticks([-1500, 0, 1500])
+
+    ax2.set_autoscale_on(False)
+
+
+def renderPlot(artefact):
+    """Render a diagnostic figure from the artefact saved by UzeroFlagger.savePlot
+
+    Returns:
+        name of the saved plot
+    """
+    with np.load(artefact) as stored:
+        meta = json.loads(str(stored['meta']))
+        panels = meta['panels']
+        for kk, panel in enumerate(panels):
+            panel['image'] = stored['image{0:d}'.format(kk)]
+            panel['fft'] = stored['fft{0:d}'.format(kk)]
+
+    plt.rcParams.update(PLOT_PARAMS)
+    NS = len(panels)
+    fig = plt.figure(figsize=meta['figsize'], constrained_layout=False)
+    fig.set_tight_layout(False)
+    gs = gridspec.GridSpec(nrows=NS, ncols=2, figure=fig, hspace=0, wspace=0.0)
+    for kk, panel in enumerate(panels):
+        drawPanel(fig, gs, NS, kk, panel, meta['common_vmax'])
+    fig.subplots_adjust(left=0.05, bottom=0.05, right=0.97, top=0.97, wspace=0, hspace=0)
+    fig.savefig(meta['outPlot'], bbox_inches='tight', dpi=200)   # save the figure to file
+    plt.close(fig)
+
+    return meta['outPlot']
+
+
 class UzeroFlagger:
-    global u, SkyCoord, astviz, WCS, Table, Column, fits, astasc
-    global optimize, scconstants, stats
 
-    
     @extras(packages=["astropy", "scipy"])
     def __init__(self, config):
+        # Optional dependencies, made available to all methods
+        global u, SkyCoord, astviz, WCS, Table, Column, fits, astasc
+        global optimize, scconstants, stats
         from astropy import units as u
         from astropy.coordinates import SkyCoord
         import astropy.visualization as astviz
@@ -48,6 +192,10 @@ class UzeroFlagger:
         from scipy import stats
 
         self.config = config
+        # Serialises flag writes to an MS shared by the processes of the scan pool
+        self.writeLock = contextlib.nullcontext()
+        # Diagnostic plots rendered in the background
+        self.plotPool, self.plotJobs = None, []
 
     def setDirs(self, output):
 
@@ -196,6 +344,95 @@ class UzeroFlagger:
 
         return scanVisList, scanVisNames
 
+    def scanRanges(self, scans, timestamps):
+        """Return the rows and the time-step interval of each scan
+
+        scans and timestamps are the SCAN_NUMBER and TIME columns of an
+        MS. The rows of each scan are returned in increasing order, the
+        interval as [first, last + 1) index into the sorted unique time
+        stamps, as understood by wsclean -interval.
+        """
+        order = np.argsort(scans, kind='stable')
+        scanNums, starts = np.unique(scans[order], return_index=True)
+        timeSteps = np.unique(timestamps, return_inverse=True)[1]
+
+        scanRows, scanIntervals = [], []
+        for rows in np.split(order, starts[1:]):
+            scanRows.append(rows)
+            scanIntervals.append([int(timeSteps[rows].min()), int(timeSteps[rows].max()) + 1])
+
+        return scanNums, scanRows, scanIntervals
+
+    def getScanFlags(self, inVis, rows):
+        """Read the flags of the given rows of inVis into memory"""
+        t = tables.table(inVis, ack=False)
+        scanTab = t.selectrows(rows)
+        flags = scanTab.getcol('FLAG')
+        scanTab.close()
+        t.close()
+        return flags
+
+    def putScanFlags(self, inVis, rows, flags):
+        """Write flags to the given rows of inVis"""
+        with self.writeLock:
+            t = tables.table(inVis, readonly=False, ack=False)
+            scanTab = t.selectrows(rows)
+            scanTab.putcol('FLAG', flags)
+            scanTab.close()
+            t.close()
+
+    def chunkFlags(self, t, update=None, chunkSize=2**27, prefetch=False):
+        """Read, and optionally modify and write, the FLAG column of t in chunks
+
+        The rows of table t are processed in chunks of roughly chunkSize
+        bytes of flags, such that the memory used does not depend on the
+        size of the MS. update(startRow, flags) is called for each chunk
+        and modifies the boolean flags in place, which are then written
+        back. With prefetch, the next chunk is read in a background
+        thread while the current one is processed.
+
+        Returns:
+            number of flagged visibilities before and after the update,
+            and total number of visibilities
+        """
+        nRows = t.nrows()
+        if not nRows:
+            return 0, 0, 0
+        chunkRows = max(1, int(chunkSize // max(1, t.getcell('FLAG', 0).size)))
+        starts = range(0, nRows, chunkRows)
+
+        # Reads and writes to the table must not overlap
+        lock = threading.Lock()
+
+        def readChunk(startRow):
+            with lock:
+                return t.getcol('FLAG', startRow, min(chunkRows, nRows - startRow))
+
+        nBefore, nAfter, nVis = 0, 0, 0
+        pool = ThreadPoolExecutor(max_workers=1) if prefetch else None
+        try:
+            if pool:
+                nextChunk = pool.submit(readChunk, starts[0])
+            for ii, startRow in enumerate(starts):
+                if pool:
+                    flags = nextChunk.result()
+                    if ii + 1 < len(starts):
+                        nextChunk = pool.submit(readChunk, starts[ii + 1])
+                else:
+                    flags = readChunk(startRow)
+                nVis += flags.size
+                nBefore += np.count_nonzero(flags)
+                if update is not None:
+                    update(startRow, flags)
+                    with lock:
+                        t.putcol('FLAG', flags, startRow, flags.shape[0])
+                nAfter += np.count_nonzero(flags)
+        finally:
+            if pool:
+                pool.shutdown()
+
+        return nBefore, nAfter, nVis
+
     def gaussian(self, x, cent, amp, sigma):
         """
         Gaussian function
@@ -221,7 +458,7 @@ class UzeroFlagger:
 
         return data, flags
 
-    def makeCube(self, pipeline, msdir, inVis, outCubePrefix, kind='scan'):
+    def makeCube(self, pipeline, msdir, inVis, outCubePrefix, kind='scan', interval=None):
 
         robust = self.config['flag_u_zeros']['robust']
         imsize = int(self.config['flag_u_zeros']['imsize'])
@@ -269,6 +506,10 @@ class UzeroFlagger:
         if self.config['flag_u_zeros']['taper']:
             line_image_opts.update({"taper-gaussian": str(self.config['flag_u_zeros']['taper'])})
 
+        # Image only the time steps of one scan
+        if interval is not None:
+            line_image_opts.update({"interval": interval})
+
         step = 'makeCube'
         recipe.add('cab/wsclean',
                    step, line_image_opts,
@@ -300,19 +541,7 @@ class UzeroFlagger:
     def makeFFT(self, inCube):
 
         with fits.open(inCube) as hdul:
-            hdu = hdul[0]
-            dFFT = np.abs(np.fft.fftshift(np.fft.fft2(np.squeeze(hdu.data))))
-            hdr = fits.Header()
-            hdr["CTYPE1"] = 'UU---SIN'
-            hdr["CDELT1"] = 1 / (np.deg2rad(hdu.header["NAXIS1"] * hdu.header["CDELT1"]))
-            hdr["CRVAL1"] = 0
-            hdr["CRPIX1"] = hdu.header["NAXIS1"] / 2
-            hdr["CUNIT1"] = 'lambda'
-            hdr["CTYPE2"] = 'VV---SIN'
-            hdr["CDELT2"] = 1 / (np.deg2rad(hdu.header["NAXIS2"] * hdu.header["CDELT2"]))
-            hdr["CRVAL2"] = 0
-            hdr["CRPIX2"] = hdu.header["NAXIS2"] / 2
-            hdr["CUNIT2"] = 'lambda'
+            dFFT, hdr = self.imageFFT(np.squeeze(hdul[0].data), hdul[0].header)
 
         caracal.log.info('\tFFT cell size = {0:.2f}'.format(hdr['CDELT2']))
         caracal.log.info("FFT Done")
@@ -320,79 +549,250 @@ class UzeroFlagger:
 
         return dFFT, hdr
 
-    def plotAll(self, fig, gs, NS, kk, outCubeName, inFFTData, inFFTHeader, galaxy, track, scan, percent, common_vmax, ctff, type=None):
+    def imageFFT(self, image, imHeader):
+        """Return the FFT amplitudes of a 2D image and their header"""
+        dFFT = np.abs(np.fft.fftshift(np.fft.fft2(image)))
+        hdr = fits.Header()
+        hdr["CTYPE1"] = 'UU---SIN'
+        hdr["CDELT1"] = 1 / (np.deg2rad(imHeader["NAXIS1"] * imHeader["CDELT1"]))
+        hdr["CRVAL1"] = 0
+        hdr["CRPIX1"] = imHeader["NAXIS1"] / 2
+        hdr["CUNIT1"] = 'lambda'
+        hdr["CTYPE2"] = 'VV---SIN'
+        hdr["CDELT2"] = 1 / (np.deg2rad(imHeader["NAXIS2"] * imHeader["CDELT2"]))
+        hdr["CRVAL2"] = 0
+        hdr["CRPIX2"] = imHeader["NAXIS2"] / 2
+        hdr["CUNIT2"] = 'lambda'
+        return dFFT, hdr
 
-        fitsdata = fits.open(outCubeName)
-        fitsim = fitsdata[0].data[0, 0]
-        fitshdr = fitsdata[0].header
-        fitswcs = WCS(fitshdr).sub(2)
-        rms1 = np.std(fitsim)
+    def gridVis(self, inVis, rows=None, chunkSize=2**27):
+        """Grid the Stokes-I visibilities of inVis onto the uv plane
+
+        The visibilities of the channels in the chans range of the
+        flag_u_zeros section are gridded with their natural weights
+        onto the uv cells of an imsize x imsize image with the
+        configured cell size, using nearest-neighbour gridding without
+        w-term or padding. Both the visibilities and their complex
+        conjugates are gridded, such that the image is real. If rows is
+        given, only these rows of inVis (e.g. one scan) are gridded. The
+        data are read in chunks of roughly chunkSize bytes.
+
+        Returns:
+            weighted visibility sums and weight sums per uv cell
+            (imsize x imsize each), and the channel frequencies and
+            phase centre (deg) of the data
+        """
+        imsize = int(self.config['flag_u_zeros']['imsize'])
+        cell = float(self.config['flag_u_zeros']['cell']) / 3600.
+        chanMin = int(self.config['flag_u_zeros']['chans'][0])
+        chanMax = int(self.config['flag_u_zeros']['chans'][1])
+        duv = 1. / (imsize * np.deg2rad(cell))
 
-        ax = fig.add_subplot(gs[kk, 0], projection=fitswcs)
-        ax.imshow(fitsim, cmap='Greys', vmin=-rms1, vmax=2 * rms1)
-        if scan != 0:
-            ax.annotate("Scan: " + str(scan) + r" rms = " + str(np.round(rms1 * 1e6, 3)) + r" $\mu$Jyb$^{-1}$", xy=(0.05, 0.95), xycoords='axes fraction', horizontalalignment='left', verticalalignment='top', backgroundcolor='w', fontsize=12)
-        else:
-            ax.annotate("rms = " + str(np.round(rms1 * 1e6, 3)) + r" $\mu$Jyb$^{-1}$", xy=(0.05, 0.95), xycoords='axes fraction', horizontalalignment='left', verticalalignment='top', backgroundcolor='w', fontsize=12)
-        if type == 'postFlag':
-            ax.annotate(r"Flags {percent} $\%$".format(percent=str(np.round(percent, 2))), xy=(0.95, 0.05), xycoords='axes fraction', horizontalalignment='right', verticalalignment='bottom', backgroundcolor='w', fontsize=12)
-
-        lon = ax.coords[0]
-        lat = ax.coords[1]
-        c = SkyCoord('00:02:00.', '00:01:00.0', unit=(u.hourangle, u.deg))
-        lon.set_ticks(spacing=c.ra.degree * u.degree)
-        lat.set_ticks(spacing=c.ra.degree * u.degree)
-
-        lon.set_auto_axislabel(False)
-        lat.set_auto_axislabel(False)
-        lon.set_ticklabel(exclude_overlapping=True)
-        lat.set_ticklabel(exclude_overlapping=True)
-
-        if kk == NS / 2 or kk == NS / 2 + 1 or (kk == 0 and NS == 1):
-            lat.set_axislabel(r'Dec  (J2000)')
-            lat.set_ticklabel_visible(True)
-        else:
-            lat.set_ticklabel_visible(True)
-        if kk == NS - 1:
-            lon.set_axislabel(r'RA  (J2000)')
-            lon.set_ticklabel_visible(True)
+        t = tables.table(inVis, ack=False)
+        tSel = t.selectrows(rows) if rows is not None else t
+        dataCol = 'CORRECTED_DATA' if 'CORRECTED_DATA' in t.colnames() else 'DATA'
+
+        spw = tables.table(inVis + '/SPECTRAL_WINDOW', ack=False)
+        freqs = spw.getcol('CHAN_FREQ')[0, chanMin:chanMax]
+        spw.close()
+        pol = tables.table(inVis + '/POLARIZATION', ack=False)
+        corrTypes = pol.getcol('CORR_TYPE')[0]
+        pol.close()
+        field = tables.table(inVis + '/FIELD', ack=False)
+        phaseDir = np.rad2deg(field.getcol('PHASE_DIR')[(tSel if tSel.nrows() else t).getcell('FIELD_ID', 0), 0])
+        field.close()
+
+        # Stokes I from the I, RR/LL or XX/YY correlations
+        iCorrs = np.where(np.isin(corrTypes, [1, 5, 8, 9, 12]))[0]
+        blc, trc = [chanMin, iCorrs.min()], [chanMax - 1, iCorrs.max()]
+        iCorrs = iCorrs - iCorrs.min()
+
+        gridVis = np.zeros(imsize * imsize, dtype=complex)
+        gridWeight = np.zeros(imsize * imsize)
+        chunkRows = max(1, int(chunkSize // (freqs.size * (trc[1] - blc[1] + 1) * 16)))
+        for startRow in range(0, tSel.nrows(), chunkRows):
+            nRow = min(chunkRows, tSel.nrows() - startRow)
+            uvw = tSel.getcol('UVW', startRow, nRow)
+            cross = tSel.getcol('ANTENNA1', startRow, nRow) != tSel.getcol('ANTENNA2', startRow, nRow)
+            cross &= ~tSel.getcol('FLAG_ROW', startRow, nRow)
+            data = tSel.getcolslice(dataCol, blc, trc, [], startRow, nRow)[:, :, iCorrs]
+            flags = tSel.getcolslice('FLAG', blc, trc, [], startRow, nRow)[:, :, iCorrs].any(axis=2)
+            corrWeight = tSel.getcol('WEIGHT', startRow, nRow)[:, iCorrs]
+
+            # Inverse variance of the average of the correlations
+            with np.errstate(divide='ignore'):
+                weight = iCorrs.size**2 / (1. / corrWeight).sum(axis=1)
+            weight = np.where(cross, weight, 0.)[:, None] * ~flags
+            vis = np.where(weight > 0, data.mean(axis=2), 0.) * weight
+
+            for sign in [1, -1]:
+                iu = np.rint(imsize // 2 - sign * uvw[:, 0, None] * freqs / scconstants.c / duv).astype(np.int64)
+                iv = np.rint(imsize // 2 + sign * uvw[:, 1, None] * freqs / scconstants.c / duv).astype(np.int64)
+                inside = (weight > 0) & (iu >= 0) & (iu < imsize) & (iv >= 0) & (iv < imsize)
+                cellIndex = iv[inside] * imsize + iu[inside]
+                cellVis = vis[inside] if sign == 1 else np.conj(vis[inside])
+                gridVis.real += np.bincount(cellIndex, cellVis.real, imsize * imsize)
+                gridVis.imag += np.bincount(cellIndex, cellVis.imag, imsize * imsize)
+                gridWeight += np.bincount(cellIndex, weight[inside], imsize * imsize)
+        if rows is not None:
+            tSel.close()
+        t.close()
+
+        return gridVis.reshape(imsize, imsize), gridWeight.reshape(imsize, imsize), freqs, phaseDir
+
+    def dirtyImage(self, gridVis, gridWeight, freqs, phaseDir):
+        """Make a dirty image from the output of gridVis
+
+        Briggs weighting per uv cell and the Gaussian taper of the
+        flag_u_zeros section are applied before the inverse FFT.
+
+        Returns:
+            dirty image (imsize x imsize) in Jy/beam and its header
+        """
+        robust = float(self.config['flag_u_zeros']['robust'])
+        cell = float(self.config['flag_u_zeros']['cell']) / 3600.
+        taper = self.config['flag_u_zeros']['taper']
+        imsize = gridVis.shape[0]
+        duv = 1. / (imsize * np.deg2rad(cell))
+
+        # Briggs weighting per cell, and Gaussian taper
+        imWeight = np.zeros(gridWeight.shape)
+        if gridWeight.sum() > 0:
+            f2 = (5 * 10**-robust)**2 / ((gridWeight**2).sum() / gridWeight.sum())
+            imWeight = 1. / (1. + gridWeight * f2)
+        if taper:
+            uu, vv = np.meshgrid((np.arange(imsize) - imsize // 2) * duv, (np.arange(imsize) - imsize // 2) * duv)
+            imWeight *= np.exp(-(np.pi * np.deg2rad(float(taper) / 3600.))**2 * (uu**2 + vv**2) / (4 * np.log(2)))
+        sumWeight = (gridWeight * imWeight).sum()
+
+        dirty = np.fft.fftshift(np.fft.ifft2(np.fft.ifftshift(gridVis * imWeight))).real
+        if sumWeight > 0:
+            dirty *= imsize * imsize / sumWeight
+
+        imHeader = fits.PrimaryHDU(dirty[None, None].astype(np.float32)).header
+        for ax, (ctype, crpix, cdelt, crval) in enumerate([
+                ('RA---SIN', imsize // 2 + 1, -cell, phaseDir[0] % 360.),
+                ('DEC--SIN', imsize // 2 + 1, cell, phaseDir[1]),
+                ('FREQ', 1, freqs[-1] - freqs[0] if freqs.size > 1 else 1., freqs.mean()),
+                ('STOKES', 1, 1, 1)]):
+            imHeader['CTYPE{:d}'.format(ax + 1)] = ctype
+            imHeader['CRPIX{:d}'.format(ax + 1)] = crpix
+            imHeader['CDELT{:d}'.format(ax + 1)] = cdelt
+            imHeader['CRVAL{:d}'.format(ax + 1)] = crval
+        imHeader['BUNIT'] = 'JY/BEAM'
+
+        return dirty, imHeader
+
+    def gridImage(self, inVis, rows=None):
+        """Make a dirty image of inVis by gridding it in-process
+
+        Stand-in for makeCube that needs no container (see gridVis and
+        dirtyImage). Its FFT amplitudes are what makeFFT derives from a
+        wsclean image.
+
+        Returns:
+            dirty image (imsize x imsize) in Jy/beam and its header
+        """
+        return self.dirtyImage(*self.gridVis(inVis, rows))
+
+    def previewImage(self, pipeline, msdir, visName, visAddress, outCubePrefix, rows=None, interval=None):
+        """Image a (scan of an) MS for the stripe analysis and FFT the image
+
+        Depending on flag_u_zeros: imager the image is made with wsclean
+        (makeCube) or gridded in-process (gridImage). In the latter
+        case a FITS file is only written if plots are made.
+
+        Returns:
+            FFT amplitudes, FFT header, image rms and image file name
+        """
+        outCubeName = self.config['flag_u_zeros']['stripeCubeDir'] + outCubePrefix + '-dirty.fits'
+        if os.path.exists(outCubeName):
+            os.remove(outCubeName)
+
+        if self.config['flag_u_zeros'].get('imager', 'wsclean') == 'gridder':
+            dirty, imHeader = self.gridImage(visAddress, rows)
+            if self.config['flag_u_zeros']['make_plots']:
+                fits.writeto(outCubeName, dirty[None, None].astype(np.float32), imHeader)
+            caracal.log.info("Making FFT of image")
+            inFFTData, inFFTHeader = self.imageFFT(dirty, imHeader)
+            rms = np.std(dirty)
         else:
-            lon.set_ticklabel_visible(False)
+            self.makeCube(pipeline, msdir, visName, outCubePrefix, interval=interval)
+            with fits.open(outCubeName) as fitsdata:
+                rms = np.std(fitsdata[0].data[0, 0])
+            caracal.log.info("Making FFT of image")
+            inFFTData, inFFTHeader = self.makeFFT(outCubeName)
+
+        return inFFTData, inFFTHeader, rms, outCubeName
+
+    def plotPanel(self, outCubeName, inFFTData, inFFTHeader, scan, percent, ctff, type=None):
+        """Return the compact artefact from which a diagnostic panel is drawn
+
+        The panel shows the image outCubeName and the central +/- 2000
+        lambda of the FFT amplitudes inFFTData. Only these arrays, the
+        celestial WCS of the image and the annotations are kept, such
+        that the plot can be rendered later by drawPanel.
+        """
+        with fits.open(outCubeName) as fitsdata:
+            fitsim = np.array(fitsdata[0].data[0, 0], dtype=np.float32)
+            fitswcs = WCS(fitsdata[0].header).sub(2)
 
         udelt = inFFTHeader['CDELT1']
         vdelt = inFFTHeader['CDELT2']
-        ax.set_autoscale_on(False)
-
-        ax2 = fig.add_subplot(gs[kk, 1])
         w = int(2000. / vdelt)
         cx, cy = inFFTData.shape[0] // 2, inFFTData.shape[1] // 2
-        extent = [-w * udelt, w * udelt, -w * vdelt, w * vdelt]
+
+        return {'image': fitsim,
+                'wcs': fitswcs.to_header().tostring(),
+                'fft': np.array(inFFTData[cx - w:cx + w + 1, cy - w:cy + w + 1], dtype=np.float32),
+                'udelt': float(udelt), 'vdelt': float(vdelt), 'w': w,
+                'scan': int(scan), 'percent': None if percent is None else float(percent),
+                'ctff': float(ctff), 'type': type}
+
+    def savePlot(self, outPlot, panels, figsize, common_vmax=0):
+        """Store the artefacts of a figure of diagnostic panels next to outPlot
+
+        The panels are written to outPlot with extension .npz, and
+        rendered to outPlot in the background or left for rendering on
+        demand (renderPlot), depending on flag_u_zeros: render_plots.
+        If common_vmax is 0, the FFT colour scale is set by the first
+        panel.
+
+        Returns:
+            the FFT colour scale of the figure
+        """
         if common_vmax == 0:
-            common_vmax = np.nanpercentile(inFFTData[cx - w:cx + w + 1, cy - w:cy + w + 1], 99)
-        fftim = ax2.imshow(inFFTData[cx - w:cx + w + 1, cy - w:cy + w + 1], vmin=0, vmax=common_vmax, extent=extent, origin='upper')
-        if ctff:
-            ax2.contour(inFFTData[cx - w:cx + w + 1, cy - w:cy + w + 1], levels=[ctff,], colors=['r'], linewidths=[1,], extent=extent, origin='upper')
-
-        ax2.yaxis.set_label_position("right")
-        ax2.yaxis.tick_right()
-        ax2.yaxis.set_ticks_position('right')
-
-        if kk == NS - 1:
-            ax2.set_xlabel(r'u [$\lambda$]')
-            ax2.set_xticks([-1500, 0, 1500])
+            common_vmax = float(np.nanpercentile(panels[0]['fft'], 99))
+
+        arrays = {}
+        meta = {'outPlot': outPlot, 'figsize': list(figsize), 'common_vmax': common_vmax, 'panels': []}
+        for kk, panel in enumerate(panels):
+            arrays['image{0:d}'.format(kk)] = panel['image']
+            arrays['fft{0:d}'.format(kk)] = panel['fft']
+            meta['panels'].append({key: value for key, value in panel.items() if key not in ['image', 'fft']})
+        artefact = os.path.splitext(outPlot)[0] + '.npz'
+        np.savez_compressed(artefact, meta=json.dumps(meta), **arrays)
+
+        if self.config['flag_u_zeros'].get('render_plots', 'background') == 'background':
+            if self.plotPool is None:
+                self.plotPool = concurrent.futures.ProcessPoolExecutor(self.nWorkers())
+            self.plotJobs.append(self.plotPool.submit(renderPlot, artefact))
         else:
-            ax2.set_xticks([])
-        if kk == NS / 2 or kk == NS / 2 + 1 or (kk == 0 and NS == 1):
-            ax2.set_ylabel(r'v [$\lambda$]')
+            caracal.log.info("Plot artefact saved to {0:s}, render it with: python -m caracal.workers.utils.flag_Uzeros {0:s}".format(artefact))
 
-        ax2.set_xlim(-2000, 2000)
-        ax2.set_ylim(-2000, 2000)
-        ax2.set_yticks([-1500, 0, 1500])
+        return common_vmax
 
-        ax2.set_autoscale_on(False)
-        fig.subplots_adjust(left=0.05, bottom=0.05, right=0.97, top=0.97, wspace=0, hspace=0)
-
-        return fig, common_vmax
+    def finishPlots(self):
+        """Wait for the plots rendered in the background"""
+        if self.plotPool is None:
+            return
+        caracal.log.info("Waiting for {0:d} diagnostic plot(s) to be rendered".format(len(self.plotJobs)))
+        try:
+            for job in self.plotJobs:
+                caracal.log.info("Plot saved to {0:s}".format(job.result()))
+        finally:
+            self.plotPool.shutdown()
+            self.plotPool, self.plotJobs = None, []
 
     def baselineStats(self, galaxy, flags, uvw, avspecchan):
 
@@ -453,41 +853,127 @@ class UzeroFlagger:
 
         return 0
 
-    def saveFFTTable(self, inFFT, inFFTHeader, visName, U, V, galaxy, msid, track, scan, el, az, method, threshold, dilateU, dilateV, makePlots):
+    def fftTable(self, inFFT, U, V):
+        """Return the FFT amplitudes inFFT[V, U] as a table of cells"""
+        namBins = tuple(['BIN_ID', 'U', 'V', 'Amp'])
+        tabArr = np.zeros([len(U) * len(V)], dtype={'names': namBins, 'formats': ('i4', 'f8', 'f8', 'f8')})
+        tabArr['BIN_ID'] = np.arange(len(tabArr))
+        tabArr['U'] = np.repeat(U, len(V))
+        tabArr['V'] = np.tile(V, len(U))
+        tabArr['Amp'] = inFFT[:len(V), :len(U)].T.ravel()
+        return tabArr
+
+    def analyseScan(self, pipeline, scan, visName, visAddress, scanMSDir, rows, interval, galaxy, mfsOb, track):
+        """Image, FFT and stripe-flag one scan
+
+        The scan is the MS visAddress (named visName in scanMSDir) or,
+        if rows is given, those rows of it, imaged over the time steps
+        in interval. In the latter case the initial flags of the rows are
+        restored after the post-flagging image is made, such that scans
+        can be analysed independently of each other.
+
+        Returns:
+            stats of the selected threshold, stripe flags of the rows of
+            the scan, percentage of rows flagged, cutoff, and the
+            diagnostic plot artefacts (plotPanel) before and after flagging
+            if plots are made
+        """
+        method = self.config['flag_u_zeros']['method']
+        makePlots = self.config['flag_u_zeros']['make_plots']
+        thresholds = self.config['flag_u_zeros']['thresholds']
+        dilateU = self.config['flag_u_zeros']['dilateU']
+        dilateV = self.config['flag_u_zeros']['dilateV']
 
-        xCol = np.zeros([len(U) * len(V)])
-        yCol = np.zeros([len(U) * len(V)])
-        BIN_ID = np.arange(0, len(U) * len(V), 1)
-        tabGen = np.column_stack([BIN_ID, xCol, yCol])
-        dt = np.dtype([('BIN_ID', np.int32), ('U', np.int32), ('V', np.int32)])
-        tabGen = np.array(list(map(tuple, tabGen)), dtype=dt)
+        caracal.log.info("----------------------------------------------------")
+        caracal.log.info("\tWorking on scan {}".format(str(scan)))
+        caracal.log.info("----------------------------------------------------")
 
-        namBins = tuple(['BIN_ID', 'U', 'V', 'Amp'])
+        # Keep the flags of this scan in memory, the stripe flags are applied to the full MS later
+        scanFlagBuffer = None
+        if rows is not None:
+            scanFlagBuffer = self.getScanFlags(visAddress, rows)
+
+        caracal.log.info("Imaging scan for stripe analysis")
+        outCubePrefix_0 = galaxy + track + '_scan' + str(scan)
+        inFFTData, inFFTHeader, rms_0, outCubeName_0 = self.previewImage(pipeline, scanMSDir, visName, visAddress, outCubePrefix_0, rows, interval)
 
-        tabArr = np.zeros([len(tabGen)], dtype={'names': namBins, 'formats': ('i4', 'f8', 'f8', 'f8')})
+        U = ((np.linspace(1, inFFTData.shape[1], inFFTData.shape[1]) - inFFTHeader['CRPIX1']) * inFFTHeader['CDELT1'] + inFFTHeader['CRVAL1'])
+        V = ((np.linspace(1, inFFTData.shape[1], inFFTData.shape[1]) - inFFTHeader['CRPIX2'] - 1) * inFFTHeader['CDELT2'] + inFFTHeader['CRVAL2'])
 
-        indexBin = 0
-        for i in range(0, len(U)):
-            for j in range(0, len(V)):
+        el = 0
+        az = 0
 
-                tabArr['BIN_ID'][indexBin] = indexBin
-                tabArr['U'][indexBin] = U[i]
-                tabArr['V'][indexBin] = V[j]
-                tabArr['Amp'][indexBin] = inFFT[j, i]
+        outCubePrefix = galaxy + track + '_scan' + str(scan) + '_stripeFlag'
 
-                indexBin += 1
+        # Select best threshold (minimum noise) without flagging or imaging
+        # Only the cutoff of the madThreshold method depends on the threshold
+        if len(thresholds) > 1 and method == 'madThreshold':
+            caracal.log.info('Sweeping over all requested thresholds {} to find the optimal one'.format(thresholds))
+            threshold, cutoff = self.sweepThresholds(inFFTData, inFFTHeader, visAddress, np.flip(U), V, galaxy, mfsOb, track, scan, method, thresholds, dilateU, dilateV, makePlots, rows=rows)
+            caracal.log.info('\tThe threshold that minimises the image noise is {}'.format(threshold))
+        else:
+            if len(thresholds) > 1:
+                caracal.log.info('The cutoff of method {0} does not depend on the threshold, not sweeping over thresholds {1}'.format(method, thresholds))
+            threshold, cutoff = thresholds[0], None
+
+        caracal.log.info("Computing statistics on FFT and flagging scan for threshold {0}".format(threshold))
+        # scanFlags below are the stripe flags for this scan
+        statsArray, scanFlags, percent, cutoff_scan = self.saveFFTTable(inFFTData, inFFTHeader, visAddress, np.flip(U), V, galaxy, mfsOb, track, scan, el, az, method, threshold, dilateU, dilateV, makePlots, rows=rows, cutoff=cutoff)
+        caracal.log.info("Scan flags from stripe-flagging: {percent:.3f}%".format(percent=percent))
+        caracal.log.info("Making post-flagging image")
+        postFFTData, postFFTHeader, rms, outCubeName = self.previewImage(pipeline, scanMSDir, visName, visAddress, outCubePrefix, rows, interval)
+        caracal.log.info("Image noise = {0:.3e} Jy/beam".format(rms))
+
+        # The stripe flags of all scans are applied to the full MS at once later
+        if scanFlagBuffer is not None:
+            self.putScanFlags(visAddress, rows, scanFlagBuffer)
+            del scanFlagBuffer
+
+        # Artefacts for the diagnostic plots before and after flagging
+        prePanel, postPanel = None, None
+        if makePlots:
+            prePanel = self.plotPanel(outCubeName_0, inFFTData, inFFTHeader, scan, None, cutoff_scan, type=None)
+            postPanel = self.plotPanel(outCubeName, postFFTData, postFFTHeader, scan, percent, 0, type='postFlag')
+
+        return statsArray, scanFlags, percent, cutoff_scan, prePanel, postPanel
+
+    def nWorkers(self):
+        """Number of worker processes, from the ncpu of flag_u_zeros or else of the line worker (0 = all CPUs)"""
+        ncpu = self.config['flag_u_zeros'].get('ncpu', 1) or self.config['ncpu']
+        return max(1, min(ncpu, psutil.cpu_count()) if ncpu else psutil.cpu_count())
+
+    def runScanPool(self, pipeline, scanJobs, nWorkers):
+        """Run analyseScan on scanJobs in nWorkers processes
+
+        The workers are forked, such that they inherit the flagger and
+        the pipeline rather than receiving them pickled, and share a lock
+        for writing flags, as concurrent writes to one MS can deadlock on
+        its table lock. The results are yielded in the order of scanJobs
+        as they become available.
+        """
+        global _scanPool
+        context = multiprocessing.get_context('fork')
+        _scanPool = (self, pipeline, scanJobs)
+        self.writeLock = context.Lock()
+        try:
+            with concurrent.futures.ProcessPoolExecutor(nWorkers, mp_context=context) as executor:
+                for scanResult in executor.map(_analyseScan, range(len(scanJobs))):
+                    yield scanResult
+        finally:
+            _scanPool = None
+            self.writeLock = contextlib.nullcontext()
+
+    def saveFFTTable(self, inFFT, inFFTHeader, visName, U, V, galaxy, msid, track, scan, el, az, method, threshold, dilateU, dilateV, makePlots, rows=None, cutoff=None):
+
+        tabArr = self.fftTable(inFFT, U, V)
 
         hdr = fits.Header()
         hdr['COMMENT'] = "This is the table of the FFT"
         hdr['COMMENT'] = "Ext 1 = FFT table"
 
-        if method == 'madThreshold':
-            cutoff = self.sunBlockStats(inFFT, galaxy, msid, track, scan, makePlots, 'mad', threshold, ax=None, title='', verb=True)
-        else:
-            if self.config['flag_u_zeros']['taper']:
-                cutoff = np.nanpercentile(tabArr['Amp'], 99.99)
-            else:
-                cutoff = np.nanpercentile(tabArr['Amp'], 99.9999)
+        # The cutoff may have been found by sweepThresholds already
+        if cutoff is None:
+            cutoff = self.fftCutoffs(inFFT, tabArr, galaxy, msid, track, scan, method, threshold, makePlots)
 
         empty_primary = fits.PrimaryHDU(header=hdr)
 
@@ -512,13 +998,73 @@ class UzeroFlagger:
         else:
             statsArray = [galaxy, track, scan, 0., cutoff, el, az]
         caracal.log.info("FFT Table saved")
-        caracal.log.info("Flagging scan".format(scanNumber=str(scan), galaxy=galaxy, track=track))
+        caracal.log.info("Flagging scan")
 
         # the following scanFlags are the stripe flags for this scan
-        scanFlags, percent = self.flagQuartile(visName, newtab, inFFTHeader, method, dilateU, dilateV, qrtdebug=False)
+        scanFlags, percent = self.flagQuartile(visName, newtab, inFFTHeader, method, dilateU, dilateV, qrtdebug=False, rows=rows)
 
         return statsArray, scanFlags, percent, cutoff
 
+    def fftCutoffs(self, inFFT, tabArr, galaxy, msid, track, scan, method, thresholds, makePlots):
+        """Return the amplitude cutoff of each of thresholds (or of one threshold)"""
+        if method == 'madThreshold':
+            return self.sunBlockStats(inFFT, galaxy, msid, track, scan, makePlots, 'mad', thresholds, ax=None, title='', verb=True)
+        if self.config['flag_u_zeros']['taper']:
+            cutoff = np.nanpercentile(tabArr['Amp'], 99.99)
+        else:
+            cutoff = np.nanpercentile(tabArr['Amp'], 99.9999)
+        return cutoff + 0. * np.asarray(thresholds, dtype=float)
+
+    def sweepThresholds(self, inFFT, inFFTHeader, visName, U, V, galaxy, msid, track, scan, method, thresholds, dilateU, dilateV, makePlots, rows=None):
+        """Find the threshold that minimises the noise of the flagged scan
+
+        The cutoffs of all thresholds follow from one pass of statistics
+        over the FFT amplitudes, and the rows each of them would flag are
+        found with matchCells without touching the MS. The post-flagging
+        noise of each candidate is estimated from the gridded scan
+        (gridVis), from which the contribution of the candidate's rows
+        is subtracted, so that no flags and no images are written.
+        The estimate always comes from the in-process gridder, whatever
+        the imager used for the scan images. Only useful for the
+        madThreshold method, as the cutoff of the others does not
+        depend on the threshold.
+
+        Returns:
+            selected threshold and its cutoff
+        """
+        tabArr = self.fftTable(inFFT, U, V)
+        cutoffs = self.fftCutoffs(inFFT, tabArr, galaxy, msid, track, scan, method, thresholds, makePlots)
+
+        t = tables.table(visName, ack=False)
+        tSel = t.selectrows(rows) if rows is not None else t
+        spw = tables.table(visName + '/SPECTRAL_WINDOW', ack=False)
+        avspecchan = np.average(spw.getcol('CHAN_FREQ'))
+        spw.close()
+        uv = tSel.getcol('UVW')[:, :2] * avspecchan / scconstants.c
+        if rows is not None:
+            tSel.close()
+        t.close()
+
+        caracal.log.info('Gridding scan in process (nearest-neighbour gridder, whatever the imager) to estimate the noise after flagging')
+        gridVis, gridWeight, freqs, phaseDir = self.gridVis(visName, rows)
+
+        rms = []
+        for threshold, cutoff in zip(thresholds, cutoffs):
+            index = np.where(tabArr['Amp'] >= cutoff)[0]
+            rowSel = self.matchCells(uv, tabArr['U'][index], tabArr['V'][index], inFFTHeader['CDELT2'], dilateU, dilateV)
+            flagRows = np.where(rowSel)[0] if rows is None else rows[rowSel]
+            if flagRows.size:
+                flagVis, flagWeight = self.gridVis(visName, flagRows)[:2]
+                dirty = self.dirtyImage(gridVis - flagVis, np.clip(gridWeight - flagWeight, 0., None), freqs, phaseDir)[0]
+            else:
+                dirty = self.dirtyImage(gridVis, gridWeight, freqs, phaseDir)[0]
+            rms.append(np.std(dirty))
+            caracal.log.info('\tthreshold {0}: cutoff = {1:.5f}, {2:.3f}% of rows flagged, gridder image noise = {3:.3e} Jy/beam'.format(
+                threshold, cutoff, float(flagRows.size) / max(1, uv.shape[0]) * 100., rms[-1]))
+
+        best = int(np.argmin(rms))
+        return thresholds[best], cutoffs[best]
+
     def plotSunblocker(self, bin_centers, bin_edges, npoints, widthes, average, stdev, med, mad, popt, hist, threshold, galaxy, msid, track, scan, cut):
 
         caracal.log.info("\tPlotting stats")
@@ -542,7 +1088,8 @@ class UzeroFlagger:
         ax.plot(showgouse, calculated, 'g-')
         ax.plot(showgouse, fitted, 'r-')
         ax.plot(showgouse, madded, 'b-')
-        ax.axvline(x=cut, linewidth=2, color='k')
+        for cutoff in np.atleast_1d(cut):
+            ax.axvline(x=cutoff, linewidth=2, color='k')
         ax.set_xlim(min(bin_edges), max(bin_edges))
         plt.legend(['avg,std: {0:.1e}, {1:.1e}'.format(average, stdev), 'fit:  {0:.1e}, {1:.1e}'.format(popt[0], popt[2]), 'med,mad: {0:.1e}, {1:.1e}'.format(med, mad)], loc='upper right')
         ax.set_ylim(0.5,)
@@ -617,86 +1164,125 @@ class UzeroFlagger:
         except NameError:
             makePlots = None
 
+        # One cutoff per threshold if several are given
+        cutoff = ave + np.asarray(threshold, dtype=float) * std
+
         if makePlots:
-            self.plotSunblocker(bin_centers, bin_edges, npoints, widthes, average, stdev, med, mad, popt, hist, threshold, galaxy, msid, track, scan, ave + float(threshold) * std)
+            self.plotSunblocker(bin_centers, bin_edges, npoints, widthes, average, stdev, med, mad, popt, hist, threshold, galaxy, msid, track, scan, cutoff)
         else:
             caracal.log.warn('For some reasons I am not making the fftstats plots!')
 
-        caracal.log.info("FFT image flagging cutoff = median + {threshold} * mad = {cutoff:.5f}".format(threshold=float(threshold), cutoff=ave + float(threshold) * std))
+        for thresh, cut in zip(np.atleast_1d(threshold), np.atleast_1d(cutoff)):
+            caracal.log.info("FFT image flagging cutoff = median + {threshold} * mad = {cutoff:.5f}".format(threshold=float(thresh), cutoff=cut))
 
-        return ave + float(threshold) * std
+        return cutoff
 
-    def flagQuartile(self, inVis, tableFlags, inFFTHeader, method, dilateU, dilateV, qrtdebug=False):
+    def matchCells(self, uv, U, V, cellSize, dilateU, dilateV):
+        """Return which rows of uv (nrow, 2) fall into the UV cells U, V
+
+        A row is selected if it lies within +/- (1/2 + dilateU) cells of
+        any cell in u and +/- (1/2 + dilateV) cells in v. Rather than
+        comparing all rows with all cells, the rows are binned onto the
+        cell grid once and looked up in a boolean image of the dilated
+        cells.
+        """
+        rowSel = np.zeros(uv.shape[0], dtype=bool)
+        if not len(U):
+            return rowSel
+
+        # Grid indices of the cells relative to the first one
+        U = np.asarray(U, dtype=float)
+        V = np.asarray(V, dtype=float)
+        cellU = np.round((U - U[0]) / cellSize).astype(np.int64)
+        cellV = np.round((V - V[0]) / cellSize).astype(np.int64)
+        offU = cellU.min() - dilateU
+        offV = cellV.min() - dilateV
+        cellU -= offU
+        cellV -= offV
+
+        # Dilated cell image
+        cellImage = np.zeros((cellU.max() + dilateU + 1, cellV.max() + dilateV + 1), dtype=bool)
+        for du in range(-dilateU, dilateU + 1):
+            for dv in range(-dilateV, dilateV + 1):
+                cellImage[cellU + du, cellV + dv] = True
+
+        # Row bins, cell k covering (k - 1/2, k + 1/2] cells
+        rowU = np.ceil((uv[:, 0] - U[0]) / cellSize - 0.5) - offU
+        rowV = np.ceil((uv[:, 1] - V[0]) / cellSize - 0.5) - offV
+        inside = (rowU >= 0) & (rowU < cellImage.shape[0]) & (rowV >= 0) & (rowV < cellImage.shape[1])
+        rowSel[inside] = cellImage[rowU[inside].astype(np.int64), rowV[inside].astype(np.int64)]
+        return rowSel
+
+    def flagQuartile(self, inVis, tableFlags, inFFTHeader, method, dilateU, dilateV, qrtdebug=False, rows=None):
 
         U = tableFlags['u']
         V = tableFlags['v']
         UV = np.array([U, V])
 
-        t = tables.table(inVis, readonly=False, ack=False)
-        # Take existing flags from MS of this scan to estimate flagged starting flagged fraction
-        flags = t.getcol('FLAG')
-        percTot = np.nansum(flags) / float(flags.shape[0] * flags.shape[1] * flags.shape[2]) * 100.
-        # Reset to no flags and build up stripe flags
-        flags = np.zeros(flags.shape, bool)
-        caracal.log.info("Scan flags before stripe-flagging: {percent:.3f}%".format(percent=percTot))
-        # uvw=np.array(t.getcol('UVW'),dtype=float) # This is never used
+        t = tables.table(inVis, ack=False)
+        # Work on the rows of one scan only
+        tSel = t.selectrows(rows) if rows is not None else t
         spw = tables.table(inVis + '/SPECTRAL_WINDOW', ack=False)
         avspecchan = np.average(spw.getcol('CHAN_FREQ'))
-        uv = t.getcol('UVW')[:, :2] * avspecchan / scconstants.c
+        spw.close()
+        uv = tSel.getcol('UVW')[:, :2] * avspecchan / scconstants.c
+        if rows is not None:
+            tSel.close()
+        t.close()
 
         caracal.log.info('{0:d} UV cells in the FFT image selected for flagging'.format(U.shape[0]))
 
         if qrtdebug and U.shape[0]:
             caracal.log.info('\tamplitude of selected cells in range {0:.3f} - {1:.3f}'.format(np.nanmin(tableFlags['amp']), np.nanmax(tableFlags['amp'])))
-            caracal.log.info('\t{0} total rows in scan MS'.format(flags.shape))
+            caracal.log.info('\t{0} total rows in scan MS'.format(uv.shape[0]))
 
         if U.shape[0]:
             caracal.log.info('Finding MS rows within flagged cells +/- {0:d} U cell(s) and +/- {1:d} V cell(s)'.format(dilateU, dilateV))
 
-        percent = 0.
-        for i in range(0, UV.shape[1]):
-            indexU = np.where(np.logical_and(uv[:, 0] > UV[0, i] - (1 / 2 + dilateU) * inFFTHeader['CDELT2'], uv[:, 0] <= UV[0, i] + (1 / 2 + dilateU) * inFFTHeader['CDELT2']))[0]
-            indexV = np.where(np.logical_and(uv[:, 1] > UV[1, i] - (1 / 2 + dilateV) * inFFTHeader['CDELT2'], uv[:, 1] <= UV[1, i] + (1 / 2 + dilateV) * inFFTHeader['CDELT2']))[0]
+        rowSel = self.matchCells(uv, U, V, inFFTHeader['CDELT2'], dilateU, dilateV)
 
-            if qrtdebug:
+        if qrtdebug:
+            for i in range(0, UV.shape[1]):
                 caracal.log.info('\tcell {0:d}, [U,V] = {1}'.format(i, UV[:, i]))
                 caracal.log.info('\t\tflagging u range = {0:.3f} - {1:.3f}'.format(UV[0, i] - (1 / 2 + dilateU) * inFFTHeader['CDELT2'], UV[0, i] + (1 / 2 + dilateU) * inFFTHeader['CDELT2']))
                 caracal.log.info('\t\tflagging v range = {0:.3f} - {1:.3f}'.format(UV[1, i] - (1 / 2 + dilateV) * inFFTHeader['CDELT2'], UV[1, i] + (1 / 2 + dilateV) * inFFTHeader['CDELT2']))
-
-            # Combine U and V selection into final selection
-            indexTot = np.intersect1d(indexU, indexV)
-
-            if qrtdebug:
+                indexTot = np.where(self.matchCells(uv, U[i:i + 1], V[i:i + 1], inFFTHeader['CDELT2'], dilateU, dilateV))[0]
                 caracal.log.info('\t\t{0:d} rows found'.format(indexTot.shape[0]))
                 if indexTot.shape[0]:
                     caracal.log.info('\t\tSelected rows have uv in the following ranges')
                     caracal.log.info('\t\tu: {0:.3f} - {1:.3f}'.format(np.nanmin(uv[indexTot, 0]), np.nanmax(uv[indexTot, 0])))
                     caracal.log.info('\t\tv: {0:.3f} - {1:.3f}'.format(np.nanmin(uv[indexTot, 1]), np.nanmax(uv[indexTot, 1])))
 
-            # Add to stripe flags of this scan
-            flags[indexTot, :, :] = True
-            percent += float(len(indexTot)) / float(flags.shape[0]) * 100.
+        # The stripe flags of this scan flag entire rows
+        percent = float(np.count_nonzero(rowSel)) / float(max(1, rowSel.shape[0])) * 100.
 
-        # Save modified flags to MS of this scan
-        t.putcol('FLAG', t.getcol('FLAG') + flags)
-        t.close()
+        # Add them to the flags of the MS of this scan
+        def addStripeFlags(startRow, flags):
+            flags |= rowSel[startRow:startRow + flags.shape[0], None, None]
+
+        with self.writeLock:
+            t = tables.table(inVis, readonly=False, ack=False)
+            tSel = t.selectrows(rows) if rows is not None else t
+            nBefore, nAfter, nVis = self.chunkFlags(tSel, addStripeFlags, prefetch=self.config['flag_u_zeros'].get('prefetch', False))
+            if rows is not None:
+                tSel.close()
+            t.close()
+        caracal.log.info("Scan flags before stripe-flagging: {percent:.3f}%".format(percent=nBefore / float(max(1, nVis)) * 100.))
         caracal.log.info("Flag scan done")
-        return flags, percent
+        return rowSel, percent
 
     def putFlags(self, pipeline, pf_inVis, pf_inVisName, pf_stripeFlags):
-        caracal.log.info("Opening full MS file to add stripe flags".format(pf_inVisName))
+        caracal.log.info("Opening full MS file to add stripe flags")
         t = tables.table(pf_inVis, readonly=False, ack=False)
-        flagOld = t.getcol('FLAG')
-        percTotBefore = np.nansum(flagOld) / float(flagOld.shape[0] * flagOld.shape[1] * flagOld.shape[2]) * 100.
-        caracal.log.info("Total Flags Before: {percent:.3f} %".format(percent=percTotBefore))
-        flagNew = np.sum([pf_stripeFlags, flagOld], axis=0)
-        percTotAfter = np.nansum(flagNew) / float(flagNew.shape[0] * flagNew.shape[1] * flagNew.shape[2]) * 100.
-        caracal.log.info("Total Flags After: {percent:.3f} %".format(percent=percTotAfter))
-        t.putcol('FLAG', flagNew)
-        del flagOld
-        del flagNew
-        gc.collect()
+
+        # pf_stripeFlags holds one flag per row
+        def addStripeFlags(startRow, flags):
+            flags |= pf_stripeFlags[startRow:startRow + flags.shape[0], None, None]
+
+        nBefore, nAfter, nVis = self.chunkFlags(t, addStripeFlags, prefetch=self.config['flag_u_zeros'].get('prefetch', False))
         t.close()
+        caracal.log.info("Total Flags Before: {percent:.3f} %".format(percent=nBefore / float(max(1, nVis)) * 100.))
+        caracal.log.info("Total Flags After: {percent:.3f} %".format(percent=nAfter / float(max(1, nVis)) * 100.))
         caracal.log.info("MS flagged")
         caracal.log.info("Before we close, save flag version 'stripe_flag_after'")
         self.saveFlags(pipeline, pf_inVisName, msdir=pipeline.msdir, flagname='stripe_flag_after')
@@ -705,14 +1291,11 @@ class UzeroFlagger:
 
     def run_flagUzeros(self, pipeline, targets, msname):
 
-        method = self.config['flag_u_zeros']['method']
         makePlots = self.config['flag_u_zeros']['make_plots']
 
         doCleanUp = self.config['flag_u_zeros']['cleanup']
 
-        thresholds = self.config['flag_u_zeros']['thresholds']
-        dilateU = self.config['flag_u_zeros']['dilateU']
-        dilateV = self.config['flag_u_zeros']['dilateV']
+        splitScans = self.config['flag_u_zeros'].get('split_scans', False)
         flagCmd = True
 
         galaxies = targets
@@ -723,33 +1306,7 @@ class UzeroFlagger:
         self.setDirs(pipeline.output)
 
         if makePlots:
-            font = 16
-            params = {'figure.autolayout': True,
-                      'font.family': 'serif',
-                      'figure.facecolor': 'white',
-                      'pdf.fonttype': 3,
-                      'font.serif': 'times',
-                      'font.style': 'normal',
-                      'font.weight': 'book',
-                      'font.size': font,
-                      'axes.linewidth': 1.5,
-                      'lines.linewidth': 1,
-                      'xtick.labelsize': font,
-                      'ytick.labelsize': font,
-                      'legend.fontsize': font,
-                      'xtick.direction': 'in',
-                      'ytick.direction': 'in',
-                      'xtick.major.size': 3,
-                      'xtick.major.width': 1.5,
-                      'xtick.minor.size': 2.5,
-                      'xtick.minor.width': 1.,
-                      'ytick.major.size': 3,
-                      'ytick.major.width': 1.5,
-                      'ytick.minor.size': 2.5,
-                      'ytick.minor.width': 1.,
-                      'text.usetex': False
-                      }
-            plt.rcParams.update(params)
+            plt.rcParams.update(PLOT_PARAMS)
 
         # MAIN MAIN MAIN
         superArr = np.empty((0, 7))
@@ -806,179 +1363,75 @@ class UzeroFlagger:
                 continue
 
             # For the first lw, do all that follows
-            caracal.log.info("Opening full MS file".format(inVisName))
+            caracal.log.info("Opening full MS file")
             t = tables.table(inVis, readonly=True, ack=False)
             scans = t.getcol('SCAN_NUMBER')
-            FlagTot = t.getcol('FLAG')
-            scanNums = np.unique(scans)
             timestamps = t.getcol("TIME")
-            field_id = t.getcol("FIELD_ID")
-            spw = tables.table(inVis + '/SPECTRAL_WINDOW', ack=False)
-            avspecchan = np.average(spw.getcol('CHAN_FREQ'))
-            uvw = t.getcol("UVW")
-            spw.close()
+            scanNums, scanRows, scanIntervals = self.scanRanges(scans, timestamps)
+            nRows = t.nrows()
+            nFlag, _, nVis = self.chunkFlags(t, prefetch=self.config['flag_u_zeros'].get('prefetch', False))
             t.close()
+            del scans, timestamps
 
-            percTot = np.nansum(FlagTot) / float(FlagTot.shape[0] * FlagTot.shape[1] * FlagTot.shape[2]) * 100.
+            percTot = nFlag / float(max(1, nVis)) * 100.
             caracal.log.info("Flagged visibilites so far: {percTot:.3f} %".format(percTot=percTot))
 
-            anttab = tables.table(inVis + "::ANTENNA", ack=False)
-            ant_xyz = anttab.getcol("POSITION", 0, 1)[0]
-            anttab.close()
-
             caracal.log.info("----------------------------------------------------")
             caracal.log.info("Imaging full MS for stripe analysis")
             outCubePrefix = galaxy + track + '_tot'
-            outCubeName = self.config['flag_u_zeros']['stripeCubeDir'] + outCubePrefix + '-dirty.fits'
-            if os.path.exists(outCubeName):
-                os.remove(outCubeName)
-            self.makeCube(pipeline, pipeline.msdir, inVisName, outCubePrefix)
-
-            caracal.log.info("Making FFT of image")
-            inFFTData, inFFTHeader = self.makeFFT(outCubeName)
+            inFFTData, inFFTHeader, rms_tot, outCubeName = self.previewImage(pipeline, pipeline.msdir, inVisName, inVis, outCubePrefix)
 
             if makePlots:
-                if flagCmd:
-                    fig0 = plt.figure(figsize=(7.24409, 7.24409), constrained_layout=False)
-                    fig0.set_tight_layout(False)
-                    gs0 = gridspec.GridSpec(nrows=2, ncols=2, figure=fig0, hspace=0, wspace=0.0)
-                    fig0, comvmax_tot = self.plotAll(fig0, gs0, 2, 0, outCubeName, inFFTData, inFFTHeader, galaxy, track, 0, 0, comvmax_tot, 0, type=None)
-                else:
+                totPanels = [self.plotPanel(outCubeName, inFFTData, inFFTHeader, 0, 0, 0, type=None)]
+                if not flagCmd:
                     outPlot = "{0}{2}_tot.png".format(self.config['flag_u_zeros']['stripePlotDir'], galaxy, mfsOb)
-                    fig0 = plt.figure(figsize=(7.24409, 7.24409), constrained_layout=False)
-                    fig0.set_tight_layout(False)
-                    gs0 = gridspec.GridSpec(nrows=1, ncols=2, figure=fig0, hspace=0, wspace=0.0)
-                    fig0, comvmax_tot = self.plotAll(fig0, gs0, 1, 0, outCubeName, inFFTData, inFFTHeader, galaxy, track, 0, 0, comvmax_tot, 0, type=None)
-                    fig0.subplots_adjust(left=0.05, bottom=0.05, right=0.97, top=0.97, wspace=0, hspace=0)
-                    fig0.savefig(outPlot, bbox_inches='tight', dpi=200)   # save the figure to file
-                    plt.close(fig0)
+                    comvmax_tot = self.savePlot(outPlot, totPanels, (7.24409, 7.24409), comvmax_tot)
 
             caracal.log.info("----------------------------------------------------")
 
-            caracal.log.info("Splitting scans".format(galaxy=galaxy, track=track))
-
-            scanVisList, scanVisNames = self.splitScans(pipeline, pipeline.msdir, inVis, scanNums)
+            if splitScans:
+                caracal.log.info("Splitting scans")
+                scanVisList, scanVisNames = self.splitScans(pipeline, pipeline.msdir, inVis, scanNums)
+            else:
+                caracal.log.info("Working on the rows of each scan in the full MS file")
 
             arr = np.empty((0, 7))
-            NS = len(scanNums)
-            if makePlots:
-                fig1 = plt.figure(figsize=(8, 21.73227), constrained_layout=False)
-                fig1.set_tight_layout(False)
-                fig2 = plt.figure(figsize=(8, 21.73227), constrained_layout=False)
-                fig2.set_tight_layout(False)
+            prePanels, postPanels = [], []
 
-                gs1 = gridspec.GridSpec(nrows=NS, ncols=2, figure=fig1, hspace=0, wspace=0.0)
-                gs2 = gridspec.GridSpec(nrows=NS, ncols=2, figure=fig2, hspace=0, wspace=0.0)
-
-            # Initialising the stripeFlags array, to which scans will be added one by one
-            stripeFlags = np.empty(((0), FlagTot.shape[1], FlagTot.shape[2]))
+            # Initialising the stripeFlags array (one flag per row), to which scans will be added one by one
+            stripeFlags = np.zeros(nRows, dtype=bool)
             percTotAv = []
 
-            del FlagTot
-            gc.collect()
-
+            # The scans are analysed independently, possibly in parallel, and merged in scan order
+            scanJobs = []
             for kk in range(len(scanNums)):
+                if splitScans:
+                    scanJobs.append((scanNums[kk], scanVisNames[kk], scanVisList[kk], self.config['flag_u_zeros']['stripeMSDir'], None, None))
+                else:
+                    scanJobs.append((scanNums[kk], inVisName, inVis, pipeline.msdir, scanRows[kk], scanIntervals[kk]))
+            scanJobs = [job + (galaxy, mfsOb, track) for job in scanJobs]
 
-                scan = scanNums[kk]
-                caracal.log.info("----------------------------------------------------")
-                caracal.log.info("\tWorking on scan {}".format(str(scan)))
-                visName = scanVisNames[kk]
-                visAddress = scanVisList[kk]
-                caracal.log.info("----------------------------------------------------")
-
-                # Save flag version before start iterating over all thresholds
-                self.saveFlags(pipeline, visName, msdir=self.config['flag_u_zeros']['stripeMSDir'], flagname='scan_flags_start')
-
-                caracal.log.info("Imaging scan for stripe analysis".format(scanNumber=str(scan), galaxy=galaxy, track=track))
-                outCubePrefix_0 = galaxy + track + '_scan' + str(scan)
-                outCubeName_0 = self.config['flag_u_zeros']['stripeCubeDir'] + outCubePrefix_0 + '-dirty.fits'
-                if os.path.exists(outCubeName_0):
-                    os.remove(outCubeName_0)
-                self.makeCube(pipeline, self.config['flag_u_zeros']['stripeMSDir'], visName, outCubePrefix_0)
-
-                caracal.log.info("Making FFT of image")
-
-                inFFTData, inFFTHeader = self.makeFFT(outCubeName_0)
-
-                U = ((np.linspace(1, inFFTData.shape[1], inFFTData.shape[1]) - inFFTHeader['CRPIX1']) * inFFTHeader['CDELT1'] + inFFTHeader['CRVAL1'])
-                V = ((np.linspace(1, inFFTData.shape[1], inFFTData.shape[1]) - inFFTHeader['CRPIX2'] - 1) * inFFTHeader['CDELT2'] + inFFTHeader['CRVAL2'])
-
-                el = 0
-                az = 0
-
-                outCubePrefix = galaxy + track + '_scan' + str(scan) + '_stripeFlag'
-                outCubeName = self.config['flag_u_zeros']['stripeCubeDir'] + outCubePrefix + '-dirty.fits'
-
-                rms_thresh = []
+            nWorkers = min(self.nWorkers(), len(scanJobs))
+            if nWorkers > 1:
+                caracal.log.info("Analysing {0:d} scans in {1:d} parallel processes".format(len(scanJobs), nWorkers))
+                scanResults = self.runScanPool(pipeline, scanJobs, nWorkers)
+            else:
+                scanResults = (self.analyseScan(pipeline, *job) for job in scanJobs)
 
-                if len(thresholds) > 1:
-                    caracal.log.info('Start iterating over all requested thresholds {} to find the optimal one'.format(thresholds))
-                # iterate over all thresholds
-                for threshold in thresholds:
-                    if len(thresholds) > 1:
-                        caracal.log.info('New iter')
-                    # Rewind flags of this scan to their initial state
-                    fvers = [ii.split(' :')[0] for ii in open(visAddress + '.flagversions/FLAG_VERSION_LIST').readlines()]
-                    self.restoreFlags(pipeline, visName, msdir=self.config['flag_u_zeros']['stripeMSDir'], flagname='scan_flags_start')
+            for kk, scanResult in enumerate(scanResults):
 
-                    while fvers[-1] != 'scan_flags_start':
-                        self.deleteFlags(pipeline, visName, msdir=self.config['flag_u_zeros']['stripeMSDir'], flagname=fvers[-1])
-                        fvers = fvers[:-1]
-
-                    caracal.log.info("Computing statistics on FFT and flagging scan for threshold {0}".format(threshold))
-                    # scanFlags below are the stripe flags for this scan
-                    statsArray, scanFlags, percent, cutoff_scan = self.saveFFTTable(inFFTData, inFFTHeader, visAddress, np.flip(U), V, galaxy, mfsOb, track, scan, el, az, method, threshold, dilateU, dilateV, makePlots)
-                    caracal.log.info("Scan flags from stripe-flagging: {percent:.3f}%".format(percent=percent))
-                    caracal.log.info("Making post-flagging image")
-
-                    if os.path.exists(outCubeName):
-                        os.remove(outCubeName)
-                    self.makeCube(pipeline, self.config['flag_u_zeros']['stripeMSDir'], visName, outCubePrefix)
-                    fitsdata = fits.open(outCubeName)
-                    rms_thresh.append(np.std(fitsdata[0].data[0, 0]))
-                    caracal.log.info("Image noise = {0:.3e} Jy/beam".format(rms_thresh[-1]))
-                    fitsdata.close()
-
-                # Select best threshold (minimum noise), re-flag and re-image
-                if len(thresholds) > 1:
-                    caracal.log.info('Done iterating over all requested thresholds')
-                    threshold = thresholds[rms_thresh.index(min(rms_thresh))]
-                    caracal.log.info('\tThe threshold that minimises the image noise is {}'.format(threshold))
-                    caracal.log.info('Repeating flagging and imaging steps with the selected threshold (yes, the must be a better way...)')
-                    # Rewind flags of this scan to their initial state
-                    fvers = [ii.split(' :')[0] for ii in open(visAddress + '.flagversions/FLAG_VERSION_LIST').readlines()]
-                    self.restoreFlags(pipeline, visName, msdir=self.config['flag_u_zeros']['stripeMSDir'], flagname='scan_flags_start')
-
-                    while fvers[-1] != 'scan_flags_start':
-                        self.deleteFlags(pipeline, visName, msdir=self.config['flag_u_zeros']['stripeMSDir'], flagname=fvers[-1])
-
-                        fvers = fvers[:-1]
-                    # Re-flag with selected threshold
-                    caracal.log.info("Computing statistics on FFT and flagging scan for threshold {0}".format(threshold))
-                    statsArray, scanFlags, percent, cutoff_scan = self.saveFFTTable(inFFTData, inFFTHeader, visAddress, np.flip(U), V, galaxy, mfsOb, track, scan, el, az, method, threshold, dilateU, dilateV, makePlots)
-                    caracal.log.info("Scan flags from stripe-flagging: {percent:.3f}%".format(percent=percent))
-                    # Re-image
-                    caracal.log.info("Making post-flagging image")
-                    if os.path.exists(outCubeName):
-                        os.remove(outCubeName)
-                    self.makeCube(pipeline, self.config['flag_u_zeros']['stripeMSDir'], visName, outCubePrefix)
+                statsArray, scanFlags, percent, cutoff_scan, prePanel, postPanel = scanResult
 
                 # Save stats for the selected threshold
                 arr = np.vstack((arr, statsArray))
                 percTotAv.append(percent)
 
                 # Add the stripe flags of this scan to the stripe flags of all the scans done previously
-                stripeFlags = np.concatenate([stripeFlags, scanFlags])
+                stripeFlags[scanRows[kk]] = scanFlags
 
                 if makePlots:
-                    fig1, comvmax_scan = self.plotAll(fig1, gs1, NS, kk, outCubeName_0, inFFTData, inFFTHeader, galaxy, track, scan, None, comvmax_scan, cutoff_scan, type=None)
-
-                caracal.log.info("Making FFT of post-flagging image")
-
-                inFFTData, inFFTHeader = self.makeFFT(outCubeName)
-
-                if makePlots:
-                    fig2, comvmax_scan = self.plotAll(fig2, gs2, NS, kk, outCubeName, inFFTData, inFFTHeader, galaxy, track, scan, percent, comvmax_scan, 0, type='postFlag')
+                    prePanels.append(prePanel)
+                    postPanels.append(postPanel)
 
             if makePlots:
                 caracal.log.info("----------------------------------------------------")
@@ -986,12 +1439,8 @@ class UzeroFlagger:
                 outPlot = "{0}{2}_perscan_preFlag.png".format(self.config['flag_u_zeros']['stripePlotDir'], galaxy, mfsOb)
                 outPlotFlag = "{0}{2}_perscan_postFlag.png".format(self.config['flag_u_zeros']['stripePlotDir'], galaxy, mfsOb)
 
-                fig1.subplots_adjust(left=0.05, bottom=0.05, right=0.97, top=0.97, wspace=0, hspace=0)
-                fig1.savefig(outPlot, bbox_inches='tight', dpi=200)   # save the figure to file
-                plt.close(fig1)
-                fig2.subplots_adjust(left=0.05, bottom=0.05, right=0.97, top=0.97, wspace=0, hspace=0)
-                fig2.savefig(outPlotFlag, bbox_inches='tight', dpi=200)   # save the figure to file
-                plt.close(fig2)
+                comvmax_scan = self.savePlot(outPlot, prePanels, (8, 21.73227), comvmax_scan)
+                comvmax_scan = self.savePlot(outPlotFlag, postPanels, (8, 21.73227), comvmax_scan)
 
             superArr = np.vstack((superArr, arr))
             caracal.log.info("Saving stats table")
@@ -1007,22 +1456,11 @@ class UzeroFlagger:
                 caracal.log.info("Making post-flagging image")
 
                 outCubePrefix = galaxy + track + '_tot_stripeFlag'
-                outCubeName = self.config['flag_u_zeros']['stripeCubeDir'] + outCubePrefix + '-dirty.fits'
-
-                if os.path.exists(outCubeName):
-                    os.remove(outCubeName)
-                self.makeCube(pipeline, pipeline.msdir, inVisName, outCubePrefix)
-
-                caracal.log.info("Making FFT of post-flagging image")
-
-                inFFTData, inFFTHeader = self.makeFFT(outCubeName)
+                inFFTData, inFFTHeader, rms_tot, outCubeName = self.previewImage(pipeline, pipeline.msdir, inVisName, inVis, outCubePrefix)
 
-                U = ((np.linspace(1, inFFTData.shape[1], inFFTData.shape[1]) - inFFTHeader['CRPIX1']) * inFFTHeader['CDELT1'] + inFFTHeader['CRVAL1'])
-                V = ((np.linspace(1, inFFTData.shape[1], inFFTData.shape[1]) - inFFTHeader['CRPIX2'] - 1) * inFFTHeader['CDELT2'] + inFFTHeader['CRVAL2'])
+                caracal.log.info("Saving total stripe flagging diagnostic plots")
 
-                caracal.log.info("Saving total stripe flagging diagnostic plots".format(galaxy=galaxy, track=track))
-
-                percTotAfter = np.nansum(stripeFlags) / float(stripeFlags.shape[0] * stripeFlags.shape[1] * stripeFlags.shape[2]) * 100.
+                percTotAfter = np.count_nonzero(stripeFlags) / float(max(1, nRows)) * 100.
                 caracal.log.info("Total stripe flags: {percent:.3f} %".format(percent=percTotAfter))
                 percRel = percTotAfter - percTot
 
@@ -1035,14 +1473,20 @@ class UzeroFlagger:
                     caracal.log.info("----------------------Plotting----------------------")
 
                     outPlot = "{0}{2}_fullMS_prepostFlag.png".format(self.config['flag_u_zeros']['stripePlotDir'], galaxy, mfsOb)
-                    fig0, comvmax_tot = self.plotAll(fig0, gs0, 2, 1, outCubeName, inFFTData, inFFTHeader, galaxy, track, 0, np.nanmean(percTotAv), comvmax_tot, 0, type='postFlag')
-                    fig0.subplots_adjust(left=0.05, bottom=0.05, right=0.97, top=0.97, wspace=0, hspace=0)
-                    fig0.savefig(outPlot, bbox_inches='tight', dpi=200)   # save the figure to file
-                    plt.close(fig0)
+                    totPanels.append(self.plotPanel(outCubeName, inFFTData, inFFTHeader, 0, np.nanmean(percTotAv), 0, type='postFlag'))
+                    comvmax_tot = self.savePlot(outPlot, totPanels, (7.24409, 7.24409), comvmax_tot)
 
                 timeFlag = (time.time() - timeInit) / 60.
 
+        self.finishPlots()
+
         if doCleanUp is True:
             self.cleanUp(galaxy)
 
         return timeFlag
+
+
+if __name__ == "__main__":
+    # Render diagnostic plots on demand from their stored artefacts
+    for artefact in sys.argv[1:]:
+        print(renderPlot(artefact))
@@ -1,6 +1,9 @@
 #! /usr/bin/env python
 
+import os
 import sys
+import tempfile
+import concurrent.futures
 from datetime import datetime
 import numpy as np
 import argparse
@@ -9,16 +12,452 @@ from caracal.utils.requires import extras
 
 version = '1.0.2'
 
+# Approximate number of bytes held in memory per voxel of a tile while
+# fitting (input, mask, masked copies, float64 fit, convolved fit and
+# subtracted output)
+TILE_VOXEL_BYTES = 48
+
 
 def printime(string):
     now = datetime.now().strftime("%H:%M:%S")
     print('{} {}'.format(now, string))
 
+
+def _polyfit_masked(incubus_data, incubus_mask, polyorder):
+    """Fit a polynomial to each spectrum of a cube, ignoring masked voxels
+
+    Parameters:
+        incubus_data (array): Cube with spectral axis first
+        incubus_mask (array of bool): Voxels to ignore in the fit
+        polyorder (int): Polynomial order
+
+    Returns:
+        fit (array): Polynomial evaluated at all channels
+
+    Solves the normal equations of the least-squares fit of all
+    spectra at once, with the Vandermonde matrix weighted by the
+    unmasked voxels of each spectrum. The channel axis is mapped onto
+    [-1, 1] to keep the small linear systems well conditioned. Spectra
+    with fewer unmasked channels than polynomial coefficients get a
+    fit of 0.
+    """
+    nchan = incubus_data.shape[0]
+    ncoef = polyorder + 1
+    data = incubus_data.reshape((nchan, -1))
+    weights = np.logical_not(incubus_mask.reshape((nchan, -1)))
+
+    x = np.linspace(-1., 1., nchan) if nchan > 1 else np.zeros(1)
+    vander = np.polynomial.polynomial.polyvander(x, polyorder)
+
+    # Per-spectrum normal matrices sum_c w V_ci V_cj and right-hand sides
+    # sum_c w V_ci y_c
+    normal = np.dot(
+        (vander[:, :, None] * vander[:, None, :]).reshape((nchan, -1)).T,
+        weights.astype(float)).T.reshape((-1, ncoef, ncoef))
+    rhs = np.dot(vander.T, np.where(weights, data, 0.)).T[:, :, None]
+
+    underdetermined = weights.sum(axis=0) < ncoef
+    normal[underdetermined] = np.identity(ncoef)
+    rhs[underdetermined] = 0.
+
+    try:
+        coefficients = np.linalg.solve(normal, rhs)
+    except np.linalg.LinAlgError:
+        coefficients = np.matmul(np.linalg.pinv(normal), rhs)
+
+    return np.dot(vander, coefficients[:, :, 0].T).reshape(incubus_data.shape)
+
+
+def _running_median(incubus_data, incubus_mask, length, blocksize=2**24):
+    """Sliding-window median along the first axis, skipping masked voxels
+
+    Parameters:
+        incubus_data (array): Cube with spectral axis first
+        incubus_mask (array of bool): Voxels to skip, or None; NaNs are
+            always skipped
+        length (int): Window length in channels
+        blocksize (int): Approximate number of window elements sorted at
+            once
+
+    Returns:
+        Median of the unmasked voxels in the window centred on each
+        voxel, or NaN if the window contains none
+
+    The spectra are extended by mirroring at both ends, like
+    scipy.ndimage.median_filter does by default, so the result is the
+    same as that of scipy.ndimage.median_filter(incubus_data,
+    (length, 1, 1)) for an odd length if nothing is masked. All windows of a block of
+    channels and pixels are sorted at once, with skipped voxels
+    sorted to the end of each window, and the median is picked from
+    the valid part of each window.
+    """
+    nchan = incubus_data.shape[0]
+    data = np.array(incubus_data, dtype=np.result_type(
+        incubus_data.dtype, np.float32)).reshape((nchan, -1))
+    if incubus_mask is not None:
+        data[incubus_mask.reshape((nchan, -1))] = np.nan
+    before = length // 2
+    data = np.pad(data, ((before, length - 1 - before), (0, 0)),
+                  mode='symmetric')
+
+    npix = data.shape[1]
+    median = np.empty((nchan, npix), dtype=data.dtype)
+    # blocks of channels and pixels with about blocksize window elements
+    nblock = max(1, blocksize // (length * npix))
+    pblock = min(npix, max(1, blocksize // (length * nblock)))
+    for c0 in range(0, nchan, nblock):
+        c1 = min(c0 + nblock, nchan)
+        for p0 in range(0, npix, pblock):
+            p1 = min(p0 + pblock, npix)
+            windows = np.lib.stride_tricks.sliding_window_view(
+                data[c0:c1 + length - 1, p0:p1], length, axis=0)
+            windows = np.sort(windows, axis=-1)
+            nvalid = length - np.isnan(windows).sum(axis=-1)
+            lower = np.take_along_axis(
+                windows, np.maximum(nvalid - 1, 0)[..., None] // 2, axis=-1)[..., 0]
+            upper = np.take_along_axis(
+                windows, (nvalid // 2)[..., None], axis=-1)[..., 0]
+            median[c0:c1, p0:p1] = np.where(nvalid > 0, (lower + upper) / 2., np.nan)
+
+    return median.reshape(incubus_data.shape)
+
+
+def _fit_cube(incubus_data_masked, fitmode, length, polyorder, sgiters,
+              datarange=(0., 0.), verb=True):
+    """Fit a continuum along the first axis of a masked (sub)cube
+
+    Parameters:
+        incubus_data_masked (masked array): Cube with spectral axis first
+        fitmode, length, polyorder, sgiters: see imcontsub
+        datarange (tuple): Minimum and maximum of the full input cube,
+            used to clip the polynomial fit
+        verb (bool): Report Savitzky-Golay iterations
+
+    Returns:
+        fit (array): Fitted continuum with the shape of the input
+    """
+    import scipy.signal as scipy_signal
+
+    incubus_data = incubus_data_masked.data
+
+    if fitmode == 'poly':
+        fit = _polyfit_masked(
+            incubus_data, np.ma.getmaskarray(incubus_data_masked), polyorder)
+
+        # Make sure that the fit cube can be convolved
+        minincube, maxincube = datarange
+        fit[fit > maxincube] = maxincube
+        fit[fit < minincube] = minincube
+
+        # To be completely sure
+        fit[np.logical_not(np.isfinite(fit))] = 0.
+
+    elif fitmode == 'median' and length > 0:
+        fit = _running_median(
+            incubus_data, np.ma.getmaskarray(incubus_data_masked), length)
+
+        # Where a whole window is masked fall back to the median of the
+        # data that are not blank
+        holes = np.isnan(fit)
+        if holes.any():
+            spectra = holes.any(axis=0)
+            unmasked = _running_median(incubus_data[:, spectra], None, length)
+            fit[:, spectra] = np.where(holes[:, spectra], unmasked,
+                                       fit[:, spectra])
+
+    elif fitmode == 'savgol' and length > 0:
+        sgmask = np.ma.getmask(incubus_data_masked)
+        sgincubus = incubus_data.copy()
+        sgincubus[sgmask] = 0.0
+
+        # First stitch holes in the data
+        if sgiters > 0:
+            fit = _running_median(
+                incubus_data, np.ma.getmaskarray(incubus_data_masked), length)
+            fit[np.isnan(fit)] = 0.0
+
+            # Then iterate n times with better guesses for the
+            # stitched data
+            for i in range(sgiters):
+                if verb:
+                    print('Iteration {}'.format(i))
+
+                sgincubus = fit
+
+                fit = scipy_signal.savgol_filter(
+                    sgincubus, length, polyorder, axis=0, mode='interp')
+        else:
+            fit = scipy_signal.savgol_filter(
+                sgincubus, length, polyorder, axis=0, mode='interp')
+
+    else:
+        fit = np.zeros(incubus_data.shape)
+
+    return fit
+
+
+def _make_kernel(kertyp, kersiz):
+    """Return the 1-D profile of the spatial convolution kernel"""
+    import scipy.signal as scipy_signal
+
+    if kertyp == 'gauss':
+        kernel = scipy_signal.windows.gaussian(
+            int(10. * kersiz / np.sqrt(np.log(256.))) // 2 * 2 + 1,
+            kersiz / np.sqrt(np.log(256.)))
+    else:
+        klength = int(10. * kersiz) // 2 * 2 + 1
+        coordinates = np.arange(klength, dtype=int) - int(klength) // 2
+        kernel = (np.fabs(coordinates) < (kersiz // 2 + 1))
+    return kernel
+
+
+def _convolve_cube(fit, kernel):
+    """Convolve each plane of fit with the outer product of kernel
+
+    Both kernel types are separable, so the planes are smoothed with
+    two 1-D passes along y and x, all channels at once. NaNs in fit
+    and the area outside the planes get no weight; the result is
+    normalised by the convolved weights instead of the kernel sum and
+    NaNs are restored afterwards. fit is modified in place.
+    """
+    import scipy.ndimage as scipy_ndimage
+
+    kernel = np.asarray(kernel, dtype=np.float64)
+    fitmask = np.isnan(fit)
+    fit[fitmask] = 0.
+
+    convolved = np.empty_like(fit)
+    scipy_ndimage.convolve1d(fit, kernel, axis=1, output=convolved,
+                             mode='constant', cval=0.)
+    scipy_ndimage.convolve1d(convolved, kernel, axis=2, output=fit,
+                             mode='constant', cval=0.)
+    convolved, fit = fit, convolved
+
+    # Without NaNs the weights are separable, too
+    if fitmask.any():
+        weights = (~fitmask).astype(fit.dtype)
+        scipy_ndimage.convolve1d(weights, kernel, axis=1, output=fit,
+                                 mode='constant', cval=0.)
+        scipy_ndimage.convolve1d(fit, kernel, axis=2, output=weights,
+                                 mode='constant', cval=0.)
+    else:
+        weights = np.outer(
+            scipy_ndimage.convolve1d(np.ones(fit.shape[1]), kernel,
+                                     mode='constant', cval=0.),
+            scipy_ndimage.convolve1d(np.ones(fit.shape[2]), kernel,
+                                     mode='constant', cval=0.)).astype(fit.dtype)
+    del fit
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        convolved /= weights
+    convolved[fitmask] = np.nan
+    return convolved
+
+
+def _process_tile(tile_data, tile_mask, fitmode, length, polyorder,
+                  sgiters, datarange, kernel, products):
+    """Fit, convolve and subtract the continuum of one tile
+
+    Parameters:
+        tile_data (array): Tile, spectral axis first
+        tile_mask (array): Voxels of tile_data to exclude from the fit
+        fitmode, length, polyorder, sgiters: see imcontsub
+        datarange (tuple): see _fit_cube
+        kernel (array): 1-D convolution kernel or None. With a kernel,
+            the tile has to cover the whole sky plane
+        products (tuple of bool): Whether to return the fitted and the
+            convolved continuum, and the subtracted tile
+
+    Returns:
+        fitted, convolved and subtracted tile as float32 arrays, each
+        being None unless requested in products
+    """
+    fit = _fit_cube(np.ma.masked_array(tile_data, tile_mask), fitmode,
+                    length, polyorder, sgiters, datarange, verb=False)
+    del tile_mask
+
+    fit = fit.astype(np.float32, copy=False)
+    if not any(products[1:]):
+        return fit if products[0] else None, None, None
+    fitted = fit.copy() if products[0] else None
+
+    confit, subtracted = _convolve_tile(
+        tile_data, fit, (slice(None),) * 3, kernel, products[1:])
+    return fitted, confit, subtracted
+
+
+def _convolve_tile(tile_data, fit, inslice, kernel, products):
+    """Convolve the continuum fit of a tile and subtract it from the tile
+
+    Parameters:
+        tile_data (array): Tile, spectral axis first
+        fit (array): Continuum fit of the tile including its halo, which
+            is modified
+        inslice (tuple): Slices of the tile within fit
+        kernel (array): 1-D convolution kernel or None
+        products (tuple of bool): Whether to return the convolved
+            continuum and the subtracted tile
+
+    Returns:
+        convolved and subtracted tile as float32 arrays, each being None
+        unless requested in products
+    """
+    if kernel is not None:
+        convolved = _convolve_cube(fit, kernel)
+    else:
+        convolved = fit
+    del fit
+
+    confit = convolved[inslice].copy() if products[0] else None
+    if not products[1]:
+        return confit, None
+
+    # Subtract in place on the (already copied) input tile
+    tile_data -= convolved[inslice]
+    return confit, tile_data
+
+
+def _poly_range(incubus_data, tilemem):
+    """Return the range a polynomial fit to incubus_data is clipped to
+
+    The cube is read in blocks of channels of at most tilemem MB, so
+    that memory-mapped cubes need not be loaded as a whole.
+    """
+    planebytes = incubus_data.shape[1] * incubus_data.shape[2] * \
+        incubus_data.dtype.itemsize
+    nplanes = max(1, int(tilemem * 2**20 // planebytes))
+    datamin, datamax = np.inf, -np.inf
+    for z0 in range(0, incubus_data.shape[0], nplanes):
+        block = np.asarray(incubus_data[z0:z0 + nplanes])
+        block = block[np.isfinite(block)]
+        if block.size:
+            datamin = min(datamin, block.min())
+            datamax = max(datamax, block.max())
+
+    maxincube = datamax * 10. if datamax > 0. else 0.
+    minincube = datamin * 10. if datamin < 0. else 0.
+    return minincube, maxincube
+
+
+def _tiles(shape, tilemem, halo=0, ntiles=1):
+    """Split the sky plane of a cube into tiles fitting into tilemem MB
+
+    Parameters:
+        shape (tuple): Shape (nchan, ny, nx) of the cube
+        tilemem (float): Memory budget per tile in MB (0 means no limit)
+        halo (int): Number of pixels a tile has to be padded with on
+            each side for a spatial convolution
+        ntiles (int): Minimum number of tiles to split the cube into,
+            e.g. to spread them over several processes
+
+    Returns:
+        list of (inner, outer) tuples of (y0, y1, x0, x1) pixel ranges,
+        where inner is the part of the sky plane a tile contributes to
+        the output and outer includes the halo
+    """
+    nchan, ny, nx = shape
+    # Tiles are at least as large as their halo, such that they are at
+    # most 9 times as large including it
+    minsize = max(1, halo)
+    npix = max(1, int(tilemem * 2**20 // (nchan * TILE_VOXEL_BYTES)))
+
+    # Prefer strips of full rows, which are contiguous on disk
+    if tilemem <= 0:
+        tw = nx
+        th = max(minsize, -(-ny // ntiles))
+    elif (minsize + 2 * halo) * nx <= npix:
+        tw = nx
+        th = max(minsize, min(npix // nx - 2 * halo, -(-ny // ntiles)))
+    else:
+        tw = th = int(np.sqrt(npix)) - 2 * halo
+        if tw < minsize:
+            tw = th = minsize
+            printime('Warning: tiles with a halo of {:d} pixels do not fit into '
+                     'tilemem = {} MB, using tiles of {:.0f} MB'.format(
+                         halo, tilemem, (minsize + 2 * halo)**2 * nchan * TILE_VOXEL_BYTES / 2.**20))
+
+    tiles = []
+    for y0 in range(0, ny, th):
+        y1 = min(y0 + th, ny)
+        for x0 in range(0, nx, tw):
+            x1 = min(x0 + tw, nx)
+            tiles.append(((y0, y1, x0, x1),
+                          (max(0, y0 - halo), min(ny, y1 + halo),
+                           max(0, x0 - halo), min(nx, x1 + halo))))
+    return tiles
+
+
+class _CubeWriter(object):
+    """Output cube preallocated on disk and filled tile by tile
+
+    The primary HDU gets the header of the template HDU list, converted
+    to float32, and is memory-mapped, such that tiles can be written
+    without holding the whole cube in memory. DATAMIN and DATAMAX are
+    accumulated while writing and stored on close().
+    """
+
+    def __init__(self, filename, hdul_template, clobber=False):
+        import astropy.io.fits as astropy_io_fits
+
+        if os.path.exists(filename):
+            if not clobber:
+                raise OSError('File {} already exists.'.format(filename))
+            os.remove(filename)
+
+        header = hdul_template[0].header.copy()
+        header['BITPIX'] = -32
+        for key in ['BSCALE', 'BZERO', 'BLANK']:
+            header.remove(key, ignore_missing=True)
+        header['DATAMIN'] = 0.
+        header['DATAMAX'] = 0.
+
+        shape = tuple(header['NAXIS{:d}'.format(i)]
+                      for i in range(header['NAXIS'], 0, -1))
+        datasize = int(np.prod(shape)) * 4
+        datasize = (datasize + 2879) // 2880 * 2880
+        header.tofile(filename)
+        with open(filename, 'rb+') as fobj:
+            fobj.seek(len(header.tostring()) + datasize - 1)
+            fobj.write(b'\0')
+
+        if len(hdul_template) > 1:
+            with astropy_io_fits.open(filename, mode='append') as hdul:
+                for hdu in hdul_template[1:]:
+                    hdul.append(hdu.copy())
+
+        self.filename = filename
+        self.hdul = astropy_io_fits.open(filename, mode='update', memmap=True)
+        self.data = self.hdul[0].data
+        if self.data.ndim == 4:
+            self.data = self.data[0]
+        self.datamin, self.datamax = np.inf, -np.inf
+
+    def write(self, tile, y0, y1, x0, x1):
+        """Write tile (nchan, y1 - y0, x1 - x0) to its place in the cube"""
+        self.data[:, y0:y1, x0:x1] = tile
+
+        # fmin/fmax ignore NaNs without copying out the finite voxels
+        tile = tile.ravel()
+        tilemin = float(np.fmin.reduce(tile))
+        tilemax = float(np.fmax.reduce(tile))
+        if np.isfinite(tilemin):
+            self.datamin = min(self.datamin, tilemin)
+        if np.isfinite(tilemax):
+            self.datamax = max(self.datamax, tilemax)
+
+    def close(self):
+        if np.isfinite(self.datamin):
+            self.hdul[0].header['DATAMIN'] = self.datamin
+            self.hdul[0].header['DATAMAX'] = self.datamax
+        del self.data
+        self.hdul.close()
+
+
 @extras(packages=["scipy", "astropy"])
 def imcontsub(
     incubus, outcubus=None, fitmode='median', length=0,
     polyorder=None, mask=None, sgiters=0, kertyp='gauss', kersiz=0,
-        fitted=None, confit=None, clobber=False):
+        fitted=None, confit=None, clobber=False, tilemem=0, ncpu=1):
     """Continuum subtraction in a fits data cube
 
     Parameters:
@@ -38,6 +477,9 @@ def imcontsub(
         confit (str): Name of fitted and convolved continuum cube (optional
             output)
         clobber (bool): Overwrite output if set
+        tilemem (float): Memory budget in MB for out-of-core processing
+            (0 means the whole cube is processed as a single tile)
+        ncpu (int): Number of processes fitting tiles in parallel
 
     Returns:
         None
@@ -69,12 +511,17 @@ def imcontsub(
     optionally supply the name of the output fitted data cube and with
     the parameter confit the user specifies the name of the fitted and
     convolved output data cube. The parameter clobber determines
-    whether the output will be overwritten (if True).
+    whether the output will be overwritten (if True). The input cube
+    is memory-mapped and the output cubes are preallocated on disk
+    and written once, tile by tile, in single precision. If tilemem is
+    larger than 0, the cube is processed in spatial tiles (all
+    channels of a block of sky pixels) of roughly tilemem MB, such
+    that cubes larger than the available memory can be processed. If
+    ncpu is larger than 1, the sky plane is split into at least ncpu
+    tiles, which are processed by a pool of ncpu processes.
     """
 
     import astropy.io.fits as astropy_io_fits
-    import scipy
-    import scipy.signal as scipy_signal
     # Read cube
     begin = datetime.now()
     print('')
@@ -82,24 +529,24 @@ def imcontsub(
 
     if isinstance(incubus, type('')):
         printime('Reading input cube {}'.format(incubus))
-        hdul_incubus = astropy_io_fits.open(incubus)
+        hdul_incubus = astropy_io_fits.open(incubus, memmap=True)
     else:
         hdul_incubus = incubus
 
     incubus_data = hdul_incubus[0].data
 
     # Reduce to 3 dims if necessary
-    stokes = False
     if len(incubus_data.shape) == 4:
-        stokes = True
         incubus_data = incubus_data[0, :]
 
-    # Read mask and apply
+    # Read mask
+    hdul_mask = None
+    mask_data = None
     if not isinstance(mask, type(None)):
 
         if isinstance(mask, type('')):
             printime('Reading and applying mask {}'.format(mask))
-            hdul_mask = astropy_io_fits.open(mask)
+            hdul_mask = astropy_io_fits.open(mask, memmap=True)
         else:
             hdul_mask = mask
 
@@ -109,157 +556,152 @@ def imcontsub(
         if len(mask_data.shape) == 4:
             mask_data = mask_data[0, :]
 
-        # Create a masked cube
-        # incubus_data_masked = np.ma.masked_array(incubus_data, mask_data > 0)
-        incubus_data_masked = np.ma.masked_array(
-            incubus_data, (mask_data > 0) + np.isnan(incubus_data))
-        hdul_mask.close()
-    else:
-        incubus_data_masked = np.ma.masked_array(
-            incubus_data, np.isnan(incubus_data))
-        # incubus_data_masked = incubus_data
-
     if fitmode == 'poly':
-
         if isinstance(polyorder, type(None)):
             polyorder = length
-
-        # Flatten and fit
-        incubus_data_flat = incubus_data_masked.reshape(
-            (incubus_data.shape[0], incubus_data.shape[1]
-                * incubus_data.shape[2]))
-        x = np.ma.masked_array(np.arange(incubus_data.shape[0]), False)
-
         printime('Fitting polynomial of order {}'.format(polyorder))
-        fitpars = np.array(
-            np.flip(np.ma.polyfit(x, incubus_data_flat, polyorder)))
-
-        printime('Creating continuum cube')
-        fit = np.flip(np.polynomial.polynomial.polyval(
-            np.flip(np.array(x), 0), fitpars).transpose()).reshape(
-                (incubus_data.shape[0], incubus_data.shape[1],
-                    incubus_data.shape[2]))
-        # Make sure that the fit cube can be convolved
-        if np.nanmax(incubus_data) > 0.:
-            maxincube = np.nanmax(incubus_data) * 10.
-        else:
-            maxincube = 0
-        if np.nanmin(incubus_data) < 0.:
-            minincube = np.nanmin(incubus_data) * 10.
-        else:
-            minincube = 0.
-
-        fit[fit > maxincube] = maxincube
-        fit[fit < minincube] = minincube
-
-        # To be completely sure
-        fit[np.logical_not(np.isfinite(fit))] = 0.
-
     elif fitmode == 'median':
         if length == 0:
             printime('Length is 0, no median-filtering.')
         else:
             printime('Median-filtering cube')
-
-            fit = scipy.ndimage.median_filter(
-                incubus_data, (length, 1, 1))
     elif fitmode == 'savgol':
         if isinstance(polyorder, type(None)):
             polyorder = 0
-
         if length == 0:
             printime('Length is 0, no Savitzky-Golay-filtering.')
         else:
             printime('Savitzky-Golay-filtering cube (order {})'.format(polyorder))
-
-            sgmask = np.ma.getmask(incubus_data_masked)
-            sgincubus = incubus_data.copy()
-            sgincubus[sgmask] = 0.0
-
-            # First stitch holes in the data
-            if sgiters > 0:
-                fit = scipy.ndimage.median_filter(
-                    sgincubus, (length, 1, 1))
-
-                # Then iterate n times with better guesses for the
-                # stitched data
-                for i in range(sgiters):
-                    print('Iteration {}'.format(i))
-
-                    sgincubus = fit
-
-                    fit = scipy_signal.savgol_filter(
-                        sgincubus, length, polyorder, axis=0, mode='interp')
-            else:
-                fit = scipy_signal.savgol_filter(
-                    sgincubus, length, polyorder, axis=0, mode='interp')
-
     else:
         printime('No valid filter chosen, not filtering.')
-        fit = incubus_data_masked * 0.
-
-    if not isinstance(fitted, type(None)):
-        printime('Writing continuum cube')
-        if stokes:
-            hdul_incubus[0].data = fit.astype('float32').reshape(
-                (1, fit.shape[0], fit.shape[1], fit.shape[2]))
-        else:
-            hdul_incubus[0].data = fit.astype('float32')
-        hdul_incubus[0].header['DATAMAX'] = np.nanmax(hdul_incubus[0].data)
-        hdul_incubus[0].header['DATAMIN'] = np.nanmax(hdul_incubus[0].data)
-        hdul_incubus.writeto(fitted, overwrite=clobber)
 
     if kersiz > 0:
-        printime('Spatially convolving continuum cube')
-        if kertyp == 'gauss':
-            kernel = scipy_signal.gaussian(
-                int(10. * kersiz / np.sqrt(np.log(256.))) // 2 * 2 + 1,
-                kersiz / np.sqrt(np.log(256.)))
-        else:
-            klength = int(10. * kersiz) // 2 * 2 + 1
-            coordinates = np.arange(klength, dtype=int) - int(klength) // 2
-            kernel = (np.fabs(coordinates) < (kersiz // 2 + 1))
-
-        kernel = np.outer(
-            kernel, kernel).reshape((1, kernel.size, kernel.size))
-        kernel = np.repeat(kernel, fit.shape[0], axis=0)
-        fitmask = np.isnan(fit)
-        fit[fitmask] = 0.
-        convolved = scipy_signal.fftconvolve(
-            fit, kernel, mode='same', axes=(1, 2)) / kernel[0].sum()
-        convolved[fitmask] = np.nan
+        kernel = _make_kernel(kertyp, kersiz)
     else:
-        convolved = fit
+        kernel = None
 
-    if not isinstance(confit, type(None)):
-        printime('Writing convolved continuum cube')
-        if stokes:
-            hdul_incubus[0].data = convolved.astype('float32').reshape(
-                (1, convolved.shape[0], convolved.shape[1],
-                    convolved.shape[2]))
+    if fitmode == 'poly':
+        datarange = _poly_range(
+            incubus_data, tilemem if tilemem > 0 else 1024.)
+    else:
+        datarange = (0., 0.)
+
+    halo = 0 if kernel is None else kernel.size // 2
+    tiles = _tiles(incubus_data.shape, tilemem, halo, ntiles=ncpu)
+    # The spatial convolution of a tile needs the fits of the pixels in its
+    # halo. Rather than fitting them again for every tile, all pixels are
+    # fitted once and the fits stored, then convolved tile by tile
+    twopass = kernel is not None and len(tiles) > 1
+    fit_tiles = _tiles(incubus_data.shape, tilemem, 0, ntiles=ncpu) if twopass else tiles
+    printime('Processing cube in {:d} tiles using {:d} process(es)'.format(
+        len(fit_tiles), ncpu))
+
+    writers = []
+    for product in [fitted, confit, outcubus]:
+        if isinstance(product, type(None)):
+            writers.append(None)
         else:
-            hdul_incubus[0].data = convolved.astype('float32')
-        hdul_incubus[0].header['DATAMAX'] = np.nanmax(hdul_incubus[0].data)
-        hdul_incubus[0].header['DATAMIN'] = np.nanmax(hdul_incubus[0].data)
-        hdul_incubus.writeto(confit, overwrite=clobber)
+            writers.append(_CubeWriter(product, hdul_incubus, clobber))
+    products = tuple(writer is not None for writer in writers)
 
-    printime('Subtracting continuum.')
-    subtracted = incubus_data - convolved
+    scratch, fitstore = None, None
+    if twopass:
+        if writers[0] is not None:
+            fitstore = writers[0].data
+        else:
+            # Scratch file next to the outputs
+            outdir = os.path.dirname(os.path.abspath(confit or outcubus))
+            scratch = tempfile.TemporaryFile(dir=outdir)
+            fitstore = np.memmap(scratch, dtype=np.float32, mode='w+',
+                                 shape=incubus_data.shape)
+
+    def read_tile(y0, y1, x0, x1):
+        tile_data = np.array(incubus_data[:, y0:y1, x0:x1], dtype=np.float32)
+        tile_mask = np.isnan(tile_data)
+        if mask_data is not None:
+            tile_mask += np.asarray(mask_data[:, y0:y1, x0:x1]) > 0
+        return tile_data, tile_mask
+
+    def fit_jobs():
+        for inner, outer in fit_tiles:
+            if twopass:
+                yield (_process_tile,) + read_tile(*inner) + (
+                    fitmode, length, polyorder, sgiters, datarange, None,
+                    (True, False, False))
+            else:
+                yield (_process_tile,) + read_tile(*inner) + (
+                    fitmode, length, polyorder, sgiters, datarange, kernel,
+                    products)
+
+    def convolve_jobs():
+        for (y0, y1, x0, x1), (oy0, oy1, ox0, ox1) in tiles:
+            # Slices of the inner tile within the outer one
+            inslice = (slice(None), slice(y0 - oy0, y1 - oy0),
+                       slice(x0 - ox0, x1 - ox0))
+            tile_data = np.array(incubus_data[:, y0:y1, x0:x1], dtype=np.float32)
+            yield (_convolve_tile, tile_data, np.array(fitstore[:, oy0:oy1, ox0:ox1]),
+                   inslice, kernel, products[1:])
+
+    def write_fit(tt, results):
+        y0, y1, x0, x1 = fit_tiles[tt][0]
+        printime('Tile {:d}/{:d} fitted: pixels y = {:d}-{:d}, x = {:d}-{:d}'.format(
+            tt + 1, len(fit_tiles), y0, y1 - 1, x0, x1 - 1))
+        if writers[0] is not None:
+            writers[0].write(results[0], y0, y1, x0, x1)
+        else:
+            fitstore[:, y0:y1, x0:x1] = results[0]
+
+    def write_tile(tilelist, tilewriters):
+        def write(tt, results):
+            y0, y1, x0, x1 = tilelist[tt][0]
+            printime('Tile {:d}/{:d} done: pixels y = {:d}-{:d}, x = {:d}-{:d}'.format(
+                tt + 1, len(tilelist), y0, y1 - 1, x0, x1 - 1))
+            for writer, result in zip(tilewriters, results):
+                if writer is not None:
+                    writer.write(result, y0, y1, x0, x1)
+        return write
+
+    def run(jobs, done):
+        if ncpu > 1:
+            # Keep a limited number of tiles in flight to bound memory
+            with concurrent.futures.ProcessPoolExecutor(ncpu) as executor:
+                pending = {}
+                for tt, job in enumerate(jobs):
+                    if len(pending) >= 2 * ncpu:
+                        finished, _ = concurrent.futures.wait(
+                            pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                        for future in finished:
+                            done(pending.pop(future), future.result())
+                    pending[executor.submit(*job)] = tt
+                for future in concurrent.futures.as_completed(pending):
+                    done(pending[future], future.result())
+        else:
+            for tt, job in enumerate(jobs):
+                done(tt, job[0](*job[1:]))
 
-    if stokes:
-        hdul_incubus[0].data = subtracted.astype('float32').reshape(
-            (1, subtracted.shape[0], subtracted.shape[1], subtracted.shape[2]))
+    if twopass:
+        run(fit_jobs(), write_fit)
+        printime('Convolving fits in {:d} tiles'.format(len(tiles)))
+        run(convolve_jobs(), write_tile(tiles, writers[1:]))
     else:
-        hdul_incubus[0].data = subtracted.astype('float32')
-    printime('Writing subtracted cube.')
-    hdul_incubus[0].header['DATAMAX'] = np.nanmax(hdul_incubus[0].data)
-    hdul_incubus[0].header['DATAMIN'] = np.nanmax(hdul_incubus[0].data)
-    hdul_incubus.writeto(outcubus, overwrite=clobber)
+        run(fit_jobs(), write_tile(fit_tiles, writers))
+
+    # Release the stored fits before closing the files they map
+    fitstore = None
+    printime('Closing output cubes')
+    for writer in writers:
+        if writer is not None:
+            writer.close()
+    if scratch is not None:
+        scratch.close()
+    if hdul_mask is not None:
+        hdul_mask.close()
     hdul_incubus.close()
     now = datetime.now()
     printime(
         'Time elapsed: {:.1f} minutes'.format((now - begin).total_seconds() / 60.))
     print('')
+    return
 
 
 def description():
@@ -294,7 +736,14 @@ def description():
         'optionally supply the name of the output fitted data cube and with'
         'the parameter confit the user specifies the name of the fitted and'
         'convolved output data cube. The parameter clobber determines'
-        'whether the output will be overwritten (if True).')
+        'whether the output will be overwritten (if True). The input cube'
+        'is memory-mapped and the output cubes are preallocated on disk'
+        'and written once, tile by tile, in single precision. If tilemem is'
+        'larger than 0, the cube is processed in spatial tiles (all'
+        'channels of a block of sky pixels) of roughly tilemem MB, such'
+        'that cubes larger than the available memory can be processed. If'
+        'ncpu is larger than 1, the sky plane is split into at least ncpu'
+        'tiles, which are processed by a pool of ncpu processes.')
 
 
 def parsing():
@@ -348,6 +797,13 @@ def parsing():
     parser.add_argument(
         '--clobber', '-c', help='overwrite output if set', default=False,
         action='store_true')
+    parser.add_argument(
+        '--ncpu', '-n',
+        help='Number of processes fitting tiles in parallel', type=int)
+    parser.add_argument(
+        '--tilemem',
+        help='Memory budget in MB for processing the cube in spatial tiles '
+        '(0 means no tiling)', type=str)
 
     whatnot = parser.parse_args()
     inpars = vars(whatnot)
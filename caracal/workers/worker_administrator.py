@@ -1,5 +1,7 @@
 # -*- coding: future_fstrings -*-
 from caracal.dispatch_crew import utils
+from caracal.dispatch_crew.step_cache import StepCache
+from caracal.dispatch_crew.warm_containers import WarmContainers
 from collections import OrderedDict
 import caracal
 from caracal import log, pckgdir, notebooks
@@ -7,10 +9,18 @@ import sys
 import os
 from datetime import datetime
 import stimela
+from stimela.exceptions import PipelineException, StimelaRecipeExecutionError
+from stimela.cargo.cab import StimelaCabParameterError
 import glob
 import shutil
 import traceback
 import itertools
+import re
+import json
+import hashlib
+import psutil
+import numpy
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 import ruamel.yaml
 assert ruamel.yaml.version_info >= (0, 12, 14)
@@ -19,12 +29,179 @@ assert ruamel.yaml.version_info >= (0, 12, 14)
 REPORTS = True
 
 
+class ParallelMSRecipe(stimela.Recipe):
+    """
+    stimela.Recipe that runs independent steps concurrently.
+
+    Each step added to the recipe gets the pipeline resources it reads and
+    writes (see WorkerAdministrator.step_resources). run() runs a step once
+    all earlier steps it conflicts with (i.e. that write a resource it uses,
+    or use a resource it writes) are done, with up to
+    WorkerAdministrator.parallel_ms_slots() steps at once. Steps that write
+    the same observation thus run in the order they were added, while e.g.
+    the steps of different observations run in parallel.
+
+    Steps may declare what they use by passing inputs= and outputs= (lists of
+    MS, table, image etc. names) to add(), so that e.g. several steps reading
+    the same MS can run at once.
+
+    Completed steps are journalled in the step cache of the pipeline, and
+    steps completed in an earlier run are skipped if the cache is reused
+    (general: cache_steps, or --resume; see StepCache).
+
+    If the pipeline keeps warm containers (general: warm_containers), container
+    steps are run in them (see WarmContainers).
+    """
+    pipeline = None
+
+    def add(self, image, name, config=None, *args, inputs=None, outputs=None, **kwargs):
+        result = super().add(image, name, config, *args, **kwargs)
+        if self.pipeline is not None:
+            job = self.jobs[-1]
+            job.caracal_resources = self.pipeline.step_resources(config, inputs, outputs)
+            if self.pipeline.step_cache is not None:
+                dirs = dict(msdir=kwargs.get('msdir') or self.msdir,
+                            indir=kwargs.get('input') or self.indir,
+                            outdir=kwargs.get('output') or self.outdir)
+                job.caracal_step = self.pipeline.step_cache.describe(image, config, job.version, job.tag, dirs=dirs,
+                                                                     is_file=self.pipeline.is_data_product)
+            warm_containers = self.pipeline.warm_containers
+            if warm_containers is not None and warm_containers.supports(job):
+                job.run_job = lambda job=job: warm_containers.run_job(job)
+        return result
+
+    def run(self, steps=None, resume=False, redo=None):
+        if steps is not None or resume or redo or self.pipeline is None or not self.jobs:
+            return super().run(steps=steps, resume=resume, redo=redo)
+
+        # keys of the steps to run, for the step cache
+        cache = self.pipeline.step_cache
+        cache_keys = OrderedDict()
+        for step, job in enumerate(self.jobs, 1):
+            description = getattr(job, 'caracal_step', None)
+            cache_keys[step] = cache.plan(description) if cache is not None and description is not None else ""
+            if cache_keys[step] is None:
+                log.info(f"Skipping step {job.name}, completed in an earlier run")
+                del cache_keys[step]
+
+        # steps each step waits for
+        waits_for = OrderedDict()
+        resources = [getattr(job, 'caracal_resources', None) or (set(), {WorkerAdministrator.ALL_RESOURCES})
+                     for job in self.jobs]
+        for step in cache_keys:
+            waits_for[step] = {earlier for earlier in cache_keys if earlier < step and
+                               self._conflict(resources[step - 1], resources[earlier - 1])}
+
+        nslots = self.pipeline.parallel_ms_slots(len(waits_for))
+        if nslots > 1:
+            log.info(f"Running {len(waits_for)} steps, up to {nslots} at a time")
+        # the recipe state (completed steps, resume file) is only updated here, in the calling thread
+        recipe = {"name": self.name, "steps": []}
+        self.completed, self.failed, self.remaining = [], None, []
+        running = {}
+        error = None
+        with ThreadPoolExecutor(nslots) as pool:
+            while waits_for or running:
+                if error is None:
+                    for step in [step for step, waiting in waits_for.items() if not waiting]:
+                        if len(running) == nslots:
+                            break
+                        del waits_for[step]
+                        running[pool.submit(self._run_step, step)] = step
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in sorted(done, key=running.get):
+                    step = running.pop(future)
+                    job = self.jobs[step - 1]
+                    try:
+                        future.result()
+                    except Exception as exc:
+                        # let running steps finish, but do not start new ones
+                        if error is None:
+                            error, self.failed = exc, job
+                        self.log2recipe(job, recipe, step, 'failed')
+                    else:
+                        self.log2recipe(job, recipe, step, 'completed')
+                        self.completed.append(job)
+                        if cache_keys[step]:
+                            cache.record(job.caracal_step, cache_keys[step])
+                    for waiting in waits_for.values():
+                        waiting.discard(step)
+
+        if error is not None:
+            self.remaining = [self.jobs[step - 1] for step in waits_for]
+            self.log.info('Completed jobs : {}'.format([job.name for job in self.completed]))
+            self.log.info('Remaining jobs : {}'.format([job.name for job in self.remaining]))
+            for step in waits_for:
+                self.log2recipe(self.jobs[step - 1], recipe, step, 'remaining')
+        self.log.info('Saving pipeline information in {}'.format(self.resume_file))
+        stimela.utils.writeJson(self.resume_file, recipe)
+        if error is not None:
+            if isinstance(error, self.STEP_ERRORS):
+                # already logged by _run_step
+                raise PipelineException(error, self.completed, self.failed, self.remaining) from None
+            raise error
+        self.log.info('Recipe executed successfully')
+        return 0
+
+    # Step errors reported as a failed recipe (PipelineException), as stimela.Recipe.run does
+    STEP_ERRORS = (stimela.utils.StimelaCabRuntimeError, StimelaRecipeExecutionError, StimelaCabParameterError)
+
+    def _run_step(self, step):
+        """
+        Runs a step (1-based) as stimela.Recipe.run does, with the same logging and handling of the status declared
+        by output wranglers, but without touching the recipe state, so that steps can run concurrently. Raises
+        the error of a failed step.
+        """
+        job = self.jobs[step - 1]
+        start_time = datetime.now()
+        job.log.info('job started at {}'.format(start_time),
+                     # the extra attributes are filtered by e.g. the CARACal logger
+                     extra=dict(stimela_job_state=(job.name, "running")))
+        self.log.info('STEP {0} :: {1}'.format(step, job.label))
+        try:
+            with open(job.logfile, 'a') as astd:
+                astd.write('\n-----------------------------------\n')
+                astd.write('Stimela version     : {}\n'.format(stimela.__version__))
+                astd.write('Cab name            : {}\n'.format(job.image))
+                astd.write('-------------------------------------\n')
+            job.run_job()
+            # raise exception if wranglers declared the job a failure
+            if job.declare_status is False:
+                raise StimelaRecipeExecutionError("job declared as failed")
+        except self.STEP_ERRORS as exc:
+            finished_time = datetime.now()
+            # ignore exceptions if wranglers declared the job a success
+            if job.declare_status is True:
+                job.log.info('job complete (declared successful) at {} after {}'.format(finished_time, finished_time - start_time),
+                             extra=dict(stimela_job_state=(job.name, "complete")))
+                return
+            job.log.error(str(exc), extra=dict(stimela_job_state=(job.name, "failed"), boldface=True))
+            job.log.error('job failed at {} after {}'.format(finished_time, finished_time - start_time),
+                          extra=dict(stimela_job_state=(job.name, "failed"), color=None))
+            for line in traceback.format_exc().splitlines():
+                job.log.error(line, extra=dict(traceback_report=True))
+            raise
+        finished_time = datetime.now()
+        job.log.info('job complete at {} after {}'.format(finished_time, finished_time - start_time),
+                     extra=dict(stimela_job_state=(job.name, "complete")))
+
+    @staticmethod
+    def _conflict(resources, other):
+        """Whether two steps, given their (reads, writes), cannot run at the same time"""
+        (reads, writes), (other_reads, other_writes) = resources, other
+        if WorkerAdministrator.ALL_RESOURCES in writes | other_writes:
+            return True
+        return bool(writes & (other_reads | other_writes) or reads & other_writes)
+
+
 class WorkerAdministrator(object):
     def __init__(self, config, workers_directory,
                  prefix=None, configFileName=None,
                  add_all_first=False, singularity_image_dir=None,
                  start_worker=None, end_worker=None,
-                 container_tech='docker', generate_reports=True):
+                 container_tech='docker', generate_reports=True, resume=False):
 
         self.config = config
         self.config_file = configFileName
@@ -52,8 +229,6 @@ class WorkerAdministrator(object):
         self.ms_extension = self.config["getdata"]["extension"]
         self.ignore_missing = self.config["getdata"]["ignore_missing"]
 
-        self._msinfo_cache = {}
-
         self.logs_symlink = f'{self.output}/logs'
         self.logs = "{}-{}".format(self.logs_symlink, self.timeNow)
 
@@ -120,8 +295,21 @@ class WorkerAdministrator(object):
                     [_name, suffix]) if suffix else _name for suffix in wkr.FLAG_NAMES]
 
         self.recipes = {}
+        # Journal of the steps completed in this and earlier runs, reused if requested
+        self.resume = resume
+        self.step_cache = StepCache(f'{self.output}/step_cache.json',
+                                    reuse=self.config['general']['cache_steps'] or resume)
+        # Running containers to run the steps of a worker in
+        self.warm_containers = WarmContainers(container_tech) if self.config['general']['warm_containers'] else None
+        # Journal of the workers completed in this and earlier runs, with the pipeline state they left
+        self.checkpoint_file = f'{self.output}/checkpoint.json'
+        self.checkpoint = []
         # Workers to skip
         self.skip = []
+        # attributes set so far are run settings, saved with their initial values (or None if they cannot be
+        # saved). The attributes set from here on (mostly by workers), and the settings that workers change
+        # (e.g. virtconcat), are the pipeline state saved in checkpoints
+        self._settings = {key: self._dump_state(value) for key, value in vars(self).items()}
         # Initialize empty lists for ddids, leave this up to getdata worker to define
         self.dataid = []
         # names of all MSs
@@ -188,20 +376,82 @@ class WorkerAdministrator(object):
                 setattr(self, item, value)
 
     def get_msinfo(self, msname):
-        """Returns info dict corresponding to an MS. Caches and reloads as needed"""
+        """Returns info dict (utils.MSInfo) corresponding to an MS. Caches and reloads as needed"""
         msinfo_file = os.path.splitext(msname)[0] + "-summary.json"
         msinfo_path = os.path.join(self.msdir, msinfo_file)
-        msdict, mtime_cache = self._msinfo_cache.get(msname, (None, 0))
         if not os.path.exists(msinfo_path):
             raise RuntimeError(f"MS summary file {msinfo_file} not found at expected location. This is a bug or "
                                "a misconfiguration. Was the MS transformed properly?")
-        # reload cached dict if file on disk is newer
-        mtime = os.path.getmtime(msinfo_path)
-        if msdict is None or mtime > mtime_cache:
-            with open(msinfo_path, 'r') as f:
-                msdict = ruamel.yaml.load(f, ruamel.yaml.RoundTripLoader)
-            self._msinfo_cache[msname] = msdict, mtime
-        return msdict
+        return utils.MSInfo.load(msinfo_path)
+
+    # Resource standing for the whole pipeline
+    ALL_RESOURCES = "*"
+
+    def is_data_product(self, name):
+        """Whether a recipe step parameter is the name of an MS or of a product of an observation"""
+        return name.endswith(f".{self.ms_extension}") or self.name_observation(name) is not None
+
+    def name_observation(self, name):
+        """
+        Returns the index of the observation (0...nobs-1) that a file name belongs to, i.e. whose MS base name or
+        prefixed MS base name it starts with, or None
+        """
+        # strip Stimela ":input"-type suffixes and paths
+        name = os.path.basename(name.split(':')[0].rstrip('/'))
+        match = None
+        for iobs, names in enumerate(zip(self.msbasenames, self.prefix_msbases)):
+            for base in names:
+                if re.match(re.escape(base) + r'([-_.]|$)', name) and (match is None or len(base) > len(match[0])):
+                    match = base, iobs
+        return match and match[1]
+
+    def step_resources(self, config, inputs=None, outputs=None):
+        """
+        Given the parameters of a recipe step, and optionally the names of its declared inputs and outputs,
+        returns the sets of pipeline resources that the step reads and writes. Resources are observations
+        (as "obs<index>"), the declared names, and self.ALL_RESOURCES for the whole pipeline.
+
+        A step with declared inputs or outputs reads the observations of its inputs and outputs, and its
+        inputs, and it writes its outputs (and the whole pipeline, if an output does not belong to an
+        observation). Otherwise the step is taken to write the observations its parameters refer to, or the
+        whole pipeline if they refer to none.
+        """
+        def observations(names):
+            obs = (self.name_observation(name) for name in names)
+            return {f"obs{iobs}" for iobs in obs if iobs is not None}
+
+        if inputs or outputs:
+            inputs, outputs = list(inputs or []), list(outputs or [])
+            reads = observations(inputs + outputs) | set(inputs)
+            writes = set(outputs)
+            if any(self.name_observation(name) is None for name in outputs):
+                writes.add(self.ALL_RESOURCES)
+            return reads, writes
+
+        names = []
+
+        def scan(value):
+            if isinstance(value, str):
+                names.append(value)
+            elif isinstance(value, (list, tuple)):
+                for item in value:
+                    scan(item)
+            elif isinstance(value, dict):
+                for item in value.values():
+                    scan(item)
+
+        scan(config)
+        return set(), observations(names) or {self.ALL_RESOURCES}
+
+    def parallel_ms_slots(self, nsteps):
+        """Number of recipe steps to run at once, out of nsteps, within general: max_parallel_ms, ms_ncpu and ms_memory"""
+        general = self.config['general']
+        nslots = general['max_parallel_ms'] or nsteps
+        if general['ms_ncpu'] > 0:
+            nslots = min(nslots, psutil.cpu_count() // general['ms_ncpu'])
+        if general['ms_memory'] > 0:
+            nslots = min(nslots, int(psutil.virtual_memory().available / 2**30 // general['ms_memory']))
+        return max(1, min(nslots, nsteps))
 
     # The following three methods provide MS naming services for workers
 
@@ -403,9 +653,24 @@ class WorkerAdministrator(object):
                 cabspecs.update(self.parse_cabspec_dict(config["cabs"]))
             active_workers.append((_name, worker, config, cabspecs))
 
+        # workers completed in the earlier runs journalled in the checkpoint, with unchanged configuration
+        completed = self.load_checkpoint() if self.resume else []
+        ncompleted = 0
+        for (_name, worker, config, cabspecs), entry in zip(active_workers, completed):
+            if entry["worker"] != _name or entry["config"] != self.config_hash(config):
+                break
+            ncompleted += 1
+        if self.resume:
+            if ncompleted:
+                log.info(f"Resuming pipeline after worker {active_workers[ncompleted - 1][0]}")
+                self.restore_state(completed[ncompleted - 1]["state"])
+            else:
+                log.warning(f"No completed workers to resume from in {self.checkpoint_file}, running all workers")
+        self.checkpoint = completed[:ncompleted]
+
         # now run the actual pipeline
         # for _name, _worker, i in self.workers:
-        for _name, worker, config, cabspecs in active_workers:
+        for _name, worker, config, cabspecs in active_workers[ncompleted:]:
             # Define stimela recipe instance for worker
             # Also change logger name to avoid duplication of logging info
             label = getattr(worker, 'LABEL', None)
@@ -416,27 +681,32 @@ class WorkerAdministrator(object):
             if "__" in _name:
                 label += "__" + _name.split("__", 1)[1]
 
-            recipe = stimela.Recipe(label,
-                                    ms_dir=self.msdir,
-                                    singularity_image_dir=self.singularity_image_dir,
-                                    log_dir=self.logs,
-                                    cabspecs=cabspecs,
-                                    logfile=False,  # no logfiles for recipes
-                                    logfile_task=f'{self.logs}/log-{label}-{{task}}-{self.timeNow}.txt')
+            recipe = ParallelMSRecipe(label,
+                                      ms_dir=self.msdir,
+                                      singularity_image_dir=self.singularity_image_dir,
+                                      log_dir=self.logs,
+                                      cabspecs=cabspecs,
+                                      logfile=False,  # no logfiles for recipes
+                                      logfile_task=f'{self.logs}/log-{label}-{{task}}-{self.timeNow}.txt')
 
             recipe.JOB_TYPE = self.container_tech
+            recipe.pipeline = self
             self.CURRENT_WORKER = _name
-            # Don't allow pipeline-wide resume
-            # functionality
-            os.system('rm -f {}'.format(recipe.resume_file))
             # Get recipe steps
             # 1st get correct section of config file
             log_label = "" if _name == label or _name.startswith(label + "__") else f" ({label})"
             log.info(f"{_name}{log_label}: initializing", extra=dict(color="GREEN"))
-            worker.worker(self, recipe, config)
-            log.info(f"{_name}{log_label}: running")
-            recipe.run()
+            # workers may run recipe steps themselves while setting up, so stop the warm containers
+            # whatever happens from here on
+            try:
+                worker.worker(self, recipe, config)
+                log.info(f"{_name}{log_label}: running")
+                recipe.run()
+            finally:
+                if self.warm_containers is not None:
+                    self.warm_containers.close()
             log.info(f"{_name}{log_label}: finished")
+            self.save_checkpoint(_name, config)
 
             # this should be in the cab cleanup code, no?
 
@@ -457,5 +727,103 @@ class WorkerAdministrator(object):
 
         log.info("pipeline run complete")
 
+    @staticmethod
+    def config_hash(config):
+        """Hash of a worker configuration section"""
+        return hashlib.sha1(json.dumps(config, sort_keys=True, default=str).encode()).hexdigest()
+
+    # Attributes that are never pipeline state: the configuration (checkpoints are only reused with the same
+    # worker configurations), and the bookkeeping of the run
+    NOT_STATE = {'_settings', 'CURRENT_WORKER', 'config', 'checkpoint', 'resume', 'skip'}
+
+    @staticmethod
+    def encode_state(value):
+        """
+        Encodes a pipeline state value as JSON-serialisable data, keeping the types that JSON does not have:
+        NumPy arrays and scalars, tuples, sets, and dicts with keys other than strings become tagged dicts
+        (e.g. {"__ndarray__": [...], "dtype": "<f8"}), which decode_state() turns back into the original types.
+        Other dicts (e.g. OrderedDicts) become plain dicts. Raises TypeError for any other type.
+        """
+        encode = WorkerAdministrator.encode_state
+        if value is None or isinstance(value, (bool, int, float, str)):
+            return value
+        if isinstance(value, (numpy.ndarray, numpy.generic)):
+            return {"__ndarray__": encode(value.tolist()), "dtype": value.dtype.str}
+        if isinstance(value, list):
+            return [encode(item) for item in value]
+        if isinstance(value, tuple):
+            return {"__tuple__": [encode(item) for item in value]}
+        if isinstance(value, (set, frozenset)):
+            return {"__set__": [encode(item) for item in value]}
+        if isinstance(value, dict):
+            if all(isinstance(key, str) and not key.startswith("__") for key in value):
+                return {key: encode(item) for key, item in value.items()}
+            return {"__dict__": [[encode(key), encode(item)] for key, item in value.items()]}
+        raise TypeError(f"{type(value)} is not supported in the pipeline state")
+
+    @staticmethod
+    def decode_state(value):
+        """Decodes a pipeline state value encoded by encode_state()"""
+        decode = WorkerAdministrator.decode_state
+        if isinstance(value, list):
+            return [decode(item) for item in value]
+        if not isinstance(value, dict):
+            return value
+        if "__ndarray__" in value:
+            # [()] gives a NumPy scalar for a 0-dimensional array
+            return numpy.array(decode(value["__ndarray__"]), dtype=numpy.dtype(value["dtype"]))[()]
+        if "__tuple__" in value:
+            return tuple(decode(item) for item in value["__tuple__"])
+        if "__set__" in value:
+            return set(decode(item) for item in value["__set__"])
+        if "__dict__" in value:
+            return {decode(key): decode(item) for key, item in value["__dict__"]}
+        return {key: decode(item) for key, item in value.items()}
+
+    @classmethod
+    def _dump_state(cls, value):
+        """Returns the JSON string of an encoded pipeline state value, or None if it cannot be encoded"""
+        try:
+            return json.dumps(cls.encode_state(value))
+        except (TypeError, ValueError):
+            return None
+
+    def pipeline_state(self):
+        """
+        Returns the pipeline state set up by the workers (MS names, fields, frequencies etc.) as a JSON-serialisable
+        dict (see encode_state): the attributes set since __init__, and the run settings that have changed since.
+        """
+        state = {}
+        for key, value in vars(self).items():
+            if key in self.NOT_STATE:
+                continue
+            dump = self._dump_state(value)
+            if dump is None:
+                if key not in self._settings:
+                    log.warning(f"Pipeline attribute {key} cannot be saved to the checkpoint, ignoring it")
+            elif dump != self._settings.get(key):
+                state[key] = json.loads(dump)
+        return state
+
+    def restore_state(self, state):
+        """Restores the pipeline state saved by pipeline_state()"""
+        for key, value in state.items():
+            setattr(self, key, self.decode_state(value))
+
+    def load_checkpoint(self):
+        """Returns the workers journalled in the checkpoint file, as a list of {worker, config, state} dicts"""
+        if not os.path.exists(self.checkpoint_file):
+            return []
+        with open(self.checkpoint_file) as f:
+            return json.load(f)["workers"]
+
+    def save_checkpoint(self, name, config):
+        """Journals a completed worker and the pipeline state after it to the checkpoint file"""
+        self.checkpoint.append(dict(worker=name, config=self.config_hash(config), state=self.pipeline_state()))
+        tmpfile = f"{self.checkpoint_file}.tmp"
+        with open(tmpfile, "w") as f:
+            json.dump(dict(config_file=self.config_file, workers=self.checkpoint), f)
+        os.replace(tmpfile, self.checkpoint_file)
+
     def regenerate_reports(self):
         notebooks.generate_report_notebooks(self._report_notebooks, self.output, self.prefix, self.container_tech)